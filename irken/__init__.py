@@ -7,14 +7,28 @@ from irken.encoding import EncodingMixin
 from irken.io import SelectIO
 from irken.utils import AutoRegisterMixin, NicknameMixin
 from irken.ctcp import CTCPDispatchMixin
+from irken.lag import LagMixin
+from irken.coalesce import CoalescingMixin
+from irken.backpressure import BackpressureMixin
+from irken.caps import CapabilityMixin
+from irken.register import RegistrationMixin
+from irken.say import SayMixin
+from irken.queries import QueryMixin
+from irken.modes import ModeMixin
+from irken.restart import RestartMixin
+from irken.msglog import MessageLogMixin
+from irken.pipeline import compose
 
 class BaseMixin(object):
     client_version = "irken"
     make_io = SelectIO
 
-bases = (BaseMixin, CTCPDispatchMixin, AutoRegisterMixin, EncodingMixin,
-         CommonDispatchMixin, NicknameMixin, BaseConnection)
+bases = (BaseMixin, MessageLogMixin, CTCPDispatchMixin, LagMixin, SayMixin,
+         ModeMixin, QueryMixin, AutoRegisterMixin, EncodingMixin,
+         CoalescingMixin, BackpressureMixin, RegistrationMixin,
+         CapabilityMixin, CommonDispatchMixin, NicknameMixin, RestartMixin,
+         BaseConnection)
 
-Connection = type("Connection", bases, {})
+Connection = compose("Connection", bases)
 
 from logging import basicConfig as logging, DEBUG as LOG_DEBUG
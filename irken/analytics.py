@@ -0,0 +1,276 @@
+r"""Parallel parsing of raw IRC captures into columnar files.
+
+Capture files are split into chunks at line boundaries, and each chunk is
+parsed with `irken.parser` in a process pool. The result is a directory of
+columns, one row per line:
+
+``time.npy``
+    float64 seconds since the epoch, from the server-time tag or a leading
+    timestamp, or NaN if the line had neither.
+``command.npy``, ``source.npy``, ``target.npy``
+    int32 ids into ``command.txt``, ``source.txt`` and ``target.txt``, which
+    list one name per line. -1 means none.
+``text_offsets.npy``
+    uint64 offsets into ``text.bin`` for the text of each line (its last
+    argument), so row *i* is ``text[offsets[i]:offsets[i + 1]]``; there is
+    one more offset than there are rows. `load` maps the blob as uint8.
+
+The ``.npy`` files are written without NumPy, but load with it:
+
+    cols = analytics.load("out")
+    privmsg = cols["commands"].index("PRIVMSG")
+    (cols["command"] == privmsg).sum()
+
+Run as ``python -m irken.analytics OUTDIR CAPTURE...``.
+"""
+
+import os
+import sys
+import struct
+import logging
+import calendar
+import multiprocessing
+from time import strptime
+from array import array
+from operator import add
+from itertools import imap, repeat
+from irken.parser import parse_line, split_tags
+from irken.msglog import targeted_commands
+
+logger = logging.getLogger("irken.analytics")
+
+#: Column name and array typecode.
+columns = (("time", "d"), ("command", "i"), ("source", "i"), ("target", "i"))
+
+_npy_kinds = {"d": "f", "f": "f", "i": "i", "l": "i", "L": "u", "I": "u"}
+_npy_header_size = 128
+
+def npy_header(typecode, itemsize, length):
+    r"""The header of a version 1.0 ``.npy`` file of a 1-d array, padded to a
+    fixed size so that it can be rewritten once the length is known.
+
+    >>> h = npy_header("d", 8, 3)
+    >>> len(h), h[:10]
+    (128, '\x93NUMPY\x01\x00v\x00')
+    >>> h[10:].rstrip()
+    "{'descr': '<f8', 'fortran_order': False, 'shape': (3,), }"
+    """
+    order = "<" if sys.byteorder == "little" else ">"
+    descr = "%s%s%d" % (order, _npy_kinds[typecode], itemsize)
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        descr, length)
+    header = header.ljust(_npy_header_size - 10 - 1) + "\n"
+    return "\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
+
+def read_npy(path):
+    """Read a 1-d ``.npy`` written by this module back into an array, for
+    when NumPy isn't around."""
+    with open(path, "rb") as fp:
+        head = fp.read(_npy_header_size)
+        descr = head.split("'descr': '")[1][:3]
+        typecode = {"f8": "d", "i4": "i", "u8": "L"}[descr[1:]]
+        rv = array(typecode)
+        rv.fromstring(fp.read())
+        return rv
+
+class ColumnWriter(object):
+    """Appends arrays to a ``.npy`` file, fixing the header up on close."""
+
+    def __init__(self, path, typecode):
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.length = 0
+        self.fp = open(path, "wb")
+        self.fp.write(npy_header(typecode, self.itemsize, 0))
+
+    def write(self, arr):
+        arr.tofile(self.fp)
+        self.length += len(arr)
+
+    def close(self):
+        self.fp.seek(0)
+        self.fp.write(npy_header(self.typecode, self.itemsize, self.length))
+        self.fp.close()
+
+def chunk_ranges(path, chunk_size):
+    """Split file *path* into `(start, end)` ranges of about *chunk_size*
+    bytes, each ending just after a newline (or at the end of the file)."""
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as fp:
+        while start < size:
+            fp.seek(min(start + chunk_size, size))
+            fp.readline()
+            end = min(fp.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def parse_server_time(value):
+    """Seconds since the epoch of an IRCv3 server-time tag value.
+
+    >>> parse_server_time("2012-06-30T23:59:60.419Z")
+    1341100800.419
+    >>> parse_server_time("2012-06-30T23:59:59Z")
+    1341100799.0
+    """
+    stamp, _, frac = value.rstrip("Z").partition(".")
+    seconds = calendar.timegm(strptime(stamp, "%Y-%m-%dT%H:%M:%S"))
+    return seconds + (float("0." + frac) if frac else 0.0)
+
+def _parse_time(tags, default):
+    for tag in tags.split(";"):
+        if tag.startswith("time="):
+            try:
+                return parse_server_time(tag[5:])
+            except ValueError:
+                break
+    return default
+
+class _Interner(object):
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __call__(self, name):
+        rv = self.ids.get(name)
+        if rv is None:
+            rv = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return rv
+
+def parse_chunk(job):
+    """Parse the lines of `(path, start, end)`, returning columns with ids
+    local to the chunk, and text offsets from its start."""
+    path, start, end = job
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    nan = float("nan")
+    times, commands, sources, targets = (array(tc) for _, tc in columns)
+    text_ends = array("L")
+    text_end = 0
+    texts = []
+    command_id, source_id, target_id = _Interner(), _Interner(), _Interner()
+    mask_maker = lambda prefix: prefix.split("!", 1)[0]
+    bad = 0
+    for line in data.splitlines():
+        when = nan
+        if line[:1].isdigit():
+            # A leading Unix timestamp, unless it's an unprefixed numeric.
+            stamp, _, rest = line.partition(" ")
+            if len(stamp) > 3:
+                try:
+                    when = float(stamp)
+                except ValueError:
+                    bad += 1
+                    continue
+                line = rest
+        if line.startswith("@"):
+            raw_tags, line = split_tags(line)
+            when = _parse_time(raw_tags.raw, when)
+        if not line:
+            continue
+        try:
+            source, command, args = parse_line(line, mask_maker=mask_maker)
+        except ValueError:
+            bad += 1
+            continue
+        times.append(when)
+        commands.append(command_id(command))
+        sources.append(source_id(source) if source else -1)
+        if args and command in targeted_commands:
+            targets.append(target_id(args[0].lower()))
+        else:
+            targets.append(-1)
+        text = args[-1] if len(args) > 1 else ""
+        texts.append(text)
+        text_end += len(text)
+        text_ends.append(text_end)
+    return {"columns": (times, commands, sources, targets),
+            "names": (command_id.names, source_id.names, target_id.names),
+            "text": "".join(texts), "text_ends": text_ends, "bad": bad}
+
+def analyze(paths, outdir, processes=None, chunk_size=1 << 26):
+    """Parse capture files *paths* into columns in *outdir*, using a pool of
+    *processes* (default: one per core). Returns the number of rows."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = [(path, start, end) for path in paths
+            for start, end in chunk_ranges(path, chunk_size)]
+    writers = [ColumnWriter(os.path.join(outdir, name + ".npy"), typecode)
+               for name, typecode in columns]
+    offsets = ColumnWriter(os.path.join(outdir, "text_offsets.npy"), "L")
+    offsets.write(array("L", [0]))
+    text_fp = open(os.path.join(outdir, "text.bin"), "wb")
+    interners = (_Interner(), _Interner(), _Interner())
+    text_offset = 0
+    rows = bad = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        # imap keeps chunk order, so rows stay in capture order.
+        for result in pool.imap(parse_chunk, jobs):
+            times, commands, sources, targets = result["columns"]
+            writers[0].write(times)
+            for writer, ids, names, interner in zip(
+                    writers[1:], (commands, sources, targets),
+                    result["names"], interners):
+                # The last entry is what -1, for none, indexes.
+                remap = array("i", [interner(name) for name in names] + [-1])
+                writer.write(array("i", imap(remap.__getitem__, ids)))
+            ends = result["text_ends"]
+            if text_offset:
+                ends = array("L", imap(add, ends, repeat(text_offset)))
+            offsets.write(ends)
+            text_fp.write(result["text"])
+            text_offset += len(result["text"])
+            rows += len(times)
+            bad += result["bad"]
+    finally:
+        pool.close()
+        pool.join()
+        for writer in writers + [offsets]:
+            writer.close()
+        text_fp.close()
+    for (name, _), interner in zip(columns[1:], interners):
+        with open(os.path.join(outdir, name + ".txt"), "wb") as fp:
+            fp.write("".join(n + "\n" for n in interner.names))
+    if bad:
+        logger.warning("skipped %d unparseable lines", bad)
+    return rows
+
+def load(outdir, mmap_mode="r"):
+    """Load the columns in *outdir* with NumPy (memory-mapped by default),
+    along with the name lists "commands", "sources" and "targets"."""
+    import numpy
+    rv = {}
+    for name, _ in columns + (("text_offsets", "L"),):
+        rv[name] = numpy.load(os.path.join(outdir, name + ".npy"),
+                              mmap_mode=mmap_mode)
+    for name, _ in columns[1:]:
+        with open(os.path.join(outdir, name + ".txt"), "rb") as fp:
+            rv[name + "s"] = fp.read().splitlines()
+    text_path = os.path.join(outdir, "text.bin")
+    if os.path.getsize(text_path):
+        rv["text"] = numpy.memmap(text_path, dtype=numpy.uint8, mode="r")
+    else:
+        rv["text"] = numpy.zeros(0, dtype=numpy.uint8)
+    return rv
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Parse raw IRC captures into columnar files.")
+    parser.add_argument("outdir")
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("-j", "--processes", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=1 << 26)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    rows = analyze(args.captures, args.outdir, args.processes,
+                   args.chunk_size)
+    logger.info("wrote %d rows to %s", rows, args.outdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+r"""Bounded output: high and low water marks on what's waiting to be sent.
+
+When the peer stops reading, whatever is sent piles up in the protocol's and
+io's buffers. `BackpressureMixin` watches how much is buffered; once it goes
+past *high_water* the connection is paused, and it stays paused until the
+buffers are down to *low_water* again. What happens to sends while paused is
+up to *backpressure_policy*:
+
+"block"
+    Sending waits for the buffer to drain down to the low water mark, for at
+    most *backpressure_timeout* seconds, after which it's given up on as with
+    "disconnect".
+"drop"
+    PRIVMSG and NOTICE (see *low_priority_commands*) are dropped, and counted
+    in *dropped_lines*; everything else is still sent.
+"disconnect"
+    `BackpressureError` is raised, for the owner to reconnect.
+
+Pausing and resuming is dispatched as "output paused" and "output resumed",
+and `drain` calls back once the connection isn't paused. Whether to resume is
+checked whenever the io loop has written output, and on every read.
+
+>>> from irken.tests import TestConnection
+>>> class Conn(BackpressureMixin, TestConnection):
+...     high_water, low_water = 30, 10
+...     backpressure_policy = "drop"
+>>> conn = Conn("bot")
+>>> conn.autoflush = False
+>>> for i in range(3):
+...     conn.send_cmd(None, "PRIVMSG", ("#a", "hello %d" % (i,)))
+>>> conn.send_cmd(None, "PING", ("x",))
+>>> sorted(conn.output_metrics().items())
+[('buffered', 50), ('dropped', 1), ('paused', True)]
+>>> conn.protocol.data_to_send()
+'PRIVMSG #a :hello 0\r\nPRIVMSG #a :hello 1\r\nPING x\r\n'
+"""
+
+import logging
+from irken import IRCError
+from irken.pipeline import stage
+
+logger = logging.getLogger("irken.backpressure")
+
+class BackpressureError(IRCError): pass
+
+class BackpressureMixin(object):
+    """Bounds what's buffered for sending, by *backpressure_policy*."""
+
+    high_water = 1 << 20
+    low_water = 1 << 18
+    backpressure_policy = "block"
+    backpressure_timeout = 30.0
+    low_priority_commands = frozenset(("PRIVMSG", "NOTICE"))
+
+    paused = False
+    dropped_lines = 0
+
+    def __init__(self, *args, **kwds):
+        super(BackpressureMixin, self).__init__(*args, **kwds)
+        self._drain_callbacks = []
+        self.io.on_written = self.output_written
+
+    def output_written(self):
+        if self.paused:
+            self.check_output()
+
+    def buffered_bytes(self):
+        """Bytes sent but not yet written to the network."""
+        return self.protocol.out_bytes + self.io.buffered_bytes()
+
+    def output_metrics(self):
+        return {"buffered": self.buffered_bytes(), "paused": self.paused,
+                "dropped": self.dropped_lines}
+
+    def drain(self, callback):
+        """Call *callback* once output isn't paused; right away if it isn't
+        now."""
+        if self.paused:
+            self._drain_callbacks.append(callback)
+        else:
+            callback()
+
+    def check_output(self):
+        """Pause or resume by the water marks, returning whether paused."""
+        buffered = self.buffered_bytes()
+        if not self.paused and buffered >= self.high_water:
+            self.paused = True
+            logger.warning("output paused with %d bytes buffered", buffered)
+            self.dispatch("output paused", buffered)
+        elif self.paused and buffered <= self.low_water:
+            self.paused = False
+            logger.info("output resumed")
+            self.dispatch("output resumed", buffered)
+            callbacks, self._drain_callbacks = self._drain_callbacks, []
+            for callback in callbacks:
+                callback()
+        return self.paused
+
+    @stage("backpressure_cmd")
+    def send_cmd(self, prefix, command, args, **kwds):
+        rv = self.backpressure_cmd(prefix, command, args)
+        if rv is not None:
+            return super(BackpressureMixin, self).send_cmd(*rv, **kwds)
+
+    def backpressure_cmd(self, prefix, command, args):
+        if not self.check_output():
+            return prefix, command, args
+        policy = self.backpressure_policy
+        if policy == "drop":
+            if command.upper() in self.low_priority_commands:
+                self.dropped_lines += 1
+                return None
+        elif policy == "block":
+            self.flush()
+            if not self.io.drain_output(self.low_water,
+                                        self.backpressure_timeout):
+                raise BackpressureError("output stuck at %d bytes" %
+                                        (self.buffered_bytes(),))
+            self.check_output()
+        else:
+            raise BackpressureError("output buffer past %d bytes" %
+                                    (self.high_water,))
+        return prefix, command, args
+
+    def consume(self, data):
+        # Reads come often enough to notice that the peer caught up.
+        if self.paused:
+            self.check_output()
+        return super(BackpressureMixin, self).consume(data)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
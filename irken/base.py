@@ -1,6 +1,9 @@
 import logging
+from contextlib import contextmanager
 from irken.nicks import Mask
 from irken.parser import parse_line, build_line
+from irken.protocol import Protocol
+from irken.io import TimingWheel
 
 logger = logging.getLogger("irken.base")
 
@@ -9,11 +12,22 @@ class BaseConnection(object):
 
     This essentially knows how to parse IRC data and build lines. It doesn't
     know /how/ to send, or how to dispatch, and so on, but it does know that
-    it should send etc.
+    it should send etc. The bytes themselves are handled by a sans-IO
+    `Protocol` instance, and `self.io` merely moves them to and from the
+    network.
+
+    Outgoing data is handed to io as soon as a command is sent, unless
+    *autoflush* is false, in which case it is left in the protocol's buffer
+    until `flush` is called. See `batch`.
     """
 
+    autoflush = True
+    tags = None
+
     def __init__(self, nick):
         self.io = self.make_io()
+        self.protocol = self.make_protocol()
+        self.timers = self.io.timers = TimingWheel()
         self.nick = nick
         self._prefix_cache = {}
 
@@ -30,17 +44,66 @@ class BaseConnection(object):
         """Connect to something. This is outsourced to io."""
         return self.io.connect(*args, **kwds)
 
+    def call_later(self, delay, callback, *args):
+        r"""Call *callback* with *args* in *delay* seconds, from the io loop.
+
+        Returns a `Timer`, whose `cancel` method unschedules the call.
+
+        >>> from irken.tests import TestConnection
+        >>> bc = TestConnection("self")
+        >>> timer = bc.call_later(0, bc.send_cmd, None, "PING", ("x",))
+        >>> bc.timers.advance(now=timer.deadline)
+        1
+        >>> bc.io.sent_lines
+        ['PING x\r\n']
+        """
+        return self.timers.call_later(delay, callback, *args)
+
     def parse_line(self, line):
         return parse_line(line)
 
-    def build_line(self, prefix, command, args):
-        return build_line(prefix, command, args)
+    def build_line(self, prefix, command, args, tags=None):
+        return build_line(prefix, command, args, tags=tags)
 
-    def send_cmd(self, prefix, command, args):
-        """Send an IRC command."""
-        line = self.build_line(prefix, command, args)
+    def make_protocol(self):
+        return Protocol(parser=self.parse_line, builder=self.build_line)
+
+    def send_cmd(self, prefix, command, args, tags=None):
+        """Send an IRC command, optionally with a mapping of message
+        *tags*."""
+        line = self.protocol.send(prefix, command, args, tags=tags)
         logger.debug("send " + repr(line))
-        self.io.deliver(line + "\r\n")
+        if self.autoflush:
+            self.flush()
+
+    def flush(self):
+        """Hand everything the protocol has buffered to io."""
+        data = self.protocol.data_to_send()
+        if data:
+            self.io.deliver(data)
+
+    @contextmanager
+    def batch(self):
+        r"""Buffer every command sent within the block, and deliver them all
+        at once when it is exited.
+
+        >>> from irken.tests import TestConnection
+        >>> bc = TestConnection("self")
+        >>> with bc.batch():
+        ...     bc.send_cmd(None, "JOIN", ("#a",))
+        ...     bc.send_cmd(None, "JOIN", ("#b",))
+        ...     bc.io.sent_lines
+        []
+        >>> bc.io.sent_lines
+        ['JOIN #a\r\nJOIN #b\r\n']
+        """
+        prev, self.autoflush = self.autoflush, False
+        try:
+            yield self
+        finally:
+            self.autoflush = prev
+            if prev:
+                self.flush()
 
     def recv_cmd(self, prefix, command, args):
         """Receive an IRC command."""
@@ -51,18 +114,25 @@ class BaseConnection(object):
         return self.io.run(*args, **kwds)
 
     def consume(self, data):
-        """Consume every line in string *data*, returning any incomplete data
-        found.
+        """Consume every line in string *data*.
 
-        This really just iterates through each line, parses it and calls
-        `self.recv_cmd`.
+        This really just feeds the protocol and calls `self.recv_message` for
+        each message it parsed. Any incomplete data is kept by the protocol,
+        so the empty string is always returned.
         """
-        lines = data.replace("\r\n", "\n").replace("\r", "\n").split("\n")
-        trail = lines.pop()
-        for line in lines:
-            logger.debug("recv " + repr(line))
-            self.recv_cmd(*self.parse_line(line))
-        return trail
+        for msg in self.protocol.receive_data(data):
+            logger.debug("recv " + repr(msg.line))
+            self.recv_message(msg)
+        return ""
+
+    def recv_message(self, msg):
+        """Receive a parsed `Message`, raw line and all.
+
+        The message's tags are kept in *tags* while it is being received, so
+        that handlers can look at them.
+        """
+        self.tags = msg.tags
+        self.recv_cmd(msg.prefix, msg.command, msg.args)
 
     def lookup_prefix(self, prefix):
         """Turn *prefix* into an actual source with similar behavior to this
@@ -112,6 +182,11 @@ class BaseConnection(object):
         return RemoteSource(prefix)
 
 class RemoteSource(object):
+    # Known with IRCv3 capabilities, see irken.caps.
+    account = None
+    away = None
+    realname = None
+
     def __init__(self, mask):
         self.mask = mask
         # Could be a property, but it isn't.
@@ -0,0 +1,134 @@
+r"""Bulk handling of NAMES and WHO replies.
+
+Joining a channel makes the server send its member list as a burst of 353
+numerics, and a WHO is answered with a burst of 352s (or 354s, with WHOX).
+`BurstMixin` keeps their raw arguments until the end-of-list numeric, then
+decodes the lot at once and dispatches a single event:
+
+"names complete" *(channel, members, userhosts)*
+    *members* maps each nick to its membership prefix symbols ("@", "+",
+    or "" for most), with the nicks interned. *userhosts* maps nicks to
+    "user@host", if the server sent them (see userhost-in-names).
+"who complete" *(mask, rows)*
+    *rows* are the reply arguments after our own nick, one list per user.
+
+>>> from irken.tests import TestConnection
+>>> class Conn(BurstMixin, TestConnection):
+...     dispatch_burst_lines = True
+...     @handler("names complete")
+...     def show_names(self, name, channel, members, userhosts):
+...         print channel, sorted(members.items())
+>>> conn = Conn("bot")
+>>> conn.consume(":srv 353 bot = #chan :@op +voice plain\r\n"
+...              ":srv 353 bot = #chan :@+both\r\n"
+...              ":srv 366 bot #chan :End of /NAMES list.\r\n")
+#chan [(u'both', u'@+'), (u'op', u'@'), (u'plain', u''), (u'voice', u'+')]
+''
+
+The lines of a burst are dispatched on their own as well, for handlers of
+353, 352 or 354, unless *dispatch_burst_lines* is false, which saves decoding
+and dispatching each of them. The end-of-list numerics are dispatched as
+usual, after the event.
+
+The whole burst is decoded in one go if it's all in the primary encoding;
+if not, each nick or field is decoded on its own, so that one nick in
+latin1 doesn't have the rest decoded as latin1 too.
+"""
+
+from irken.dispatch import handler
+from irken.isupport import ISupportMixin
+
+class BurstMixin(ISupportMixin):
+    """Collects NAMES and WHO bursts, dispatching them as one event each."""
+
+    dispatch_burst_lines = True
+    nick_intern_size = 1 << 16
+
+    def __init__(self, *args, **kwds):
+        super(BurstMixin, self).__init__(*args, **kwds)
+        self._names_bursts = {}
+        self._who_burst = []
+        self._nicks = {}
+
+    def recv_message(self, msg):
+        command, args = msg.command, msg.args
+        if command == "353" and len(args) >= 4:
+            burst = self._names_bursts.get(args[2].lower())
+            if burst is None:
+                burst = self._names_bursts[args[2].lower()] = [args[2]]
+            burst.append(args[3])
+            if not self.dispatch_burst_lines:
+                return
+        elif command in ("352", "354") and len(args) >= 2:
+            self._who_burst.append(args[1:])
+            if not self.dispatch_burst_lines:
+                return
+        elif command == "366" and len(args) >= 2:
+            self.end_names_burst(args[1])
+        elif command == "315" and len(args) >= 2:
+            self.end_who_burst(args[1])
+        return super(BurstMixin, self).recv_message(msg)
+
+    def _decode_one(self, data):
+        decode = getattr(self, "_decode", None)
+        return decode(data) if decode is not None else data
+
+    def _decode_burst(self, items, sep):
+        """Decode the strings *items*, none of which contain *sep*: all at
+        once if they're in the primary encoding, else one by one."""
+        decode = getattr(self, "_decode", None)
+        if decode is None:
+            return items
+        encodings = getattr(self, "encodings", ())
+        if encodings:
+            try:
+                return sep.join(items).decode(encodings[0]).split(sep)
+            except UnicodeDecodeError:
+                pass
+        return map(decode, items)
+
+    def end_names_burst(self, channel):
+        burst = self._names_bursts.pop(channel.lower(), None) or [channel]
+        channel = self._decode_one(burst[0])
+        entries = " ".join(burst[1:]).split()
+        members, userhosts = self.split_names(
+            " ".join(self._decode_burst(entries, " ")))
+        self.dispatch("names complete", channel, members, userhosts)
+
+    def split_names(self, text):
+        """Split a space-separated NAMES list into `(members, userhosts)`.
+
+        >>> from irken.tests import TestConnection
+        >>> class Conn(BurstMixin, TestConnection): pass
+        >>> members, userhosts = Conn("bot").split_names("@a!u@h b")
+        >>> sorted(members.items()), userhosts
+        ([('a', '@'), ('b', '')], {'a': 'u@h'})
+        """
+        symbols = self.prefix_symbols()
+        nicks = self._nicks
+        if len(nicks) >= self.nick_intern_size:
+            nicks.clear()
+        members = {}
+        userhosts = {}
+        for entry in text.split():
+            nick = entry.lstrip(symbols)
+            modes = entry[:len(entry) - len(nick)]
+            if "!" in nick:
+                nick, _, userhost = nick.partition("!")
+                userhosts[nick] = userhost
+            nick = nicks.setdefault(nick, nick)
+            members[nick] = modes
+        return members, userhosts
+
+    def end_who_burst(self, mask):
+        rows, self._who_burst = self._who_burst, []
+        if rows:
+            # NUL can't be in an IRC argument.
+            fields = iter(self._decode_burst(
+                [field for row in rows for field in row], "\0"))
+            rows = [[next(fields) for field in row] for row in rows]
+        self.dispatch("who complete", self._decode_one(mask), rows)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
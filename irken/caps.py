@@ -0,0 +1,217 @@
+r"""IRCv3 capability negotiation.
+
+`CapabilityMixin` sends ``CAP LS 302`` before registering, requests those of
+*wanted_caps* the server offers, and ends negotiation once they've been
+acknowledged or refused. With the capabilities enabled, what used to take a
+WHO per channel arrives on its own, and is put on the sources:
+
+>>> from irken.tests import TestConnection
+>>> class Conn(CapabilityMixin, TestConnection): pass
+>>> conn = Conn("bot")
+>>> conn.start_negotiation()
+>>> conn.consume(":srv CAP * LS :multi-prefix extended-join sasl\r\n")
+''
+>>> conn.io.sent_lines
+['CAP LS 302\r\n', 'CAP REQ :multi-prefix extended-join\r\n']
+>>> conn.consume(":srv CAP * ACK :multi-prefix extended-join\r\n")
+''
+>>> conn.io.sent_lines[-1], sorted(conn.caps)
+('CAP END\r\n', ['extended-join', 'multi-prefix'])
+>>> conn.consume(":friend!f@host JOIN #chan friends_acct :Real Name\r\n")
+''
+>>> src = conn.lookup_prefix(("friend",))
+>>> src.account, src.realname
+('friends_acct', 'Real Name')
+
+The extra JOIN arguments are taken off, so JOIN handlers see the plain
+``(cmd, channel)`` they always have. Likewise ACCOUNT (account-notify) and
+AWAY (away-notify) set *account* and *away* on their source, NAMES replies
+with userhost-in-names fill in the masks of sources, and batches are
+dispatched as "batch start" and "batch end" events.
+"""
+
+import logging
+from irken.nicks import Mask
+from irken.dispatch import handler
+from irken.bursts import BurstMixin
+from irken.pipeline import stage
+from irken.parser import max_line_length
+
+logger = logging.getLogger("irken.caps")
+
+def parse_caps(text):
+    """Parse a CAP LS/ACK/NEW/DEL list into a dict of name to value.
+
+    >>> sorted(parse_caps("sasl=PLAIN,EXTERNAL batch -away-notify").items())
+    [('-away-notify', None), ('batch', None), ('sasl', 'PLAIN,EXTERNAL')]
+    """
+    rv = {}
+    for token in text.split():
+        name, eq, value = token.partition("=")
+        rv[name] = value if eq else None
+    return rv
+
+class CapabilityMixin(BurstMixin):
+    """Negotiates *wanted_caps* while registering.
+
+    This must come after `AutoRegisterMixin` so that CAP LS goes out before
+    USER and NICK, and after the encoding mixin so it sees decoded text.
+    """
+
+    wanted_caps = ("multi-prefix", "userhost-in-names", "extended-join",
+                   "away-notify", "account-notify", "batch")
+
+    def __init__(self, *args, **kwds):
+        super(CapabilityMixin, self).__init__(*args, **kwds)
+        self.reset_caps()
+
+    def reset_caps(self):
+        """Forget what was negotiated on the previous connection."""
+        self.caps = {}
+        self.available_caps = {}
+        self.batches = {}
+        self._cap_ls = {}
+        self._caps_pending = set()
+        self._negotiation_holds = set()
+        self._negotiating = False
+
+    def connect(self, *args, **kwds):
+        self.reset_caps()
+        rv = super(CapabilityMixin, self).connect(*args, **kwds)
+        self.start_negotiation()
+        return rv
+
+    def start_negotiation(self):
+        self._negotiating = True
+        self.send_cmd(None, "CAP", ("LS", "302"))
+
+    def request_caps(self, names):
+        """Send CAP REQ for *names*, in as many lines as it takes."""
+        names = [name for name in names if name not in self._caps_pending]
+        room = max_line_length - len("CAP REQ :\r\n")
+        line = []
+        for name in names + [None]:
+            if name is None or (line and
+                                len(" ".join(line + [name])) > room):
+                if line:
+                    self.send_cmd(None, "CAP", ("REQ", " ".join(line)))
+                    self._caps_pending.update(line)
+                line = []
+            if name is not None:
+                line.append(name)
+
+    def end_negotiation(self):
+        if self._negotiating and not (self._caps_pending or
+                                      self._negotiation_holds):
+            self._negotiating = False
+            self.send_cmd(None, "CAP", ("END",))
+
+    def hold_negotiation(self, reason):
+        """Keep negotiation from ending until `release_negotiation` is called
+        with the same *reason*, as for SASL."""
+        self._negotiation_holds.add(reason)
+
+    def release_negotiation(self, reason):
+        self._negotiation_holds.discard(reason)
+        self.end_negotiation()
+
+    def wanted_of(self, offered):
+        return [name for name in self.wanted_caps
+                if name in offered and name not in self.caps]
+
+    @handler("irc cmd cap")
+    def handle_cap(self, cmd, target, subcmd, *args):
+        subcmd = subcmd.upper()
+        more = len(args) > 1 and args[0] == "*"
+        caps = parse_caps(args[-1] if args else "")
+        if subcmd == "LS":
+            self._cap_ls.update(caps)
+            if more:
+                return
+            self.available_caps.update(self._cap_ls)
+            self._cap_ls = {}
+            self.request_caps(self.wanted_of(self.available_caps))
+            self.end_negotiation()
+        elif subcmd == "ACK":
+            for name, value in caps.iteritems():
+                if name.startswith("-"):
+                    self.caps.pop(name[1:], None)
+                    self._caps_pending.discard(name[1:])
+                else:
+                    self.caps[name] = self.available_caps.get(name)
+                    self._caps_pending.discard(name)
+            self.dispatch("caps changed", self.caps)
+            self.end_negotiation()
+        elif subcmd == "NAK":
+            logger.info("server refused capabilities %s", " ".join(caps))
+            self._caps_pending.difference_update(caps)
+            self.end_negotiation()
+        elif subcmd == "NEW":
+            self.available_caps.update(caps)
+            self.request_caps(self.wanted_of(caps))
+        elif subcmd == "DEL":
+            for name in caps:
+                self.available_caps.pop(name, None)
+                self.caps.pop(name, None)
+            self.dispatch("caps changed", self.caps)
+
+    @handler("irc num 001")
+    def stop_negotiating(self, cmd, *args):
+        # Registered, so the server's done with negotiation either way.
+        self._negotiating = False
+
+    @handler("irc num 410", "irc num 421")
+    def cap_not_supported(self, cmd, *args):
+        if len(args) >= 2 and args[1].upper() == "CAP":
+            self._negotiating = False
+            self._caps_pending.clear()
+            self._negotiation_holds.clear()
+
+    # What the capabilities bring.
+
+    @stage("caps_cmd")
+    def recv_cmd(self, prefix, command, args, **kwds):
+        rv = self.caps_cmd(prefix, command, args)
+        if rv is not None:
+            return super(CapabilityMixin, self).recv_cmd(*rv, **kwds)
+
+    def caps_cmd(self, prefix, command, args):
+        if command == "JOIN" and len(args) >= 3 and prefix:
+            # extended-join: JOIN <channel> <account> :<realname>
+            source = self.lookup_prefix(prefix)
+            source.account = None if args[1] == "*" else args[1]
+            source.realname = args[2]
+            args = args[:1]
+        return prefix, command, args
+
+    @handler("irc cmd account")
+    def note_account(self, cmd, account):
+        if cmd.source is not None:
+            cmd.source.account = None if account == "*" else account
+
+    @handler("irc cmd away")
+    def note_away(self, cmd, message=None):
+        if cmd.source is not None:
+            cmd.source.away = message or None
+
+    @handler("names complete")
+    def learn_names_masks(self, name, channel, members, userhosts):
+        for nick, userhost in userhosts.iteritems():
+            source = self.lookup_prefix((nick,))
+            if source is not self:
+                user, _, host = userhost.partition("@")
+                source.mask = Mask(nick, user, host)
+
+    @handler("irc cmd batch")
+    def handle_batch(self, cmd, ref, *args):
+        if ref.startswith("+"):
+            kind = args[0] if args else None
+            self.batches[ref[1:]] = (kind, args[1:])
+            self.dispatch("batch start", ref[1:], kind, *args[1:])
+        elif ref.startswith("-"):
+            kind, params = self.batches.pop(ref[1:], (None, ()))
+            self.dispatch("batch end", ref[1:], kind, *params)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
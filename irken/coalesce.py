@@ -0,0 +1,131 @@
+r"""Multi-target PRIVMSG/NOTICE coalescing.
+
+Sending the same text to many targets is one line per target, unless the
+server says it takes several targets per command (ISUPPORT TARGMAX or
+MAXTARGETS). Within a `coalesce` block, PRIVMSGs and NOTICEs are held back,
+and when the block ends those of the same text are sent as comma-joined lines
+that respect both the server's target limit and the 512-byte line limit.
+
+Each target still gets its messages in the order they were sent, and nothing
+else sent in the block overtakes them: any other command, tagged message or
+message with a source sends what's held first.
+
+>>> from irken.tests import TestConnection
+>>> class Conn(CoalescingMixin, TestConnection): pass
+>>> conn = Conn("self")
+>>> conn.isupport["TARGMAX"] = "PRIVMSG:3"
+>>> with conn.coalesce():
+...     for chan in ("#a", "#b", "#c", "#d"):
+...         conn.send_cmd(None, "PRIVMSG", (chan, "Hello there"))
+...     conn.send_cmd(None, "PRIVMSG", ("#a", "Bye"))
+>>> conn.io.sent_lines
+['PRIVMSG #a,#b,#c :Hello there\r\nPRIVMSG #d :Hello there\r\nPRIVMSG #a Bye\r\n']
+"""
+
+from contextlib import contextmanager
+from irken.isupport import ISupportMixin
+from irken.pipeline import stage
+from irken.parser import max_line_length
+
+def group_targets(targets, overhead, max_targets=None,
+                  max_length=max_line_length):
+    """Split *targets* into groups whose comma-joined length plus *overhead*
+    fits in *max_length*, with at most *max_targets* per group.
+
+    >>> group_targets(["#a", "#bb", "#c"], 500, max_length=508)
+    [['#a', '#bb'], ['#c']]
+    >>> group_targets(["#a", "#bb", "#c"], 0, max_targets=2)
+    [['#a', '#bb'], ['#c']]
+
+    A target that can't fit even on its own still gets a group of its own;
+    it's the server's call what to do with it.
+
+    >>> group_targets(["#toolong", "#a"], 510)
+    [['#toolong'], ['#a']]
+    """
+    groups = []
+    group, length = [], overhead
+    for target in targets:
+        size = len(target) + (1 if group else 0)
+        if group and (length + size > max_length or
+                      (max_targets and len(group) >= max_targets)):
+            groups.append(group)
+            group, length = [], overhead
+            size = len(target)
+        group.append(target)
+        length += size
+    if group:
+        groups.append(group)
+    return groups
+
+class CoalescingMixin(ISupportMixin):
+    """Merges identical PRIVMSG/NOTICE payloads sent within `coalesce`.
+
+    This must come after the encoding mixin so that it measures bytes.
+    """
+
+    coalesce_commands = ("PRIVMSG", "NOTICE")
+
+    def __init__(self, *args, **kwds):
+        super(CoalescingMixin, self).__init__(*args, **kwds)
+        self._coalesce_depth = 0
+        self._reset_coalesced()
+
+    def _reset_coalesced(self):
+        # Lines to send, in order, as [command, text, targets]; the index of
+        # the last line of each (command, text), and of each target's last.
+        self._coalesced = []
+        self._coalesced_last = {}
+        self._coalesced_targets = {}
+
+    @contextmanager
+    def coalesce(self):
+        self._coalesce_depth += 1
+        try:
+            yield self
+        finally:
+            self._coalesce_depth -= 1
+            if not self._coalesce_depth:
+                self.flush_coalesced()
+
+    @stage("coalesce_cmd", keywords=True)
+    def send_cmd(self, prefix, command, args, **kwds):
+        rv = self.coalesce_cmd(prefix, command, args, **kwds)
+        if rv is not None:
+            return super(CoalescingMixin, self).send_cmd(*rv, **kwds)
+
+    def coalesce_cmd(self, prefix, command, args, tags=None):
+        # Tagged messages are never merged.
+        if not (self._coalesce_depth and prefix is None and not tags and
+                len(args) == 2 and command.upper() in self.coalesce_commands):
+            if self._coalesced:
+                self.flush_coalesced()
+            return prefix, command, args
+        key = (command.upper(), args[1])
+        target = args[0].lower()
+        # A line may take another target only if it comes after every line
+        # already held for that target, so that its messages keep order.
+        index = self._coalesced_last.get(key)
+        if index is None or index <= self._coalesced_targets.get(target, -1):
+            index = self._coalesced_last[key] = len(self._coalesced)
+            self._coalesced.append([key[0], args[1], []])
+        self._coalesced[index][2].append(args[0])
+        self._coalesced_targets[target] = index
+        return None
+
+    def flush_coalesced(self):
+        pending = self._coalesced
+        self._reset_coalesced()
+        send_cmd = super(CoalescingMixin, self).send_cmd
+        with self.batch():
+            for command, text, targets in pending:
+                # The line sans targets is the same for every group.
+                overhead = len(self.build_line(None, command, ("", text))) + 2
+                groups = group_targets(targets, overhead,
+                                       self.max_targets(command))
+                for group in groups:
+                    send_cmd(None, command, (",".join(group), text))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
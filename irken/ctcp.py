@@ -1,6 +1,6 @@
 """CTCP decoding, encoding and dispatching."""
 
-from irken.dispatch import DispatchRegistering, Command, handler
+from irken.dispatch import DispatchRegistering, Event, handler
 
 # This implementation is sort of taken from irssi. It isn't made based on the
 # RFC, because the RFC is old and it never happened.
@@ -115,14 +115,18 @@ def parse(text):
 class BaseCTCPDispatchMixin(DispatchRegistering):
     @handler("irc cmd privmsg", "irc cmd notice")
     def dispatch_ctcp(self, cmd, target, text):
+        if "\x01" not in text:
+            return
         irc_cmd = cmd[8:].lower()
         tpnam = dict(privmsg="message", notice="reply")[irc_cmd]
         for tag, data in parse(text):
             args = (data,) if data else ()
-            command = Command("ctcp %s %s" % (tpnam, tag), source=cmd.source)
-            if not self.dispatch(command, *args):
-                default_command = Command("ctcp " + tpnam + " default")
-                self.dispatch(default_command, command, *args)
+            name = "ctcp " + tpnam + " " + tag
+            event = Event(name, name.lower(), tag, cmd.source, args,
+                          getattr(cmd, "tags", None))
+            if not self.dispatch(event, *args):
+                default_name = "ctcp " + tpnam + " default"
+                self.dispatch(default_name, event, *args)
 
 class CTCPDispatchMixin(BaseCTCPDispatchMixin):
     @handler("ctcp message version")
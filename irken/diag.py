@@ -0,0 +1,289 @@
+r"""Memory accounting per subsystem.
+
+`memory_usage` sizes up what a connection holds on to, by subsystem: the
+prefix cache (with whatever attributes user code hangs on sources), the
+dispatch tables and caches, io and protocol buffers, and so on. Sizes are
+estimates -- `sys.getsizeof` summed over containers and instance dicts --
+but they're cheap, and they move when memory does, which is what matters
+for spotting a leak.
+
+>>> from irken.tests import TestConnection
+>>> conn = TestConnection("bot")
+>>> src = conn.lookup_prefix(("friend", "f", "host"))
+>>> usage = memory_usage(conn)
+>>> usage["prefix_cache"][0], usage["prefix_cache"][1] > 0
+(1, True)
+
+`DiagnosticsMixin` samples this every *diag_interval* seconds and warns
+about subsystems that have grown in every one of the last *diag_history*
+samples, and `memory_report` dumps the lot on demand. If `tracemalloc` is
+importable (it isn't part of Python 2, but there's a backport) and tracing,
+the report also has the top allocation sites in irken's own files.
+
+Object counts, by type, are available with `count_objects`, but walk the
+whole heap, so they're left out of the periodic samples. So is most of a
+large prefix or query cache: samples size up at most *diag_sample_size* of
+its entries and scale up from those, while `memory_report` walks it all.
+"""
+
+import gc
+import sys
+import logging
+from time import time
+from itertools import islice
+from collections import deque
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logging.getLogger("irken.diag")
+
+_atomic = (int, long, float, bool, str, unicode, type(None))
+
+def deep_size(obj, seen=None, depth=4):
+    """Estimate the bytes held by *obj*: its size, plus that of its items,
+    attributes and slots, down to *depth* levels. Objects are counted once,
+    however many times they're reached.
+
+    >>> deep_size("abc") == sys.getsizeof("abc")
+    True
+    >>> deep_size(["abc"]) == sys.getsizeof(["abc"]) + sys.getsizeof("abc")
+    True
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if depth <= 0 or isinstance(obj, _atomic):
+        return size
+    depth -= 1
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen, depth) + deep_size(value, seen, depth)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += deep_size(item, seen, depth)
+    if hasattr(obj, "__dict__") and not isinstance(obj, type):
+        size += deep_size(vars(obj), seen, depth)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if slot != "__dict__" and hasattr(obj, slot):
+            size += deep_size(getattr(obj, slot), seen, depth)
+    return size
+
+def sampled_size(mapping, sample=None, seen=None, depth=4):
+    """Estimate the bytes held by dict *mapping* as `deep_size` does, but
+    from only *sample* of its entries if it has more, scaled up to all.
+
+    >>> d = dict((i, "x" * 10) for i in range(100))
+    >>> sampled_size(d) == deep_size(d)
+    True
+    >>> abs(sampled_size(d, 10) - deep_size(d)) < deep_size(d) // 10
+    True
+    """
+    if sample is None or len(mapping) <= sample:
+        return deep_size(mapping, seen, depth)
+    seen = set() if seen is None else seen
+    seen.add(id(mapping))
+    depth -= 1
+    entries = 0
+    for key, value in islice(mapping.iteritems(), sample):
+        entries += deep_size(key, seen, depth) + deep_size(value, seen, depth)
+    return sys.getsizeof(mapping, 0) + entries * len(mapping) // sample
+
+def _buffer_bytes(conn):
+    protocol = conn.protocol
+    size = protocol.out_bytes + len(protocol.in_tail)
+    buffered = getattr(conn.io, "buffered_bytes", None)
+    return size + (buffered() if buffered else 0)
+
+#: Subsystems and how to find what they hold: a function of the connection
+#: and the *sample* limit of `memory_usage`, returning `(items, bytes)`. Add
+#: to it for state of your own.
+subsystems = {
+    "prefix_cache": lambda conn, sample: (
+        len(conn._prefix_cache),
+        sampled_size(conn._prefix_cache, sample, set([id(conn)]), depth=6)),
+    "dispatch": lambda conn, sample: (
+        len(conn.evtable) + len(getattr(conn, "_pattern_cache", ())),
+        deep_size(conn.evtable) +
+        deep_size(getattr(conn, "_pattern_cache", {}))),
+    "buffers": lambda conn, sample: (len(conn.protocol.out_segs),
+                                     _buffer_bytes(conn)),
+    "timers": lambda conn, sample: (len(conn.timers),
+                                    deep_size(conn.timers.wheels)),
+    "queries": lambda conn, sample: (
+        len(conn._query_cache),
+        sampled_size(conn._query_cache, sample, depth=6)),
+}
+
+def memory_usage(conn, sample=None):
+    """Map each of `subsystems` to the `(items, bytes)` *conn* has in it.
+
+    With *sample*, caches of more entries than that are sized from that many
+    and scaled up, which bounds the cost.
+    """
+    rv = {}
+    for name, measure in subsystems.iteritems():
+        try:
+            rv[name] = measure(conn, sample)
+        except AttributeError:
+            # The connection doesn't have this subsystem.
+            continue
+    return rv
+
+#: Types of the nick and mask objects, which `memory_report` always counts.
+nick_types = ("Mask", "ByteNickname", "UniNickname", "RemoteSource")
+
+def count_objects(types=None):
+    """Count live objects by type name, only of *types* if given.
+
+    This walks every object the garbage collector knows of, so it's slow.
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if types is None or name in types:
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def tracemalloc_top(limit=10, match="irken"):
+    """The top allocation sites in files whose name contains *match*, as
+    `(filename:lineno, size, count)`, or [] if not tracing."""
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return []
+    stats = tracemalloc.take_snapshot().statistics("lineno")
+    rv = []
+    for stat in stats:
+        frame = stat.traceback[0]
+        if match in frame.filename:
+            rv.append(("%s:%d" % (frame.filename, frame.lineno),
+                       stat.size, stat.count))
+            if len(rv) >= limit:
+                break
+    return rv
+
+class MemoryHistory(object):
+    """The last *size* samples of `memory_usage`, and what grew across all
+    of them."""
+
+    def __init__(self, size=12):
+        self.samples = deque(maxlen=size)
+
+    def add(self, usage, when=None):
+        self.samples.append((time() if when is None else when, usage))
+
+    def growing(self):
+        """Subsystems whose bytes grew from each sample to the next, with
+        the total growth, provided the history is full.
+
+        >>> h = MemoryHistory(3)
+        >>> for n in (10, 20, 25):
+        ...     h.add({"a": (1, n), "b": (1, 10)})
+        >>> h.growing()
+        {'a': 15}
+        """
+        if len(self.samples) < self.samples.maxlen:
+            return {}
+        usages = [usage for when, usage in self.samples]
+        rv = {}
+        for name in usages[-1]:
+            sizes = [usage[name][1] for usage in usages if name in usage]
+            if len(sizes) == len(usages) and all(
+                    a < b for a, b in zip(sizes, sizes[1:])):
+                rv[name] = sizes[-1] - sizes[0]
+        return rv
+
+class DiagnosticsMixin(object):
+    """Samples memory usage every *diag_interval* seconds, and warns about
+    subsystems that keep growing.
+
+    Sampling happens when data is consumed, so it costs nothing between
+    samples, and one `memory_usage` call per sample, bounded by
+    *diag_sample_size*.
+
+    Setting *dump_requested* has `memory_report` logged from the io loop
+    within *diag_dump_poll* seconds; see `install_dump_signal`.
+    """
+
+    diag_interval = 300.0
+    diag_history = 12
+    diag_sample_size = 256
+    diag_dump_poll = 1.0
+
+    dump_requested = False
+
+    def __init__(self, *args, **kwds):
+        super(DiagnosticsMixin, self).__init__(*args, **kwds)
+        self.memory_history = MemoryHistory(self.diag_history)
+        self._next_diag = time() + self.diag_interval
+        self.call_later(self.diag_dump_poll, self.diag_timer)
+
+    def diag_timer(self):
+        self.check_dump()
+        self.call_later(self.diag_dump_poll, self.diag_timer)
+
+    def check_dump(self):
+        if self.dump_requested:
+            self.dump_requested = False
+            logger.warning("%s", self.memory_report(objects=True))
+
+    def sample_memory(self, now=None):
+        usage = memory_usage(self, self.diag_sample_size)
+        self.memory_history.add(usage, now)
+        for name, growth in self.memory_history.growing().iteritems():
+            logger.warning("%s grew by %d bytes over the last %d samples",
+                           name, growth, len(self.memory_history.samples))
+        return usage
+
+    def consume(self, data):
+        rv = super(DiagnosticsMixin, self).consume(data)
+        self.check_dump()
+        now = time()
+        if now >= self._next_diag:
+            self._next_diag = now + self.diag_interval
+            self.sample_memory(now)
+        return rv
+
+    def memory_report(self, objects=False):
+        """A human-readable dump of memory usage, with growth trends, object
+        counts if *objects*, and tracemalloc's top sites if tracing."""
+        lines = ["memory usage of %s:" % (self.nick,)]
+        usage = memory_usage(self)
+        for name in sorted(usage):
+            items, size = usage[name]
+            lines.append("  %-14s %8d items %12d bytes" % (name, items, size))
+        growing = self.memory_history.growing()
+        for name in sorted(growing):
+            lines.append("  growing: %s by %d bytes" % (name, growing[name]))
+        if objects:
+            counts = count_objects()
+            top = sorted(counts.iteritems(), key=lambda kv: -kv[1])[:20]
+            top.extend((name, counts.get(name, 0)) for name in nick_types
+                       if name not in dict(top))
+            for name, count in top:
+                lines.append("  %-30s %8d objects" % (name, count))
+        for site, size, count in tracemalloc_top():
+            lines.append("  %s: %d bytes in %d blocks" % (site, size, count))
+        return "\n".join(lines)
+
+def install_dump_signal(conns, signum=None):
+    """Log the `memory_report` of each of *conns* on signal *signum*
+    (default SIGUSR1), for a dump from a running process.
+
+    The handler only sets *dump_requested*; walking the heap and logging
+    are left to the connections' io loops, as they don't belong in a signal
+    handler.
+    """
+    import signal
+    signum = signal.SIGUSR1 if signum is None else signum
+    def request_dump(signum, frame):
+        for conn in conns:
+            conn.dump_requested = True
+    signal.signal(signum, request_dump)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,41 +1,179 @@
 import logging
+from fnmatch import fnmatchcase
 from irken import UnhandledCommandError
 from irken.parser import is_numeric
 
 logger = logging.getLogger("irken.dispatch")
 
-def handler(*names):
+class _Stop(object):
+    def __repr__(self): return "STOP"
+
+#: Return this from a handler to stop the event from propagating to the
+#: handlers after it, and to its default fallback.
+STOP = _Stop()
+
+def handler(*names, **kwds):
+    """Register the decorated method as a handler of event *names*.
+
+    Handlers with a higher *priority* are run first; those of equal priority
+    run in the order they were defined in.
+    """
+    priority = kwds.pop("priority", 0)
+    if kwds:
+        raise TypeError("unexpected keyword arguments: %r" % (kwds.keys(),))
     def deco(f):
         f.handles_names = names
+        f.handles_priority = priority
         return f
     return deco
 
+def handler_priority(cls, attr):
+    return getattr(getattr(cls, attr, None), "handles_priority", 0)
+
+def _definition_line(val):
+    code = getattr(getattr(val, "im_func", val), "func_code", None)
+    return code.co_firstlineno if code is not None else 0
+
 def evtable_extend(dst, src):
+    """Add the handlers of *src* to *dst*, each only once, as a class reached
+    by several paths through the bases has its handlers in each of them.
+
+    >>> dst = {"ev": ["a"]}
+    >>> evtable_extend(dst, {"ev": ["a", "b"], "other": ["c"]})
+    >>> sorted(dst.items())
+    [('ev', ['a', 'b']), ('other', ['c'])]
+    """
     for k in src:
-        dst.setdefault(k, []).extend(src[k])
+        attrs = dst.setdefault(k, [])
+        for attr in src[k]:
+            if attr not in attrs:
+                attrs.append(attr)
+
+def is_pattern(name):
+    return "*" in name or "?" in name or "[" in name
+
+class _PatternNode(object):
+    __slots__ = ("children", "globs", "attrs", "rest")
+
+    def __init__(self):
+        self.children = {}
+        self.globs = []
+        self.attrs = []
+        self.rest = []
+
+class PatternTrie(object):
+    """Index of handler patterns, as a trie over the words of event names.
+
+    A word may be a glob, matching one word of the event name, except that a
+    final "*" matches all remaining words, if there is at least one.
+
+    >>> trie = PatternTrie()
+    >>> trie.add("irc num 4*", "on_error")
+    >>> trie.add("ctcp message *", "on_ctcp")
+    >>> trie.add("irc *", "on_irc")
+    >>> trie.match("irc num 433")
+    ['on_error', 'on_irc']
+    >>> trie.match("irc num 001")
+    ['on_irc']
+    >>> trie.match("ctcp message version")
+    ['on_ctcp']
+    >>> trie.match("ctcp reply version")
+    []
+    """
+
+    def __init__(self):
+        self.root = _PatternNode()
+        self.count = 0
+
+    def add(self, pattern, attr):
+        words = pattern.lower().split()
+        node = self.root
+        for i, word in enumerate(words):
+            if word == "*" and i == len(words) - 1:
+                node.rest.append((self.count, attr))
+                break
+            if is_pattern(word):
+                for glob, child in node.globs:
+                    if glob == word:
+                        break
+                else:
+                    child = _PatternNode()
+                    node.globs.append((word, child))
+            else:
+                child = node.children.get(word)
+                if child is None:
+                    child = node.children[word] = _PatternNode()
+            node = child
+        else:
+            node.attrs.append((self.count, attr))
+        self.count += 1
+
+    def match(self, key):
+        """Return the attributes of patterns matching *key*, in the order
+        they were added."""
+        found = []
+        nodes = [self.root]
+        for word in key.split():
+            next_nodes = []
+            for node in nodes:
+                found.extend(node.rest)
+                child = node.children.get(word)
+                if child is not None:
+                    next_nodes.append(child)
+                for glob, child in node.globs:
+                    if fnmatchcase(word, glob):
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            found.extend(node.attrs)
+        found.sort()
+        return [attr for _, attr in found]
 
 class DispatchRegisteringType(type):
     """Type for dispatch registering classes.
 
     Essentially all it does is add or update an event table on the classes of
     its type. It looks for any function that has a `handles_names` attribute
-    and is callable.
+    and is callable. Each event's handlers are then sorted by priority, once,
+    so that dispatching needn't.
     """
 
     def __new__(cls, name, bases, attrs):
         # We create a new base_evtable based on the one base classae's.
         evtable = attrs.setdefault("base_evtable", {})
+        patterns = attrs.setdefault("base_patterns", [])
         for base in bases:
             evtable_extend(evtable, getattr(base, "base_evtable", {}))
+            for item in getattr(base, "base_patterns", ()):
+                if item not in patterns:
+                    patterns.append(item)
         super_cls = super(DispatchRegisteringType, cls)
         new_cls = super_cls.__new__(cls, name, bases, attrs)
+        # Class dicts have no order, so go by where the handlers are defined,
+        # after those of the bases; the sort by priority below keeps it.
+        handlers = []
         for attr in vars(new_cls):
             # We must use getattr to trigger the property machinery that gives
             # us unbound methods and that.
             val = getattr(new_cls, attr)
             if hasattr(val, "handles_names"):
-                for name in val.handles_names:
-                    evtable.setdefault(name.lower(), []).append(attr)
+                handlers.append((_definition_line(val), attr, val))
+        handlers.sort()
+        for _, attr, val in handlers:
+            for name in val.handles_names:
+                if is_pattern(name):
+                    if (name.lower(), attr) not in patterns:
+                        patterns.append((name.lower(), attr))
+                else:
+                    attrs = evtable.setdefault(name.lower(), [])
+                    if attr not in attrs:
+                        attrs.append(attr)
+        for handler_attrs in evtable.itervalues():
+            handler_attrs.sort(key=lambda attr: -handler_priority(new_cls,
+                                                                  attr))
+        new_cls.pattern_trie = None
         return new_cls
 
 class DispatchRegistering(object):
@@ -43,25 +181,78 @@ class DispatchRegistering(object):
 
     Takes the event table from the class and updates it with instance-specific
     modifications, that is, the keyworg argument *evtable*.
+
+    Handlers registered for patterns like "irc num 4*" are kept out of the
+    event table, in a `PatternTrie`. What they resolve to is cached per event
+    name, and events no pattern matches go straight to the event table.
     """
 
     __metaclass__ = DispatchRegisteringType
 
+    pattern_cache_size = 1024
+
     def __init__(self, *args, **kwds):
         self.evtable = evtable = self.base_evtable.copy()
-        self.evtable.update(kwds.pop("evtable", {}))
+        instance_patterns = []
+        for name, attrs in kwds.pop("evtable", {}).iteritems():
+            if is_pattern(name):
+                instance_patterns.extend((name, attr) for attr in attrs)
+            else:
+                evtable[name] = attrs
+        if instance_patterns:
+            self.pattern_trie = self.make_pattern_trie(instance_patterns)
+        elif self.base_patterns and type(self).pattern_trie is None:
+            type(self).pattern_trie = self.make_pattern_trie()
+        self._pattern_cache = {}
         return super(DispatchRegistering, self).__init__(*args, **kwds)
 
+    def make_pattern_trie(self, extra=()):
+        trie = PatternTrie()
+        for pattern, attr in list(self.base_patterns) + list(extra):
+            trie.add(pattern, attr)
+        return trie
+
     def handlers_for(self, name):
-        for handler_attr in self.evtable.get(name.lower(), ()):
+        key = name.key if isinstance(name, Event) else name.lower()
+        handler_attrs = self.evtable.get(key, ())
+        if self.pattern_trie is not None:
+            handler_attrs = self._with_patterns(key, handler_attrs)
+        for handler_attr in handler_attrs:
             yield getattr(self, handler_attr)
 
+    def _with_patterns(self, key, handler_attrs):
+        # Cached with the exact registrations they were merged with, so that
+        # changes to the event table are noticed.
+        cache = self._pattern_cache
+        entry = cache.get(key)
+        if (entry is None or entry[0] is not handler_attrs or
+                entry[1] != len(handler_attrs)):
+            if len(cache) >= self.pattern_cache_size:
+                cache.clear()
+            merged = handler_attrs
+            matched = self.pattern_trie.match(key)
+            if matched:
+                # Exact registrations go before patterns of the same
+                # priority.
+                cls = type(self)
+                merged = list(handler_attrs) + matched
+                merged.sort(key=lambda attr: -handler_priority(cls, attr))
+                merged = tuple(merged)
+            entry = cache[key] = (handler_attrs, len(handler_attrs), merged)
+        return entry[2]
+
     def dispatch(self, name, *args, **kwds):
+        """Call each handler for *name*, returning how many were called.
+
+        A handler returning `STOP` ends the dispatch; as it counts as handled,
+        no default fallback happens either.
+        """
         count = 0
         for handler in self.handlers_for(name):
             count += 1
             try:
-                handler(name, *args, **kwds)
+                if handler(name, *args, **kwds) is STOP:
+                    break
             except:
                 if name != "dispatch error":
                     self.dispatch("dispatch error")
@@ -73,6 +264,93 @@ class DispatchRegistering(object):
     def handle_error(self, name):
         raise
 
+def _event_str(value):
+    return value.name if isinstance(value, Event) else value
+
+class Event(object):
+    """A dispatched event.
+
+    Carries the event *name* (such as "irc cmd PRIVMSG"), its lowercased
+    *key* into the event table, the raw IRC *command*, the resolved *source*,
+    and the *args* and *tags* of the line. It is cheap to make, and made once
+    per line received.
+
+    For the sake of older handlers, it behaves like its name in comparisons
+    and string operations:
+
+    >>> ev = Event("irc cmd PRIVMSG", "irc cmd privmsg", "PRIVMSG", None)
+    >>> ev == "irc cmd PRIVMSG", ev[8:], ev.startswith("irc ")
+    (True, 'PRIVMSG', True)
+    >>> ev + "!", "<%s>" % ev, "%s" % (ev,)
+    ('irc cmd PRIVMSG!', '<irc cmd PRIVMSG>', 'irc cmd PRIVMSG')
+    >>> ev
+    Event('irc cmd PRIVMSG', source=None)
+    """
+
+    __slots__ = ("name", "key", "command", "source", "args", "tags")
+
+    def __init__(self, name, key, command=None, source=None, args=(),
+                 tags=None):
+        self.name = name
+        self.key = key
+        self.command = command
+        self.source = source
+        self.args = args
+        self.tags = tags
+
+    def __eq__(self, other):
+        if isinstance(other, Event):
+            return self.name == other.name and self.source is other.source
+        return self.name == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self): return hash(self.name)
+    def __len__(self): return len(self.name)
+    def __getitem__(self, key): return self.name[key]
+    def __contains__(self, v): return v in self.name
+    def __str__(self): return str(self.name)
+    def __unicode__(self): return unicode(self.name)
+    def __iter__(self): return iter(self.name)
+    def __add__(self, other): return self.name + other
+    def __radd__(self, other): return other + self.name
+    def __mul__(self, n): return self.name * n
+    __rmul__ = __mul__
+    def __mod__(self, args): return self.name % args
+    def __lt__(self, other): return self.name < _event_str(other)
+    def __le__(self, other): return self.name <= _event_str(other)
+    def __gt__(self, other): return self.name > _event_str(other)
+    def __ge__(self, other): return self.name >= _event_str(other)
+
+    def __getattr__(self, attr):
+        # Only reached for what isn't a slot, i.e. string methods.
+        return getattr(self.name, attr)
+
+    def __repr__(self):
+        return "%s(%r, source=%r)" % (self.__class__.__name__, self.name,
+                                      self.source)
+
+_event_names = {}
+_event_names_max = 4096
+
+def event_name(tpnam, command):
+    """Return the `(name, key)` pair for IRC *command*, making each only once.
+
+    >>> event_name("cmd", "PRIVMSG")
+    ('irc cmd PRIVMSG', 'irc cmd privmsg')
+    >>> event_name("cmd", "PRIVMSG")[1] is event_name("cmd", "PRIVMSG")[1]
+    True
+    """
+    rv = _event_names.get(command)
+    if rv is None:
+        name = "irc " + tpnam + " " + command
+        rv = (name, intern(str(name.lower())))
+        # Commands come from the network, so don't let them fill memory.
+        if len(_event_names) < _event_names_max:
+            _event_names[command] = rv
+    return rv
+
 class Command(unicode):
     def __new__(cls, command, source=None):
         return super(Command, cls).__new__(cls, command)
@@ -92,10 +370,11 @@ class BaseDispatchMixin(DispatchRegistering):
 
     def recv_cmd(self, prefix, command, args):
         tpnam = "num" if is_numeric(command) else "cmd"
-        command = Command("irc %s %s" % (tpnam, command),
-                          source=self.lookup_prefix(prefix))
-        if not self.dispatch(command, *args):
-            self.dispatch("irc " + tpnam + " default", command, *args)
+        name, key = event_name(tpnam, command)
+        event = Event(name, key, command, self.lookup_prefix(prefix), args,
+                      self.tags)
+        if not self.dispatch(event, *args):
+            self.dispatch("irc " + tpnam + " default", event, *args)
 
     # Non-fatal if numeric.
     @handler("irc num default")
@@ -113,7 +392,7 @@ class CommonDispatchMixin(BaseDispatchMixin):
     # TODO: Complete
     @handler("irc cmd privmsg")
     def dispatch_privmsg(self, cmd, target_name, text):
-        target = self.lookup_prefix(target_name)
+        target = self.lookup_prefix((target_name,))
         if self == target:
             pass # TODO Handle private queries.
         else:
@@ -127,3 +406,7 @@ class CommonDispatchMixin(BaseDispatchMixin):
     @handler("irc cmd ping")
     def reply_to_ping(self, cmd, *args):
         self.send_cmd(None, "PONG", args)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,3 +1,5 @@
+from irken.pipeline import stage
+
 class EncodingMixin(object):
     r"""Encoder/decoder.
     
@@ -65,17 +67,27 @@ class EncodingMixin(object):
     # I'm a little ethnocentric. Or is it mere convenience?
     encodings = ("utf-8", "latin1")
 
-    def send_cmd(self, prefix, command, args):
+    @stage("encode_cmd")
+    def send_cmd(self, prefix, command, args, **kwds):
+        rv = self.encode_cmd(prefix, command, args)
+        return super(EncodingMixin, self).send_cmd(*rv, **kwds)
+
+    @stage("decode_cmd")
+    def recv_cmd(self, prefix, command, args, **kwds):
+        rv = self.decode_cmd(prefix, command, args)
+        return super(EncodingMixin, self).recv_cmd(*rv, **kwds)
+
+    def encode_cmd(self, prefix, command, args):
         if prefix: prefix = self._encode(prefix)
         command = command.encode("ascii")
         if args: args = map(self._encode, args)
-        return super(EncodingMixin, self).send_cmd(prefix, command, args)
+        return prefix, command, args
 
-    def recv_cmd(self, prefix, command, args):
+    def decode_cmd(self, prefix, command, args):
         if prefix: prefix = self._decode(prefix)
         command = command.decode("ascii")
         if args: args = map(self._decode, args)
-        return super(EncodingMixin, self).recv_cmd(prefix, command, args)
+        return prefix, command, args
 
     def _code(self, target_type, v):
         if isinstance(v, target_type):
@@ -4,25 +4,534 @@ class BaseIO(object):
     def receive(self, consumer): raise NotImplementedError
     def run(self): raise NotImplementedError
 
+    def buffered_bytes(self):
+        """How many bytes were delivered but not yet written."""
+        return 0
+
+    def buffered_output(self):
+        """What was delivered but not yet written."""
+        return ""
+
+    def discard_output(self):
+        """Forget about what was delivered but not yet written."""
+
+    def drain_output(self, below=0, timeout=None):
+        """Write until at most *below* bytes are buffered, or *timeout*
+        seconds have passed. Returns whether it got there."""
+        return True
+
+    #: The connection's `TimingWheel`, run from the loop in `run`.
+    timers = None
+
+    def timer_timeout(self, timeout=None):
+        """*timeout*, shortened to when the next timer is due."""
+        if self.timers is None:
+            return timeout
+        return self.timers.timeout(timeout)
+
+    def run_timers(self):
+        if self.timers is not None:
+            self.timers.advance()
+
+    #: When the data being consumed was found ready to read, for
+    #: `irken.lag.LagMixin` to time dispatching from.
+    readable_at = None
+
+    #: Called when the run loop has written buffered output -- never from
+    #: within a `deliver`, so that it may send.
+    on_written = None
+
+    def written(self):
+        if self.on_written is not None:
+            self.on_written()
+
+import os
+import ssl
+import errno
 import socket
+import hashlib
+from time import time
+from math import ceil
+from heapq import heappush, heappop
+from itertools import count
+from select import select, error as select_error
+
+_in_progress = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def _select(rlist, wlist, xlist, timeout=None):
+    """`select`, but a signal interrupting it counts as nothing being ready,
+    so that the loop comes round and sees what the signal handler did."""
+    try:
+        return select(rlist, wlist, xlist, timeout)
+    except select_error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return [], [], []
+
+def interleave_families(addresses):
+    """Reorder getaddrinfo results so that address families alternate,
+    starting with whichever family came first (as RFC 6555 suggests).
+
+    >>> v4, v6 = socket.AF_INET, socket.AF_INET6
+    >>> addrs = [(v6, 1), (v6, 2), (v6, 3), (v4, 4), (v4, 5)]
+    >>> [n for af, n in interleave_families(addrs)]
+    [1, 4, 2, 5, 3]
+    """
+    by_family, order = {}, []
+    for info in addresses:
+        if info[0] not in by_family:
+            order.append(info[0])
+        by_family.setdefault(info[0], []).append(info)
+    rv = []
+    while any(by_family.values()):
+        for af in order:
+            if by_family[af]:
+                rv.append(by_family[af].pop(0))
+    return rv
+
+class ConnectRace(object):
+    """Staggered parallel connection attempts ("happy eyeballs").
+
+    An attempt is started for the next address every *delay* seconds, or
+    immediately once all running attempts have failed, and the first to
+    connect wins; the others are closed. This doesn't block on its own --
+    `run` does, by selecting, but an event loop can instead call
+    `start_due` and `check` itself and use `timeout` to know when to wake.
+    `check` starts nothing, so call `start_due` after it too, as a failed
+    attempt makes the next one due.
+    """
+
+    def __init__(self, addresses, delay=0.25):
+        self.pending = interleave_families(addresses)
+        self.delay = delay
+        self.attempts = {}
+        self.errors = []
+        self.winner = None
+        self.next_start = None
+
+    @property
+    def done(self):
+        return bool(self.winner or not (self.pending or self.attempts))
+
+    def timeout(self, now=None):
+        """Seconds until the next attempt is due, or None if none is."""
+        if not self.pending or self.next_start is None:
+            return None
+        return max(0.0, self.next_start - (time() if now is None else now))
+
+    def start_due(self, now=None):
+        """Start attempts that are due, returning the new sockets."""
+        now = time() if now is None else now
+        started = []
+        while self.pending and not self.winner and (
+                not self.attempts or now >= self.next_start):
+            af, st, prot, cnam, addr = self.pending.pop(0)
+            sock = socket.socket(af, st, prot)
+            sock.setblocking(0)
+            err = sock.connect_ex(addr)
+            if err not in _in_progress:
+                sock.close()
+                self._fail(addr, err)
+                continue
+            self.attempts[sock] = addr
+            self.next_start = now + self.delay
+            started.append(sock)
+            if not err:
+                self._win(sock)
+        return started
+
+    def check(self, sock):
+        """Check an attempt whose socket became writable, returning True if
+        it won."""
+        if sock not in self.attempts:
+            return False
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            addr = self.attempts.pop(sock)
+            sock.close()
+            self._fail(addr, err)
+            return False
+        self._win(sock)
+        return True
+
+    def _fail(self, addr, err):
+        self.errors.append((addr, socket.error(err, os.strerror(err))))
+
+    def _win(self, sock):
+        self.winner = (sock, self.attempts.pop(sock))
+        self.cancel()
+
+    def cancel(self):
+        """Close every attempt but the winner."""
+        for sock in self.attempts:
+            sock.close()
+        self.attempts.clear()
+
+    def run(self, timeout=None):
+        """Run the race to completion, returning `(socket, address)`."""
+        deadline = None if timeout is None else time() + timeout
+        self.start_due()
+        while not self.done:
+            wait = self.timeout()
+            if deadline is not None:
+                left = max(0.0, deadline - time())
+                if not left:
+                    self.cancel()
+                    raise socket.timeout("connect timed out")
+                wait = left if wait is None else min(wait, left)
+            socks = list(self.attempts)
+            _, w, x = select([], socks, socks, wait)
+            for sock in set(w + x):
+                self.check(sock)
+            self.start_due()
+        if not self.winner:
+            raise self.errors[-1][1] if self.errors else \
+                socket.error("no address to connect to")
+        return self.winner
+
+class Timer(object):
+    """A call scheduled on a `TimingWheel`, which `cancel` unschedules."""
+
+    __slots__ = ("wheel", "tick", "callback", "args", "bucket", "level",
+                 "cancelled")
+
+    def __init__(self, wheel, tick, callback, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+        self.level = 0
+        self.cancelled = False
+
+    @property
+    def deadline(self):
+        return self.tick * self.wheel.resolution
+
+    def cancel(self):
+        if self.level < 0 and not self.cancelled:
+            # Left in the overflow heap, to be skipped when popped.
+            self.wheel.overflowed -= 1
+        self.cancelled = True
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.wheel.counts[self.level] -= 1
+            self.bucket = None
+
+class TimingWheel(object):
+    """Timers on a hierarchical timing wheel.
+
+    Time is cut into ticks of *resolution* seconds. The first level has a
+    slot per tick for the next 64 ticks, the next level a slot per 64 ticks,
+    and so on, for *levels* levels. A timer goes in the slot of the lowest
+    level that reaches its deadline, so scheduling and cancelling are a set
+    add and discard; when a level comes round to a slot, the timers in it are
+    moved down a level, closer to when they're due. Nothing is ever sorted,
+    which is what makes it cheap with many timers that mostly get cancelled,
+    like cooldowns and timeouts. Timers further off than the wheel reaches
+    wait in a heap until they're within reach.
+
+    >>> wheel = TimingWheel(resolution=0.5, now=0)
+    >>> calls = []
+    >>> a = wheel.call_at(1.0, calls.append, "a")
+    >>> b = wheel.call_at(100.0, calls.append, "b")
+    >>> c = wheel.call_at(40.0, calls.append, "c")
+    >>> c.cancel()
+    >>> wheel.next_deadline(), wheel.timeout(now=0.25)
+    (1.0, 0.75)
+    >>> wheel.advance(now=50)
+    1
+    >>> wheel.next_deadline(), len(wheel)
+    (100.0, 1)
+    >>> wheel.advance(now=100), calls
+    (1, ['a', 'b'])
+    """
+
+    bits = 6
+
+    def __init__(self, resolution=0.01, levels=5, now=None):
+        self.resolution = resolution
+        self.levels = levels
+        self.mask = (1 << self.bits) - 1
+        self.wheels = [[set() for i in xrange(1 << self.bits)]
+                       for level in xrange(levels)]
+        self.counts = [0] * levels
+        #: Timers beyond the reach of the wheel, as (tick, seq, timer).
+        self.overflow = []
+        self.overflowed = 0
+        self._seq = count()
+        #: The next tick to run.
+        self.tick = int((time() if now is None else now) / resolution)
+        self._next = None
+
+    def __len__(self):
+        return sum(self.counts) + self.overflowed
+
+    def call_at(self, when, callback, *args):
+        """Call *callback* with *args* at *when* seconds since the epoch,
+        returning a `Timer`."""
+        timer = Timer(self, int(ceil(when / self.resolution)), callback, args)
+        self._insert(timer)
+        if self._next is not None and timer.tick < self._next:
+            self._next = timer.tick
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Call *callback* with *args* in *delay* seconds."""
+        return self.call_at(time() + delay, callback, *args)
+
+    def _insert(self, timer):
+        tick = max(timer.tick, self.tick)
+        delta = tick - self.tick
+        bits = self.bits
+        for level in xrange(self.levels):
+            if delta < 1 << (bits * (level + 1)):
+                break
+        else:
+            heappush(self.overflow, (timer.tick, next(self._seq), timer))
+            timer.level = -1
+            self.overflowed += 1
+            return
+        bucket = self.wheels[level][(tick >> (bits * level)) & self.mask]
+        bucket.add(timer)
+        timer.bucket = bucket
+        timer.level = level
+        self.counts[level] += 1
+
+    def _cascade(self, level, tick):
+        index = (tick >> (self.bits * level)) & self.mask
+        bucket = self.wheels[level][index]
+        self.wheels[level][index] = set()
+        self.counts[level] -= len(bucket)
+        for timer in bucket:
+            self._insert(timer)
+
+    def _overflow_head(self):
+        """The earliest timer in the overflow heap, or None."""
+        overflow = self.overflow
+        while overflow and overflow[0][2].cancelled:
+            heappop(overflow)
+        return overflow[0][2] if overflow else None
+
+    def _take_overflow(self):
+        # Those now within reach go in the wheel.
+        reach = 1 << (self.bits * self.levels)
+        head = self._overflow_head()
+        while head is not None and head.tick - self.tick < reach:
+            heappop(self.overflow)
+            self.overflowed -= 1
+            self._insert(head)
+            head = self._overflow_head()
+
+    def advance(self, now=None):
+        """Run the timers due by *now*, returning how many ran."""
+        # A hair over, so that a timer's own deadline survives rounding.
+        target = int((time() if now is None else now) / self.resolution +
+                     1e-6)
+        bits, mask, counts = self.bits, self.mask, self.counts
+        ran = 0
+        self._next = None
+        while self.tick <= target:
+            if self.overflow:
+                self._take_overflow()
+            tick = self.tick
+            for level in xrange(1, self.levels):
+                if tick & ((1 << (bits * level)) - 1):
+                    break
+                self._cascade(level, tick)
+            due = self.wheels[0][tick & mask]
+            self.wheels[0][tick & mask] = set()
+            counts[0] -= len(due)
+            # Timers scheduled by the callbacks go in from the next tick.
+            self.tick = tick + 1
+            due = list(due)
+            for timer in due:
+                timer.bucket = None
+            for i, timer in enumerate(due):
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except:
+                    # The rest are run on the next advance.
+                    self.tick = tick
+                    for rest in due[i + 1:]:
+                        if not rest.cancelled:
+                            self._insert(rest)
+                    raise
+                ran += 1
+            if not counts[0]:
+                # Nothing to run until the next level has a slot to cascade.
+                for level in xrange(1, self.levels):
+                    if counts[level]:
+                        span = 1 << (bits * level)
+                        self.tick = max(self.tick,
+                                        min(target + 1, tick // span * span +
+                                                        span))
+                        break
+                else:
+                    head = self._overflow_head()
+                    until = target + 1 if head is None else min(target + 1,
+                                                                head.tick)
+                    self.tick = max(self.tick, until)
+        return ran
+
+    def _find_next(self):
+        best = None
+        size = 1 << self.bits
+        for level in xrange(self.levels):
+            if not self.counts[level]:
+                continue
+            shift = self.bits * level
+            wheel, start = self.wheels[level], self.tick >> shift
+            # Unless a higher level is at the start of a slot, its current
+            # one has been cascaded already, and what's in it is a lap on.
+            if self.tick & ((1 << shift) - 1):
+                start += 1
+            for i in xrange(size):
+                bucket = wheel[(start + i) & self.mask]
+                if bucket:
+                    low = min(timer.tick for timer in bucket)
+                    best = low if best is None else min(best, low)
+                    break
+        head = self._overflow_head()
+        if head is not None and (best is None or head.tick < best):
+            best = head.tick
+        return best
+
+    def next_deadline(self):
+        """When the next timer is due, in seconds since the epoch, or None
+        if there are no timers."""
+        if self._next is None:
+            self._next = self._find_next()
+        if self._next is None:
+            return None
+        return self._next * self.resolution
+
+    def timeout(self, timeout=None, now=None):
+        """*timeout*, shortened to the time left until the next timer."""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return timeout
+        wait = max(0.0, deadline - (time() if now is None else now))
+        return wait if timeout is None else min(timeout, wait)
+
+class FingerprintError(ssl.SSLError): pass
+
+_tls_contexts = {}
+
+def default_tls_context(verify=True):
+    """A client `ssl.SSLContext`, made once per value of *verify* -- loading
+    the CA certificates is most of the cost of making one."""
+    context = _tls_contexts.get(verify)
+    if context is None:
+        if verify:
+            context = ssl.create_default_context()
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        _tls_contexts[verify] = context
+    return context
+
+def normalize_fingerprint(fingerprint):
+    """
+    >>> normalize_fingerprint("AB:cd:01")
+    'abcd01'
+    """
+    return fingerprint.replace(":", "").lower()
+
+class TLSHandshake(object):
+    """A non-blocking client TLS handshake over connected socket *sock*.
+
+    Call `step` whenever the socket is ready for what *want* says ("read" or
+    "write") until it returns True; the TLS socket is then in *sock*. `run`
+    does this by selecting, for when blocking is fine.
+
+    If a SHA-256 *fingerprint* is given, the server's certificate must match
+    it, and it isn't verified against the CAs; otherwise it must verify.
+
+    Sessions are not resumed: Python 2's ssl module has no way to get at
+    them (no `SSLSocket.session`), so every handshake is a full one. What
+    is saved is the cost of the context, which `default_tls_context` makes
+    only once.
+    """
+
+    def __init__(self, sock, server, context=None, fingerprint=None):
+        if context is None:
+            context = default_tls_context(verify=fingerprint is None)
+        self.fingerprint = fingerprint
+        sock.setblocking(0)
+        self.sock = context.wrap_socket(sock, server_hostname=server[0],
+                                        do_handshake_on_connect=False)
+        self.want = "write"
+
+    def step(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.want = "read"
+            return False
+        except ssl.SSLWantWriteError:
+            self.want = "write"
+            return False
+        self.want = None
+        if self.fingerprint is not None:
+            der = self.sock.getpeercert(binary_form=True)
+            actual = hashlib.sha256(der).hexdigest()
+            if actual != normalize_fingerprint(self.fingerprint):
+                self.sock.close()
+                raise FingerprintError("certificate fingerprint %s isn't "
+                                       "the pinned one" % (actual,))
+        return True
+
+    def run(self, timeout=None):
+        """Complete the handshake, returning the TLS socket."""
+        deadline = None if timeout is None else time() + timeout
+        while not self.step():
+            left = None if deadline is None else max(0.0, deadline - time())
+            want = [self.sock]
+            r, w, _ = select(want if self.want == "read" else [],
+                             want if self.want == "write" else [], [], left)
+            if not (r or w):
+                self.sock.close()
+                raise socket.timeout("TLS handshake timed out")
+        return self.sock
 
 class BaseSocketIO(BaseIO):
     address_family = socket.AF_UNSPEC
     socket_type = socket.SOCK_STREAM
+    #: Seconds between starting connection attempts to the next address.
+    connect_delay = 0.25
+    connect_timeout = None
+    #: Whether to speak TLS. See `TLSHandshake` for *tls_fingerprint*, and
+    #: set *tls_context* for anything else, such as client certificates.
+    tls = False
+    tls_fingerprint = None
+    tls_context = None
+    server = None
 
     def connect(self, address):
         host, port = address
+        self.server = (host, port)
         addresses = socket.getaddrinfo(host, port, self.address_family,
                                        self.socket_type, 0, 0)
-        # TODO Attempt next somehow?
-        for af, st, prot, cnam, addr in addresses:
-            self.make_socket(af, st, prot)
-            self.connect_socket(addr)
-            break
-        else:
+        if not addresses:
             raise ValueError("no address found for %r" % (address,))
+        return self.run_race(ConnectRace(addresses, self.connect_delay))
+
+    def run_race(self, race):
+        sock, addr = race.run(self.connect_timeout)
+        self.adopt_socket(sock)
         return addr
 
+    def start_tls(self, sock):
+        return TLSHandshake(sock, self.server or sock.getpeername()[:2],
+                            self.tls_context, self.tls_fingerprint)
+
+    def needs_tls(self, sock):
+        return self.tls and not isinstance(sock, ssl.SSLSocket)
+
 class BufferSegmentStringer(object):
     def __init__(self, name):
         self.name = name
@@ -39,6 +548,14 @@ class BufferSegmentStringer(object):
         self._get_target(instance)[:] = [value]
 
 class SimpleSocketIO(BaseSocketIO):
+    """Socket io with a select loop of its own.
+
+    The socket is non-blocking: `deliver` writes what the socket takes right
+    away and buffers the rest, which the run loop writes as the socket
+    becomes writable. A peer that doesn't read thus shows in
+    `buffered_bytes` rather than blocking the sender.
+    """
+
     def __init__(self):
         self.in_buffer_segs = []
         self.out_buffer_segs = []
@@ -46,23 +563,41 @@ class SimpleSocketIO(BaseSocketIO):
     in_buffer = BufferSegmentStringer("in_buffer_segs")
     out_buffer = BufferSegmentStringer("out_buffer_segs")
 
-    def make_socket(self, af, st, prot):
-        self.socket = socket.socket(af, st, prot)
-
-    def connect_socket(self, addr):
-        self.socket.connect(addr)
+    def adopt_socket(self, sock):
+        if self.needs_tls(sock):
+            sock = self.start_tls(sock).run(self.connect_timeout)
+        sock.setblocking(0)
+        self.socket = sock
 
     def deliver(self, data):
+        """Buffer *data*, and write as much of the buffer as can be without
+        blocking. Returns what's left."""
         self.out_buffer_segs.append(data)
-        send_data = self.out_buffer
-        n_bytes = self.socket.send(send_data)
-        if not n_bytes:
-            raise IOError("short write to endpoint")
-        # Useless as send_data will always equivate to "" after the loop is
-        # done. But it makes the code less "intra-reliant".
-        remains = send_data[n_bytes:]
-        self.out_buffer = remains
-        return remains
+        self.send_buffered()
+        return self.out_buffer
+
+    def send_buffered(self):
+        """Write buffered output until the socket would block, returning
+        how many bytes were written."""
+        sent = 0
+        while self.out_buffer_segs:
+            remains = self.out_buffer
+            try:
+                n_bytes = self.socket.send(remains)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                break
+            except socket.error, e:
+                if e.errno not in _would_block:
+                    raise
+                break
+            if not n_bytes:
+                raise IOError("short write to endpoint")
+            sent += n_bytes
+            if n_bytes < len(remains):
+                self.out_buffer = remains[n_bytes:]
+            else:
+                del self.out_buffer_segs[:]
+        return sent
 
     def receive(self, target):
         """Read IRC data from socket into *target*.
@@ -70,52 +605,102 @@ class SimpleSocketIO(BaseSocketIO):
         This will not always result in a command being processed; an incomplete
         line could be received and thus be buffered and run when completed.
 
-        Calling this can block if the underlying socket's `recv` doesn't return
-        immediately, as would be the case if no data is ready.
+        Calling this blocks until there is data to read, if there is none.
 
         This will not decode any incoming data, as the IRC RFC defines byte
         values for protocol parsing.
         """
-        data = self.socket.recv(1 << 12)
+        while not self.read_into(target):
+            _select([self.socket], [], [])
+
+    def read_into(self, target):
+        """Read what there is into *target*, returning False if there was
+        nothing."""
+        try:
+            data = self.socket.recv(1 << 12)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return False
+        except socket.error, e:
+            if e.errno not in _would_block:
+                raise
+            return False
         if not data:
             raise IOError("short read from endpoint")
+        self.readable_at = time()
         self.in_buffer_segs.append(data)
+        # TLS may have decrypted more than was asked for, and select won't
+        # say so.
+        pending = getattr(self.socket, "pending", None)
+        while pending and pending():
+            self.in_buffer_segs.append(self.socket.recv(pending()))
         self.in_buffer = target(self.in_buffer)
+        return True
+
+    def write_buffered(self):
+        """Write what's left of earlier deliveries, as far as the socket
+        takes it."""
+        if self.out_buffer_segs:
+            self.send_buffered()
+            self.written()
+
+    def poll(self, consumer, timeout=None):
+        """Wait at most *timeout* seconds, or until the next timer, for the
+        socket to be readable, writing buffered output meanwhile if it's
+        writable. Returns whether anything was read."""
+        wlist = [self.socket] if self.out_buffer_segs else []
+        r, w, _ = _select([self.socket], wlist, [],
+                          self.timer_timeout(timeout))
+        if w:
+            self.write_buffered()
+        # Not from within a send, so that timers may send.
+        self.run_timers()
+        return bool(r) and self.read_into(consumer)
 
     def run(self, consumer):
         while True:
-            while self.out_buffer:
-                self.deliver(self.out_buffer)
-            self.receive(consumer)
+            self.poll(consumer)
 
-from select import select
+    def buffered_bytes(self):
+        return sum(len(seg) for seg in self.out_buffer_segs)
 
-class SelectIO(SimpleSocketIO):
-    def deliver(self, data):
-        self.interact(out=data)
+    def buffered_output(self):
+        return "".join(self.out_buffer_segs)
+
+    def discard_output(self):
+        del self.out_buffer_segs[:]
 
+    def drain_output(self, below=0, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        while self.buffered_bytes() > below:
+            left = None if deadline is None else max(0.0, deadline - time())
+            _, w, _ = select([], [self.socket], [], left)
+            if not w:
+                return False
+            self.send_buffered()
+        return True
+
+class SelectIO(SimpleSocketIO):
     def receive(self, consumer):
-        self.interact(consumer=consumer)
+        while not self.interact(consumer=consumer):
+            pass
 
     def interact(self, out=None, consumer=None, timeout=None):
-        mkr = lambda: [self.socket] if consumer else []
-        mkw = lambda: [self.socket] if out else []
-        mkx = lambda: []
-        mka = lambda: (mkr(), mkw(), mkx())
-        r, w, x = mka()
-        while any((r, w, x)):
-            sets = mka()
-            if not any(sets):
-                break
-            r, w, x = select(*(sets + (timeout,)))
-            if r:
-                super(SelectIO, self).receive(consumer)
+        """Buffer *out*, then select once, for at most *timeout* seconds, to
+        read into *consumer* and write what's buffered. Returns whether
+        anything was read."""
+        if out:
+            self.out_buffer_segs.append(out)
+        if consumer is not None:
+            return self.poll(consumer, timeout)
+        if self.out_buffer_segs:
+            _, w, _ = select([], [self.socket], [], timeout)
             if w:
-                out = super(SelectIO, self).deliver(out)
+                self.write_buffered()
+        return False
 
     def run(self, consumer):
         while True:
-            self.interact(out=self.out_buffer, consumer=consumer)
+            self.interact(consumer=consumer)
 
 import asyncore
 import asynchat
@@ -123,32 +708,134 @@ import asynchat
 class AsyncoreIO(BaseSocketIO, asynchat.async_chat):
     address_family = socket.AF_UNSPEC
     socket_type = socket.SOCK_STREAM
+    race = None
+    race_attempts = ()
+    out_bytes = 0
+    handshake = None
 
     def __init__(self, *args, **kwds):
         self.consumer = kwds.pop("consumer", None)
-        asynchat.async_chat.__init__(self, conn=kwds.pop("conn", None))
-        self.set_terminator("\n")
-        super(AsyncoreIO, self).__init__(*args, **kwds)
-        self.in_buffer = []
+        asynchat.async_chat.__init__(self, kwds.pop("conn", None))
+        # Line splitting is the protocol's business, so take chunks as-is.
+        self.set_terminator(None)
 
     def collect_incoming_data(self, data):
-        self.in_buffer.append(data)
-
-    def found_terminator(self):
-        self.in_buffer = [self.consumer("".join(self.in_buffer))]
-
-    def make_socket(self, af, st, prot):
-        # NOTE Can't use create_socket because I want my prot set.
-        self.socket = socket.socket(af, st, prot)
-        self.socket.setblocking(0)
-        self.set_socket(self.socket)
+        self.consumer(data)
+
+    def run_race(self, race):
+        """Start *race*, leaving it to the asyncore loop to finish."""
+        self.race = race
+        self.race_attempts = []
+        self.start_attempts()
+        return race
+
+    def start_attempts(self):
+        race = self.race
+        for sock in race.start_due():
+            self.race_attempts.append(_RaceAttempt(self, sock))
+        if race.winner:
+            self.adopt_socket(race.winner[0])
+
+    def adopt_socket(self, sock):
+        for attempt in self.race_attempts:
+            attempt.del_channel()
+        self.race, self.race_attempts = None, []
+        if self.needs_tls(sock):
+            self.handshake = self.start_tls(sock)
+            self.set_socket(self.handshake.sock)
+            self.step_handshake()
+            return
+        self.set_socket(sock)
+        self.handle_connect_event()
+
+    def step_handshake(self):
+        if self.handshake.step():
+            self.handshake = None
+            self.handle_connect_event()
+
+    def readable(self):
+        if self.handshake is not None:
+            return self.handshake.want == "read"
+        return asynchat.async_chat.readable(self)
+
+    def writable(self):
+        if self.handshake is not None:
+            return self.handshake.want == "write"
+        return asynchat.async_chat.writable(self)
+
+    def handle_read_event(self):
+        if self.handshake is not None:
+            self.step_handshake()
+        else:
+            asynchat.async_chat.handle_read_event(self)
 
-    def connect_socket(self, address):
-        asynchat.async_chat.connect(self, address)
+    def handle_write_event(self):
+        if self.handshake is not None:
+            self.step_handshake()
+        else:
+            asynchat.async_chat.handle_write_event(self)
+            self.written()
+
+    def recv(self, buffer_size):
+        try:
+            data = asynchat.async_chat.recv(self, buffer_size)
+        except ssl.SSLWantReadError:
+            return ""
+        if data:
+            self.readable_at = time()
+        pending = getattr(self.socket, "pending", None)
+        while data and pending and pending():
+            data += self.socket.recv(pending())
+        return data
+
+    def handle_connect(self):
+        pass
+
+    def initiate_send(self):
+        # Output is held until a connection attempt has won.
+        if self.connected:
+            asynchat.async_chat.initiate_send(self)
 
     def deliver(self, data):
         self.push(data)
 
+    def push(self, data):
+        self.out_bytes += len(data)
+        asynchat.async_chat.push(self, data)
+
+    def send(self, data):
+        try:
+            n_bytes = asynchat.async_chat.send(self, data)
+        except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            return 0
+        self.out_bytes -= n_bytes
+        return n_bytes
+
+    def buffered_bytes(self):
+        return self.out_bytes
+
+    def buffered_output(self):
+        # Strings, as deliver pushes nothing else, but for close_when_done's
+        # None.
+        return "".join(data for data in self.producer_fifo if data)
+
+    def discard_output(self):
+        self.producer_fifo.clear()
+        self.out_bytes = 0
+
+    def drain_output(self, below=0, timeout=None):
+        # Only writes, so that no handlers run from within a send.
+        deadline = None if timeout is None else time() + timeout
+        while self.out_bytes > below:
+            if not self.connected:
+                return False
+            left = None if deadline is None else max(0.0, deadline - time())
+            _, w, _ = select([], [self.socket], [], left)
+            if not w:
+                return False
+            self.initiate_send()
+        return True
+
     def receive(self, target):
         # This is sort of shady. :-) Switcheroo anyway.
         prev, self.consumer = self.consumer, target
@@ -159,8 +846,55 @@ class AsyncoreIO(BaseSocketIO, asynchat.async_chat):
         self.consumer = consumer
         self.run_once()
 
-    def run_once(self, **kwds):
-        asyncore.loop(**kwds)
+    def run_once(self, timeout=None, count=None, **kwds):
+        if timeout is None:
+            pending = self.race is not None and self.race.pending
+            timeout = self.race.delay if pending else 30.0
+        if self.timers is None:
+            asyncore.loop(timeout=timeout, count=count, **kwds)
+            return
+        # One poll at a time, so that timers run in between.
+        while asyncore.socket_map and (count is None or count > 0):
+            asyncore.loop(timeout=self.timer_timeout(timeout), count=1, **kwds)
+            self.run_timers()
+            if count is not None:
+                count -= 1
 
     def handle_error(self):
         raise
+
+class _RaceAttempt(asyncore.dispatcher):
+    """A `ConnectRace` attempt in the asyncore map."""
+
+    def __init__(self, io, sock):
+        asyncore.dispatcher.__init__(self)
+        self.io = io
+        # Not set_socket, as the dispatcher mustn't think it's connected.
+        self.socket = sock
+        self._fileno = sock.fileno()
+        self.add_channel()
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        # Called on every loop iteration, which makes it the place to start
+        # attempts that have become due.
+        if self.io.race is not None:
+            self.io.start_attempts()
+        return True
+
+    def handle_write_event(self):
+        race = self.io.race
+        if race is None:
+            return
+        self.del_channel()
+        if race.check(self.socket):
+            self.io.adopt_socket(self.socket)
+            return
+        self.io.start_attempts()
+        if race.done and not race.winner:
+            self.io.race = None
+            raise race.errors[-1][1]
+
+    handle_expt_event = handle_write_event
@@ -0,0 +1,129 @@
+r"""ISUPPORT (numeric 005) handling.
+
+Servers advertise their limits and features as a list of tokens in one or
+more 005 replies after registration. Several mixins need these, so they're
+kept in one place, on `self.isupport`.
+
+>>> tokens = ["NICKLEN=30", "SAFELIST", "-WALLCHOPS", "NETWORK=Foo\\x20Net"]
+>>> sorted(parse_isupport(tokens).items())
+[('NETWORK', 'Foo Net'), ('NICKLEN', '30'), ('SAFELIST', ''), ('WALLCHOPS', None)]
+"""
+
+import re
+from irken.dispatch import DispatchRegistering, handler
+
+_escape_re = re.compile(r"\\x([0-9a-fA-F]{2})")
+
+def unescape_value(value):
+    return _escape_re.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+def parse_isupport(tokens):
+    """Parse ISUPPORT *tokens* into a dict.
+
+    Tokens without a value map to the empty string, and negated tokens map to
+    None, meaning the feature should be forgotten.
+    """
+    rv = {}
+    for token in tokens:
+        if token.startswith("-"):
+            rv[token[1:].upper()] = None
+        elif "=" in token:
+            key, value = token.split("=", 1)
+            rv[key.upper()] = unescape_value(value)
+        else:
+            rv[token.upper()] = ""
+    return rv
+
+def parse_targmax(value):
+    """Parse a TARGMAX value into a mapping of command to the max number of
+    targets, where None means unlimited.
+
+    >>> sorted(parse_targmax("PRIVMSG:4,NOTICE:3,WHOIS:1,JOIN:").items())
+    [('JOIN', None), ('NOTICE', 3), ('PRIVMSG', 4), ('WHOIS', 1)]
+    """
+    rv = {}
+    for part in value.split(","):
+        if not part:
+            continue
+        command, _, limit = part.partition(":")
+        rv[command.upper()] = int(limit) if limit else None
+    return rv
+
+def parse_prefix(value):
+    """Parse a PREFIX value into `(mode, symbol)` pairs, highest rank first.
+
+    >>> parse_prefix("(qov)~@+")
+    [('q', '~'), ('o', '@'), ('v', '+')]
+    >>> parse_prefix("")
+    []
+    """
+    if not value.startswith("(") or ")" not in value:
+        return []
+    modes, symbols = value[1:].split(")", 1)
+    return zip(modes, symbols)
+
+#: What PREFIX is taken to be when the server doesn't say.
+default_prefix = "(ov)@+"
+
+class ISupportMixin(DispatchRegistering):
+    """Keeps the server's ISUPPORT tokens in *isupport*."""
+
+    def __init__(self, *args, **kwds):
+        super(ISupportMixin, self).__init__(*args, **kwds)
+        self.isupport = {}
+
+    @handler("irc num 005")
+    def update_isupport(self, cmd, *args):
+        # First is our nick, last is "are supported by this server".
+        for key, value in parse_isupport(args[1:-1]).iteritems():
+            if value is None:
+                self.isupport.pop(key, None)
+            else:
+                self.isupport[key] = value
+
+    def max_targets(self, command):
+        """The number of targets *command* may be given at once, or None if
+        unlimited.
+
+        Defaults to one, because it's never wrong.
+
+        >>> from irken.tests import TestConnection
+        >>> class Conn(ISupportMixin, TestConnection): pass
+        >>> conn = Conn("self")
+        >>> conn.max_targets("PRIVMSG")
+        1
+        >>> conn.isupport["MAXTARGETS"] = "20"
+        >>> conn.max_targets("PRIVMSG")
+        20
+        >>> conn.isupport["TARGMAX"] = "PRIVMSG:4,NOTICE:"
+        >>> conn.max_targets("PRIVMSG"), conn.max_targets("NOTICE")
+        (4, None)
+        >>> conn.max_targets("KICK")
+        1
+        """
+        command = command.upper()
+        if "TARGMAX" in self.isupport:
+            return parse_targmax(self.isupport["TARGMAX"]).get(command, 1)
+        elif "MAXTARGETS" in self.isupport:
+            if command in ("PRIVMSG", "NOTICE"):
+                return int(self.isupport["MAXTARGETS"] or 1)
+        return 1
+
+    def prefix_symbols(self):
+        """The channel membership prefix symbols, such as "@+".
+
+        >>> from irken.tests import TestConnection
+        >>> class Conn(ISupportMixin, TestConnection): pass
+        >>> conn = Conn("self")
+        >>> conn.prefix_symbols()
+        '@+'
+        >>> conn.isupport["PREFIX"] = "(qaohv)~&@%+"
+        >>> conn.prefix_symbols()
+        '~&@%+'
+        """
+        value = self.isupport.get("PREFIX", default_prefix)
+        return "".join(symbol for mode, symbol in parse_prefix(value))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
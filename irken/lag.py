@@ -0,0 +1,193 @@
+"""Lag measurement.
+
+Two numbers are tracked per connection: the round-trip time of PINGs we send
+ourselves, and the time it takes from the socket becoming readable until the
+data read has been dispatched. The former tells you how slow the server (or
+the route to it) is, the latter how slow your own handlers are.
+"""
+
+import logging
+from math import ceil
+from time import time
+from collections import deque
+from irken import IRCError
+from irken.dispatch import DispatchRegistering, handler
+
+logger = logging.getLogger("irken.lag")
+
+class LagError(IRCError): pass
+
+def percentile(samples, p):
+    """Nearest-rank percentile *p* (0-100) of *samples*.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 100)
+    4
+    >>> percentile([3, 1, 2], 0)
+    1
+    >>> percentile([], 50) is None
+    True
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(ceil(p / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+class LagStats(object):
+    """Moving average and percentiles over a bounded window of samples.
+
+    The average is exponentially weighted so that it reacts to trends, the
+    percentiles are exact over the last *size* samples.
+
+    >>> s = LagStats(size=4, weight=0.5)
+    >>> for v in (1.0, 3.0, 3.0, 5.0, 7.0): s.add(v)
+    >>> s.last, s.average, s.count
+    (7.0, 5.375, 5)
+    >>> s.percentile(50), s.percentile(100)
+    (3.0, 7.0)
+    """
+
+    def __init__(self, size=64, weight=0.125):
+        self.samples = deque(maxlen=size)
+        self.weight = weight
+        self.average = self.last = None
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.last = value
+        self.count += 1
+        if self.average is None:
+            self.average = value
+        else:
+            self.average += self.weight * (value - self.average)
+
+    def percentile(self, p):
+        return percentile(self.samples, p)
+
+    def as_dict(self):
+        return {"last": self.last, "average": self.average,
+                "count": self.count, "p50": self.percentile(50),
+                "p90": self.percentile(90), "p99": self.percentile(99)}
+
+class LagMixin(DispatchRegistering):
+    """Measures lag by sending our own timestamped PINGs.
+
+    PINGs are sent every *lag_interval* seconds once registration is done,
+    from a timer, and the lag is checked whenever data is consumed too.
+
+    If *lag_threshold* is set and the lag goes above it, "lag exceeded" is
+    dispatched, and if *lag_reconnect* is true, `LagError` is raised out of the
+    run loop so that whoever runs the connection can reconnect. Either happens
+    once each time the lag goes over, not for as long as it stays there.
+    Connecting again starts the measurements over.
+    """
+
+    lag_interval = 60.0
+    lag_threshold = None
+    lag_reconnect = False
+    lag_token_prefix = "irken-lag-"
+
+    def __init__(self, *args, **kwds):
+        super(LagMixin, self).__init__(*args, **kwds)
+        self._lag_timer = None
+        self.reset_lag()
+
+    def reset_lag(self):
+        """Forget the PINGs and samples of the previous connection."""
+        if self._lag_timer is not None:
+            self._lag_timer.cancel()
+            self._lag_timer = None
+        self.rtt = LagStats()
+        self.dispatch_lag = LagStats()
+        self._lag_pings = {}
+        self._next_lag_ping = None
+        self._lag_exceeded = False
+
+    def connect(self, *args, **kwds):
+        self.reset_lag()
+        return super(LagMixin, self).connect(*args, **kwds)
+
+    def send_lag_ping(self, now=None):
+        now = time() if now is None else now
+        token = self.lag_token_prefix + "%.6f" % (now,)
+        self._lag_pings[token] = now
+        self._next_lag_ping = now + self.lag_interval
+        self.send_cmd(None, "PING", (token,))
+        return token
+
+    @property
+    def lag(self):
+        """Current lag estimate: the last RTT, or the age of the oldest
+        unanswered PING if that is worse."""
+        lag = self.rtt.last
+        if self._lag_pings:
+            pending = time() - min(self._lag_pings.itervalues())
+            if lag is None or pending > lag:
+                lag = pending
+        return lag
+
+    def lag_metrics(self):
+        return {"lag": self.lag, "rtt": self.rtt.as_dict(),
+                "dispatch": self.dispatch_lag.as_dict(),
+                "pending_pings": len(self._lag_pings)}
+
+    def check_lag(self, now=None):
+        now = time() if now is None else now
+        if self._next_lag_ping is not None and now >= self._next_lag_ping:
+            self.send_lag_ping(now)
+        lag = self.lag
+        exceeded = self.lag_threshold is not None and lag > self.lag_threshold
+        if exceeded and not self._lag_exceeded:
+            self._lag_exceeded = True
+            logger.warning("lag %.3fs exceeds %.3fs", lag, self.lag_threshold)
+            self.dispatch("lag exceeded", lag)
+            if self.lag_reconnect:
+                raise LagError("lag %.3fs exceeds threshold" % (lag,))
+        elif not exceeded:
+            self._lag_exceeded = False
+
+    def consume(self, data):
+        start = self.io.readable_at or time()
+        # Stamped anew with each read, and not to be used for data that
+        # didn't come from one.
+        self.io.readable_at = None
+        rv = super(LagMixin, self).consume(data)
+        now = time()
+        self.dispatch_lag.add(now - start)
+        self.check_lag(now)
+        return rv
+
+    def lag_timer(self):
+        self.check_lag()
+        self.schedule_lag_timer()
+
+    def schedule_lag_timer(self):
+        if self._lag_timer is not None:
+            self._lag_timer.cancel()
+        if self._next_lag_ping is not None:
+            self._lag_timer = self.timers.call_at(self._next_lag_ping,
+                                                  self.lag_timer)
+
+    @handler("irc num 001")
+    def start_lag_pings(self, cmd, *args):
+        self._next_lag_ping = time()
+        self.schedule_lag_timer()
+
+    @handler("irc cmd pong")
+    def note_lag_pong(self, cmd, *args):
+        if not args:
+            return
+        sent = self._lag_pings.pop(args[-1], None)
+        if sent is not None:
+            self.rtt.add(time() - sent)
+            # Anything older that wasn't answered won't ever be.
+            for token, ts in self._lag_pings.items():
+                if ts < sent:
+                    del self._lag_pings[token]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
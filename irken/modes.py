@@ -0,0 +1,208 @@
+r"""Channel modes: parsing MODE lines and sending changes in bulk.
+
+Which modes take a parameter is up to the server, which says so with the
+CHANMODES and PREFIX ISUPPORT tokens. `ModeTable` is built from those, and
+parses mode strings into `ModeChange` tuples:
+
+>>> table = ModeTable("beI,k,l,imnpst", "(ov)@+")
+>>> for change in table.parse("+ob-lk+m", ["alice", "*!*@spam", "key"]):
+...     print change
+ModeChange(adding=True, mode='o', param='alice')
+ModeChange(adding=True, mode='b', param='*!*@spam')
+ModeChange(adding=False, mode='l', param=None)
+ModeChange(adding=False, mode='k', param='key')
+ModeChange(adding=True, mode='m', param=None)
+
+`ModeMixin` keeps a table for the connection, dispatches "channel modes" with
+the changes of each channel MODE received, and sends changes packed as many
+to a line as ISUPPORT MODES allows:
+
+>>> from irken.tests import TestConnection
+>>> class Conn(ModeMixin, TestConnection): pass
+>>> conn = Conn("bot")
+>>> conn.set_modes("#chan", [ModeChange(False, "b", mask)
+...                          for mask in ("a!*@*", "b!*@*", "c!*@*", "d!*@*")])
+2
+>>> conn.io.sent_lines
+['MODE #chan -bbb a!*@* b!*@* c!*@*\r\nMODE #chan -b d!*@*\r\n']
+"""
+
+from collections import namedtuple
+from irken.dispatch import handler
+from irken.isupport import ISupportMixin, parse_prefix, default_prefix
+from irken.parser import max_line_length
+
+ModeChange = namedtuple("ModeChange", "adding mode param")
+
+#: What CHANMODES is taken to be when the server doesn't say, as in RFC 2811.
+default_chanmodes = "beI,k,l,imnpst"
+#: How many modes with parameters one MODE may have if the server doesn't say.
+default_modes = 3
+
+class ModeTable(object):
+    """Which channel modes take parameters, from the values of CHANMODES and
+    PREFIX.
+
+    CHANMODES has four groups of modes: list modes (A), modes that always
+    take a parameter (B), modes that take one only when set (C), and modes
+    that never do (D). Membership modes from PREFIX always take one. Modes
+    in neither are taken to have no parameter.
+    """
+
+    def __init__(self, chanmodes=default_chanmodes, prefix=default_prefix):
+        self.kinds = {}
+        groups = (chanmodes.split(",") + ["", "", ""])[:4]
+        for kind, modes in zip("ABCD", groups):
+            for mode in modes:
+                self.kinds[mode] = kind
+        self.prefix_modes = dict(parse_prefix(prefix))
+        for mode in self.prefix_modes:
+            self.kinds[mode] = "P"
+
+    def takes_param(self, mode, adding):
+        kind = self.kinds.get(mode, "D")
+        return kind in "ABP" or (kind == "C" and adding)
+
+    def is_list_mode(self, mode):
+        return self.kinds.get(mode) == "A"
+
+    def parse(self, modes, params):
+        """Parse mode string *modes* with its *params* into a list of
+        `ModeChange`. A parameter that's missing, as in a ban list query,
+        is None."""
+        changes = []
+        params = iter(params)
+        adding = True
+        for mode in modes:
+            if mode == "+":
+                adding = True
+            elif mode == "-":
+                adding = False
+            else:
+                param = None
+                if self.takes_param(mode, adding):
+                    param = next(params, None)
+                changes.append(ModeChange(adding, mode, param))
+        return changes
+
+def format_modes(changes):
+    """The mode string and parameters of *changes*, the inverse of
+    `ModeTable.parse`.
+
+    >>> format_modes([(True, "o", "a"), (True, "v", "a"), (False, "m", None)])
+    ('+ov-m', ['a', 'a'])
+    """
+    modes = []
+    params = []
+    adding = None
+    for change_adding, mode, param in changes:
+        if change_adding != adding:
+            adding = change_adding
+            modes.append("+" if adding else "-")
+        modes.append(mode)
+        if param is not None:
+            params.append(param)
+    return "".join(modes), params
+
+class ModeMixin(ISupportMixin):
+    """Parses channel MODEs into "channel modes" events, and packs outgoing
+    changes into as few MODE lines as ISUPPORT allows.
+
+    Changes can be sent right away with `set_modes`, or queued with
+    `queue_mode`, in which case those queued by the time the timer set for
+    *mode_flush_delay* seconds runs are sent together.
+    """
+
+    mode_flush_delay = 0.0
+
+    def __init__(self, *args, **kwds):
+        super(ModeMixin, self).__init__(*args, **kwds)
+        self._mode_table = None
+        self._mode_queue = {}
+        self._mode_flush = None
+
+    def mode_table(self):
+        """The `ModeTable` for what the server says; made again only when
+        that changes."""
+        key = (self.isupport.get("CHANMODES", default_chanmodes),
+               self.isupport.get("PREFIX", default_prefix))
+        if self._mode_table is None or self._mode_table[0] != key:
+            self._mode_table = (key, ModeTable(*key))
+        return self._mode_table[1]
+
+    def is_channel(self, name):
+        return name[:1] in self.isupport.get("CHANTYPES", "#&")
+
+    def max_modes(self):
+        """How many parameterized modes one MODE line may change, or None
+        if there is no limit."""
+        if "MODES" not in self.isupport:
+            return default_modes
+        value = self.isupport["MODES"]
+        return int(value) if value.isdigit() else None
+
+    @handler("irc cmd mode")
+    def parse_channel_modes(self, cmd, target=None, modes="", *params):
+        if target and self.is_channel(target):
+            changes = self.mode_table().parse(modes, params)
+            self.dispatch("channel modes", cmd.source, target, changes)
+
+    # Sending
+
+    def _mode_budget(self, channel):
+        # Leave room for the prefix the server relays the line with.
+        text_budget = getattr(self, "text_budget", None)
+        if text_budget is not None:
+            return text_budget("MODE", channel)
+        return max_line_length - len("MODE  :\r\n") - len(channel)
+
+    def pack_modes(self, channel, changes):
+        """Split *changes* into lists that each fit in one MODE line."""
+        limit = self.max_modes()
+        budget = self._mode_budget(channel)
+        lines = []
+        line, length, count = [], 0, 0
+        for change in changes:
+            cost = 2 + (len(change[2]) + 1 if change[2] is not None else 0)
+            if line and ((limit is not None and count >= limit and
+                          change[2] is not None) or length + cost > budget):
+                lines.append(line)
+                line, length, count = [], 0, 0
+            line.append(change)
+            length += cost
+            count += change[2] is not None
+        if line:
+            lines.append(line)
+        return lines
+
+    def set_modes(self, channel, changes):
+        """Send *changes* to *channel* in as few lines as allowed, returning
+        how many it took."""
+        lines = self.pack_modes(channel, changes)
+        with self.batch():
+            for line in lines:
+                modes, params = format_modes(line)
+                self.send_cmd(None, "MODE", [channel, modes] + params)
+        return len(lines)
+
+    def queue_mode(self, channel, adding, mode, param=None):
+        """Queue a change to be sent with the others queued soon after."""
+        self._mode_queue.setdefault(channel, []).append(
+            ModeChange(adding, mode, param))
+        if self._mode_flush is None:
+            self._mode_flush = self.call_later(self.mode_flush_delay,
+                                               self.flush_modes)
+
+    def flush_modes(self):
+        """Send the queued changes now."""
+        if self._mode_flush is not None:
+            self._mode_flush.cancel()
+            self._mode_flush = None
+        queue, self._mode_queue = self._mode_queue, {}
+        with self.batch():
+            for channel, changes in queue.iteritems():
+                self.set_modes(channel, changes)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,230 @@
+r"""Append-only message log with a per-target index.
+
+Lines are appended, timestamped, to segment files in a directory, and each
+target (channel or nick) gets an index of where in which segment its lines
+are, and when they were received. Scrollback queries then read only the
+lines they need, straight from mmapped segments.
+
+Writes are batched: nothing hits the disk until *flush_bytes* are pending or
+`flush` is called (queries flush first, so they always see everything).
+When the active segment reaches *segment_size* bytes a new one is started,
+and when all segments together exceed *max_size*, the oldest are dropped.
+
+>>> import tempfile, shutil
+>>> d = tempfile.mkdtemp()
+>>> log = MessageLog(d)
+>>> for i in range(5):
+...     log.append("#chan", ":a!b@c PRIVMSG #chan :line %d" % i, when=100 + i)
+>>> log.append("nick", ":nick!b@c NICK other", when=104.5)
+>>> log.tail("#chan", 2)
+[(103.0, ':a!b@c PRIVMSG #chan :line 3'), (104.0, ':a!b@c PRIVMSG #chan :line 4')]
+>>> [line[-6:] for when, line in log.between("#CHAN", 101, 102.5)]
+['line 1', 'line 2']
+>>> log.close()
+>>> MessageLog(d).tail("nick", 10)
+[(104.5, ':nick!b@c NICK other')]
+>>> shutil.rmtree(d)
+"""
+
+import os
+import mmap
+import logging
+from time import time
+from array import array
+from bisect import bisect_left, bisect_right
+from irken.nicks import nickname
+
+logger = logging.getLogger("irken.msglog")
+
+#: Commands whose first argument is the target they're logged under.
+targeted_commands = frozenset(("PRIVMSG", "NOTICE", "JOIN", "PART", "KICK",
+                               "TOPIC", "MODE", "TAGMSG"))
+
+class _SegmentIndex(object):
+    """Per-target arrays of timestamps and offsets into one segment."""
+
+    def __init__(self):
+        self.targets = {}
+
+    def add(self, target, when, offset):
+        entry = self.targets.get(target)
+        if entry is None:
+            entry = self.targets[target] = (array("d"), array("L"))
+        entry[0].append(when)
+        entry[1].append(offset)
+
+class MessageLog(object):
+    segment_suffix = ".log"
+
+    def __init__(self, directory, segment_size=1 << 26, max_size=1 << 30,
+                 flush_bytes=1 << 16):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.flush_bytes = flush_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = []
+        self.indices = {}
+        self.sizes = {}
+        for fn in sorted(os.listdir(directory)):
+            if fn.endswith(self.segment_suffix):
+                seg = int(fn[:-len(self.segment_suffix)])
+                self.segments.append(seg)
+                self.indices[seg] = self._scan(seg)
+        if not self.segments:
+            self.segments.append(0)
+            self.indices[0] = _SegmentIndex()
+        self._open_active()
+        self._pending = []
+        self._pending_bytes = 0
+
+    def _path(self, seg):
+        return os.path.join(self.directory, "%08d%s" % (seg,
+                                                        self.segment_suffix))
+
+    def _open_active(self):
+        seg = self.segments[-1]
+        self.active = open(self._path(seg), "ab")
+        self.active.seek(0, os.SEEK_END)
+        size = self.sizes.setdefault(seg, self.active.tell())
+        if self.active.tell() > size:
+            # Cut off whatever torn write the scan stopped at.
+            self.active.truncate(size)
+
+    def _scan(self, seg):
+        """Rebuild a segment's index from its records."""
+        index = _SegmentIndex()
+        offset = 0
+        size = 0
+        with open(self._path(seg), "rb") as fp:
+            for record in fp:
+                if not record.endswith("\n"):
+                    # A torn write; the rest of the segment is garbage.
+                    break
+                when, target, _ = record.split(" ", 2)
+                index.add(target, float(when), offset)
+                offset += len(record)
+                size = offset
+        self.sizes[seg] = size
+        return index
+
+    def append(self, target, line, when=None):
+        """Log *line* under *target* at time *when*."""
+        when = time() if when is None else when
+        target = target.lower()
+        stamp = "%.3f" % (when,)
+        record = "%s %s %s\n" % (stamp, target, line)
+        seg = self.segments[-1]
+        # Indexed as it's written, so that it's the same after a rescan.
+        self.indices[seg].add(target, float(stamp), self.sizes[seg])
+        self.sizes[seg] += len(record)
+        self._pending.append(record)
+        self._pending_bytes += len(record)
+        if self._pending_bytes >= self.flush_bytes:
+            self.flush()
+        if self.sizes[seg] >= self.segment_size:
+            self.rotate()
+
+    def flush(self):
+        if self._pending:
+            self.active.write("".join(self._pending))
+            self.active.flush()
+            del self._pending[:]
+            self._pending_bytes = 0
+
+    def rotate(self):
+        """Start a new segment, and compact if there's too much."""
+        self.flush()
+        self.active.close()
+        seg = self.segments[-1] + 1
+        self.segments.append(seg)
+        self.indices[seg] = _SegmentIndex()
+        self._open_active()
+        self.compact()
+
+    def compact(self):
+        """Drop the oldest segments until all fit in *max_size*."""
+        while (len(self.segments) > 1 and
+               sum(self.sizes.itervalues()) > self.max_size):
+            seg = self.segments.pop(0)
+            del self.indices[seg], self.sizes[seg]
+            os.unlink(self._path(seg))
+            logger.info("dropped message log segment %d", seg)
+
+    def close(self):
+        self.flush()
+        self.active.close()
+
+    def _read(self, seg, offsets):
+        with open(self._path(seg), "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                rv = []
+                for offset in offsets:
+                    end = mm.find("\n", offset)
+                    when, _, line = mm[offset:end].split(" ", 2)
+                    rv.append((float(when), line))
+                return rv
+            finally:
+                mm.close()
+
+    def tail(self, target, n):
+        """The last *n* `(time, line)` pairs logged under *target*."""
+        self.flush()
+        target = target.lower()
+        rv = []
+        for seg in reversed(self.segments):
+            entry = self.indices[seg].targets.get(target)
+            if entry is None:
+                continue
+            offsets = entry[1][max(0, len(entry[1]) - (n - len(rv))):]
+            rv[:0] = self._read(seg, offsets)
+            if len(rv) >= n:
+                break
+        return rv
+
+    def between(self, target, start, end):
+        """The `(time, line)` pairs logged under *target* from *start* up to
+        and including *end*."""
+        self.flush()
+        target = target.lower()
+        rv = []
+        for seg in self.segments:
+            entry = self.indices[seg].targets.get(target)
+            if entry is None:
+                continue
+            times, offsets = entry
+            lo, hi = bisect_left(times, start), bisect_right(times, end)
+            if lo < hi:
+                rv.extend(self._read(seg, offsets[lo:hi]))
+        return rv
+
+class MessageLogMixin(object):
+    """Logs every received line to *message_log*, if it's set.
+
+    Lines are logged under their target channel, under the other party for
+    private messages, and under the source for everything else (NICK, QUIT
+    and the like), or "*" if there's no source.
+    """
+
+    message_log = None
+
+    def log_target(self, msg):
+        if msg.command in targeted_commands and msg.args:
+            target = msg.args[0]
+            if not (msg.prefix and target and
+                    nickname(target).lower() == nickname(self.nick).lower()):
+                return target
+        if msg.prefix:
+            return msg.prefix.nick
+        return "*"
+
+    def recv_message(self, msg):
+        if self.message_log is not None:
+            self.message_log.append(self.log_target(msg), msg.line)
+        return super(MessageLogMixin, self).recv_message(msg)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
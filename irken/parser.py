@@ -1,7 +1,11 @@
 """IRC parser."""
 
+from collections import Mapping
 from irken.nicks import Mask
 
+# Including the trailing CR LF.
+max_line_length = 512
+
 def parse_line(line, mask_maker=Mask.from_string):
     """Parse an IRC line, returning `(source, command, arguments)`.
     
@@ -29,8 +33,15 @@ def parse_line(line, mask_maker=Mask.from_string):
     (None, 'TEST', ['Hello :World :Bar'])
     >>> parse_line(":Kidney@example.net SVERIGE ABC")
     (Mask(ByteNickname('Kidney@example.net')), 'SVERIGE', ['ABC'])
+
+    Message tags are skipped, use `split_tags` first to get at them:
+
+    >>> parse_line("@time=2012-01-01T00:00:00.000Z PING ABC")
+    (None, 'PING', ['ABC'])
     """
 
+    if line.startswith("@"):
+        line = split_tags(line)[1]
     if line.startswith(":"):
         prefix, line = line[1:].split(" ", 1)
         source = mask_maker(prefix)
@@ -58,8 +69,9 @@ def parse_line(line, mask_maker=Mask.from_string):
 
     return source, command.upper(), arguments
 
-def build_line(source, command, arguments):
-    """Build an IRC line from *prefix*, *command* and *arguments*.
+def build_line(source, command, arguments, tags=None):
+    """Build an IRC line from *prefix*, *command* and *arguments*, and
+    optionally a mapping of message *tags*.
 
     It is the inverse of *parse_line*, see that function's documentation for
     more information.
@@ -72,9 +84,13 @@ def build_line(source, command, arguments):
     ':A!B@C ABC ABC :ABC ABC'
     >>> build_line(*parse_line("ABC ABC :ABC ABC"))
     'ABC ABC :ABC ABC'
+    >>> build_line(None, 'TAGMSG', ('#a',), tags={"+typing": "active"})
+    '@+typing=active TAGMSG #a'
     """
 
     r = ""
+    if tags:
+        r += "@%s " % (format_tags(tags),)
     if source:
         r += ":%s " % (source.to_string(),)
     r += command
@@ -94,6 +110,119 @@ def build_line(source, command, arguments):
             r += " ".join(arguments)
     return r
 
+_tag_unescapes = {":": ";", "s": " ", "r": "\r", "n": "\n"}
+_tag_escapes = (("\\", "\\\\"), (";", "\\:"), (" ", "\\s"),
+                ("\r", "\\r"), ("\n", "\\n"))
+
+def unescape_tag_value(value):
+    r"""Unescape an IRCv3 tag value.
+
+    >>> unescape_tag_value(r"a\sb\:c\\d\ne\x")
+    'a b;c\\d\nex'
+    >>> unescape_tag_value("trailing\\")
+    'trailing'
+    """
+    if "\\" not in value:
+        return value
+    parts = value.split("\\")
+    rv = [parts[0]]
+    it = iter(parts[1:])
+    for part in it:
+        if not part:
+            # An escaped backslash splits into an empty part and the rest.
+            rest = next(it, None)
+            if rest is None:
+                break
+            rv.append("\\" + rest)
+        else:
+            rv.append(_tag_unescapes.get(part[0], part[0]) + part[1:])
+    return "".join(rv)
+
+def escape_tag_value(value):
+    r"""Escape an IRCv3 tag value.
+
+    >>> escape_tag_value("a b;c\\d")
+    'a\\sb\\:c\\\\d'
+    """
+    for x, y in _tag_escapes:
+        value = value.replace(x, y)
+    return value
+
+def parse_tags(raw):
+    """Parse the tag section of a line, sans the @, into a dict.
+
+    >>> sorted(parse_tags("aaa=bbb;ccc;example.com/ddd=eee").items())
+    [('aaa', 'bbb'), ('ccc', ''), ('example.com/ddd', 'eee')]
+    """
+    rv = {}
+    for item in raw.split(";"):
+        if not item:
+            continue
+        key, _, value = item.partition("=")
+        rv[key] = unescape_tag_value(value)
+    return rv
+
+def format_tags(tags):
+    """Inverse of `parse_tags`. Tags with empty or None values are sent
+    without any.
+
+    >>> format_tags({"a": "b c"})
+    'a=b\\\\sc'
+    """
+    parts = []
+    for key, value in tags.iteritems():
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        if value:
+            parts.append("%s=%s" % (key, escape_tag_value(value)))
+        else:
+            parts.append(key)
+    return ";".join(parts)
+
+class Tags(Mapping):
+    """Lazily parsed message tags.
+
+    Only the raw tag section is kept until somebody actually looks at a tag,
+    so lines whose tags nobody reads cost nothing more than a split.
+
+    >>> tags = Tags("msgid=abc;time=2012-01-01T00:00:00.000Z")
+    >>> tags
+    Tags('msgid=abc;time=2012-01-01T00:00:00.000Z')
+    >>> tags["msgid"], "account" in tags, len(tags)
+    ('abc', False, 2)
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._parsed = None
+
+    def _get_parsed(self):
+        if self._parsed is None:
+            self._parsed = parse_tags(self.raw)
+        return self._parsed
+
+    def __getitem__(self, key): return self._get_parsed()[key]
+    def __iter__(self): return iter(self._get_parsed())
+    def __len__(self): return len(self._get_parsed())
+    def __contains__(self, key): return key in self._get_parsed()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.raw)
+
+def split_tags(line):
+    """Split the tag section off *line*, returning `(tags, rest)` where
+    *tags* is a `Tags` instance or None.
+
+    >>> split_tags("@a=b :x PING")
+    (Tags('a=b'), ':x PING')
+    >>> split_tags(":x PING")
+    (None, ':x PING')
+    """
+    if line[:1] != "@":
+        return None, line
+    raw, _, rest = line[1:].partition(" ")
+    return Tags(raw), rest.lstrip(" ")
+
 def is_numeric(v):
     """Returns True if v is an IRC numeric, False otherwise.
 
@@ -0,0 +1,122 @@
+"""Flattened recv_cmd/send_cmd pipelines.
+
+Mixins hook into the command chains by overriding `recv_cmd` or `send_cmd`
+and calling super. That is nice to write, but it costs a Python frame and an
+argument re-pack per mixin per message. A mixin whose override does nothing
+but transform the arguments can say so with `stage`, and `compose` will then
+build a class where those overrides are replaced by one function running the
+transforms in a loop:
+
+>>> class Base(object):
+...     def recv_cmd(self, prefix, command, args):
+...         return (prefix, command, args)
+>>> class Upper(Base):
+...     @stage("upper_cmd")
+...     def recv_cmd(self, prefix, command, args):
+...         rv = self.upper_cmd(prefix, command, args)
+...         return super(Upper, self).recv_cmd(*rv)
+...     def upper_cmd(self, prefix, command, args):
+...         return prefix, command.upper(), args
+>>> class Drop(Base):
+...     @stage("drop_cmd")
+...     def recv_cmd(self, prefix, command, args):
+...         rv = self.drop_cmd(prefix, command, args)
+...         if rv is not None:
+...             return super(Drop, self).recv_cmd(*rv)
+...     def drop_cmd(self, prefix, command, args):
+...         if command != "DROP":
+...             return prefix, command, args
+>>> C = compose("C", (Upper, Drop, Base))
+>>> C.recv_cmd.stages
+('upper_cmd', 'drop_cmd')
+>>> C().recv_cmd(None, "ping", ["x"])
+(None, 'PING', ['x'])
+>>> C().recv_cmd(None, "drop", []) is None
+True
+
+A transform returning None swallows the command, as `drop_cmd` does above.
+
+Subclasses can keep overriding `recv_cmd` the old way; their super call simply
+ends up in the flattened function. They can override the transforms too:
+
+>>> class Lower(C):
+...     def upper_cmd(self, prefix, command, args):
+...         return prefix, command.lower(), args
+>>> Lower().recv_cmd(None, "PING", ["x"])
+(None, 'ping', ['x'])
+"""
+
+import types
+
+pipeline_methods = ("recv_cmd", "send_cmd")
+
+def stage(transform_name, keywords=False):
+    """Mark a `recv_cmd` or `send_cmd` override as being nothing more than
+    running `self.<transform_name>(prefix, command, args)` and passing the
+    result on to super, or stopping if it was None. Keyword arguments (such
+    as *tags*) are passed on to super untouched, and to the transform too if
+    *keywords* is true."""
+    def deco(f):
+        f.pipeline_stage = transform_name
+        f.pipeline_keywords = keywords
+        return f
+    return deco
+
+def flatten(cls, name):
+    """Build a flattened version of method *name* on *cls*, or return None
+    if there's nothing to flatten."""
+    stages = []
+    keywords = []
+    for klass in cls.__mro__:
+        if name not in vars(klass):
+            continue
+        meth = vars(klass)[name]
+        transform_name = getattr(meth, "pipeline_stage", None)
+        if transform_name is None:
+            terminal = meth
+            break
+        stages.append(transform_name)
+        keywords.append(getattr(meth, "pipeline_keywords", False))
+    else:
+        return None
+    if not stages or not isinstance(terminal, types.FunctionType):
+        return None
+    # Looked up on the class of the instance, so that subclasses may
+    # override the transforms, and cached per class.
+    resolved = {}
+
+    def resolve(klass):
+        transforms = resolved[klass] = tuple(zip(
+            (getattr(klass, tn).im_func for tn in stages), keywords))
+        return transforms
+
+    def pipeline(self, prefix, command, args, **kwds):
+        transforms = resolved.get(type(self))
+        if transforms is None:
+            transforms = resolve(type(self))
+        for transform, with_kwds in transforms:
+            if with_kwds:
+                rv = transform(self, prefix, command, args, **kwds)
+            else:
+                rv = transform(self, prefix, command, args)
+            if rv is None:
+                return
+            prefix, command, args = rv
+        return terminal(self, prefix, command, args, **kwds)
+    pipeline.__name__ = name
+    pipeline.stages = tuple(stages)
+    pipeline.terminal = terminal
+    return pipeline
+
+def compose(name, bases, attrs=None):
+    """Create a class like `type` would, but with flattened pipelines."""
+    cls = type(name, bases, dict(attrs or {}))
+    for meth_name in pipeline_methods:
+        pipeline = flatten(cls, meth_name)
+        if pipeline is not None:
+            setattr(cls, meth_name, pipeline)
+    return cls
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,99 @@
+r"""Sans-IO protocol core.
+
+The protocol object knows how to turn bytes into parsed messages, and how to
+turn commands into bytes, but it never touches a socket. Whoever owns it feeds
+it whatever was read with `receive_data`, and drains `data_to_send` whenever
+it is convenient to write -- which lets a host batch writes per tick, or drive
+any number of protocol instances from one loop.
+
+>>> p = Protocol()
+>>> p.receive_data("PING :abc\r\nPRIVMSG #a :hi")
+[Message(prefix=None, command='PING', args=['abc'], line='PING :abc', tags=None)]
+>>> msg, = p.receive_data(" there\n")
+>>> msg.command, msg.args
+('PRIVMSG', ['#a', 'hi there'])
+
+Message tags are split off, but not parsed until they're looked at:
+
+>>> msg, = p.receive_data("@msgid=x;account=lericson :a!b@c AWAY\r\n")
+>>> msg.tags, msg.command
+(Tags('msgid=x;account=lericson'), 'AWAY')
+>>> msg.tags["account"]
+'lericson'
+
+>>> p.send(None, "PONG", ("abc",))
+'PONG abc'
+>>> p.send(None, "PONG", ("def",))
+'PONG def'
+>>> p.out_bytes
+20
+>>> p.data_to_send()
+'PONG abc\r\nPONG def\r\n'
+>>> p.data_to_send()
+''
+"""
+
+from collections import namedtuple
+from irken.parser import parse_line, build_line, split_tags
+
+Message = namedtuple("Message", "prefix command args line tags")
+
+class Protocol(object):
+    """IRC protocol state for one connection.
+
+    *parser* and *builder* default to the ones in `irken.parser`, but a
+    connection passes its own so that overriding those keeps working.
+    """
+
+    def __init__(self, parser=parse_line, builder=build_line):
+        self.parser = parser
+        self.builder = builder
+        self.in_tail = ""
+        self.out_segs = []
+        self.out_bytes = 0
+
+    def receive_data(self, data):
+        """Feed *data* read from the peer, returning a list of the messages
+        completed by it. Incomplete data is kept until the next call."""
+        if self.in_tail:
+            data = self.in_tail + data
+        lines = data.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        self.in_tail = lines.pop()
+        parser = self.parser
+        messages = []
+        for line in lines:
+            if not line:
+                continue
+            tags = None
+            if line[0] == "@":
+                tags, rest = split_tags(line)
+            else:
+                rest = line
+            prefix, command, args = parser(rest)
+            messages.append(Message(prefix, command, args, line, tags))
+        return messages
+
+    def send(self, prefix, command, args, tags=None):
+        """Queue a command for sending, returning the line built."""
+        if tags:
+            line = self.builder(prefix, command, args, tags=tags)
+        else:
+            line = self.builder(prefix, command, args)
+        self.send_raw(line)
+        return line
+
+    def send_raw(self, line):
+        """Queue an already built *line*, sans the line terminator."""
+        self.out_segs.append(line + "\r\n")
+        self.out_bytes += len(line) + 2
+
+    def data_to_send(self):
+        """Drain the outgoing buffer, returning the bytes to write."""
+        data = "".join(self.out_segs)
+        del self.out_segs[:]
+        self.out_bytes = 0
+        return data
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,317 @@
+r"""WHOIS, WHO and NAMES queries with their replies put back together.
+
+The server answers each of these with a run of numerics ended by an
+end-of-list numeric; `QueryMixin` collects them and hands back the result
+through a `Query`, which callbacks can be added to:
+
+>>> from irken.tests import TestConnection
+>>> class Conn(QueryMixin, TestConnection): pass
+>>> conn = Conn("bot")
+>>> done = []
+>>> q = conn.whois("Friend").add_callback(done.append)
+>>> conn.io.sent_lines
+['WHOIS Friend\r\n']
+>>> conn.whois("friend") is q
+True
+>>> conn.consume(":srv 311 bot friend fu fh * :Real Name\r\n"
+...              ":srv 330 bot friend fa :is logged in as\r\n"
+...              ":srv 318 bot friend :End of /WHOIS list.\r\n")
+''
+>>> done == [q]
+True
+>>> sorted(q.result.items())
+[('account', 'fa'), ('channels', []), ('host', 'fh'), ('nick', 'friend'), ('realname', 'Real Name'), ('user', 'fu')]
+
+Identical queries in flight are merged into one, as above, and results are
+cached for *query_ttl* seconds -- or until the nick they're about changes
+nick or quits, or the channel they're about is joined or parted. A query the
+server hasn't finished answering in *query_timeout* seconds is done with
+*error* set, so that its callbacks aren't left waiting forever.
+"""
+
+import logging
+from time import time
+from irken.dispatch import handler
+from irken.bursts import BurstMixin
+
+logger = logging.getLogger("irken.queries")
+
+class Query(object):
+    """The eventual result of a query.
+
+    *result* is filled in as replies arrive, and once the end-of-list
+    numeric has, *done* is set and the callbacks are called with the query.
+    If the server said there's no such thing, *error* says what it said; if
+    it never said anything, *error* is "timed out".
+    """
+
+    def __init__(self, kind, key, result):
+        self.kind = kind
+        self.key = key
+        self.result = result
+        self.error = None
+        self.done = False
+        self.token = None
+        self.timer = None
+        self.callbacks = []
+
+    def __repr__(self):
+        return "<%s %s %r%s>" % (self.__class__.__name__, self.kind, self.key,
+                                 " done" if self.done else "")
+
+    def add_callback(self, callback):
+        """Call *callback* with the query once it's done, or right away if it
+        already is. Returns the query."""
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+        return self
+
+    def finish(self):
+        self.done = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+#: WHOIS numerics and how to read them into the result, after our own nick
+#: and the nick asked about.
+whois_fields = {"311": ("user", "host", None, "realname"),
+                "312": ("server",),
+                "317": ("idle", "signon"),
+                "330": ("account",),
+                "301": ("away",)}
+whois_flags = {"313": "operator", "671": "secure"}
+
+#: The WHOX fields asked for, and the names they're given in results. The
+#: server sends them in this order whatever order they're asked for in.
+whox_fields = "tcuhnfar"
+whox_names = ("channel", "user", "host", "nick", "flags", "account",
+              "realname")
+
+class QueryMixin(BurstMixin):
+    """Sends WHOIS, WHO and NAMES queries and correlates their replies.
+
+    WHO replies are matched to queries by the mask the end-of-list numeric
+    repeats, and when the server supports WHOX, by a token sent with the
+    query too -- so any number of them can be in flight at once, or sent in
+    one `batch`.
+    """
+
+    query_ttl = 60.0
+    query_timeout = 30.0
+    query_cache_size = 1024
+
+    def __init__(self, *args, **kwds):
+        super(QueryMixin, self).__init__(*args, **kwds)
+        self._queries = {}
+        self._next_token = 0
+        self._query_cache = {}
+        self._cached_nicks = {}
+
+    def _query(self, kind, key, make_result, send, refresh):
+        qkey = (kind, key.lower())
+        if not refresh:
+            cached = self._query_cache.get(qkey)
+            if cached is not None:
+                if cached[0] > time():
+                    return cached[1]
+                self.forget_query(qkey)
+        query = self._queries.get(qkey)
+        if query is None:
+            query = self._queries[qkey] = Query(kind, key, make_result())
+            query.timer = self.call_later(self.query_timeout,
+                                          self._expire_query, qkey, query)
+            send(query)
+        return query
+
+    def _expire_query(self, qkey, query):
+        query.timer = None
+        if self._queries.get(qkey) is query:
+            logger.warning("%s %s got no reply in time", query.kind,
+                           query.key)
+            del self._queries[qkey]
+            query.error = "timed out"
+            query.finish()
+
+    def whois(self, nick, refresh=False):
+        """Query for what there is to know about *nick*. The result is a
+        dict with at least "nick" and "channels"."""
+        def send(query):
+            self.send_cmd(None, "WHOIS", (nick,))
+        return self._query("whois", nick,
+                           lambda: {"nick": nick, "channels": []},
+                           send, refresh)
+
+    def who(self, mask, refresh=False):
+        """Query for the users matching *mask*, or in channel *mask*. The
+        result is a list of dicts, one per user."""
+        return self._query("who", mask, list, self._send_who, refresh)
+
+    def who_many(self, masks, refresh=False):
+        """Query `who` for each of *masks*, sending them all at once."""
+        with self.batch():
+            return [self.who(mask, refresh=refresh) for mask in masks]
+
+    def _send_who(self, query):
+        if "WHOX" in self.isupport:
+            # WHOX tokens are at most three digits.
+            self._next_token = self._next_token % 999 + 1
+            query.token = str(self._next_token)
+            self.send_cmd(None, "WHO", (query.key,
+                                        "%" + whox_fields + "," + query.token))
+        else:
+            self.send_cmd(None, "WHO", (query.key,))
+
+    def names(self, channel, refresh=False):
+        """Query for the members of *channel*, as a dict of nick to their
+        membership prefix symbols."""
+        def send(query):
+            self.send_cmd(None, "NAMES", (channel,))
+        return self._query("names", channel, dict, send, refresh)
+
+    def _complete(self, kind, key):
+        query = self._queries.pop((kind, key.lower()), None)
+        if query is None:
+            return
+        if query.error is None:
+            self._cache_query(query)
+        query.finish()
+
+    def _cache_query(self, query):
+        cache = self._query_cache
+        if len(cache) >= self.query_cache_size:
+            now = time()
+            for qkey in [k for k, (exp, q, n) in cache.iteritems()
+                         if exp <= now]:
+                self.forget_query(qkey)
+            if len(cache) >= self.query_cache_size:
+                cache.clear()
+                self._cached_nicks.clear()
+        qkey = (query.kind, query.key.lower())
+        if query.kind == "whois":
+            nicks = [query.key]
+        elif query.kind == "who":
+            nicks = [user["nick"] for user in query.result]
+        else:
+            nicks = query.result
+        nicks = [nick.lower() for nick in nicks]
+        self.forget_query(qkey)
+        cache[qkey] = (time() + self.query_ttl, query, nicks)
+        for nick in nicks:
+            self._cached_nicks.setdefault(nick, set()).add(qkey)
+
+    def forget_query(self, qkey):
+        """Drop the cached result for `(kind, key)`, if any."""
+        cached = self._query_cache.pop(qkey, None)
+        if cached is None:
+            return
+        for nick in cached[2]:
+            qkeys = self._cached_nicks.get(nick)
+            if qkeys is not None:
+                qkeys.discard(qkey)
+                if not qkeys:
+                    del self._cached_nicks[nick]
+
+    def forget_nick(self, nick):
+        """Drop every cached result that mentions *nick*."""
+        for qkey in self._cached_nicks.pop(nick.lower(), ()):
+            self.forget_query(qkey)
+
+    @handler("irc cmd nick", "irc cmd quit")
+    def invalidate_nick_queries(self, cmd, *args):
+        if cmd.source is not None and cmd.source.nick:
+            self.forget_nick(cmd.source.nick)
+        if cmd.command.upper() == "NICK" and args:
+            self.forget_nick(args[0])
+
+    @handler("irc cmd join", "irc cmd part", "irc cmd kick")
+    def invalidate_channel_queries(self, cmd, channel=None, *args):
+        if channel:
+            for kind in ("who", "names"):
+                self.forget_query((kind, channel.lower()))
+
+    # WHOIS
+
+    def _whois_query(self, nick):
+        return self._queries.get(("whois", nick.lower()))
+
+    @handler("irc num 311", "irc num 312", "irc num 317", "irc num 330",
+             "irc num 301", "irc num 313", "irc num 671", "irc num 319",
+             "irc num 401")
+    def collect_whois(self, cmd, me=None, nick=None, *args):
+        query = self._whois_query(nick) if nick else None
+        if query is None:
+            return
+        numeric = cmd.command
+        if numeric == "311":
+            # The server knows best how the nick is spelled.
+            query.result["nick"] = nick
+        if numeric in whois_fields:
+            for name, value in zip(whois_fields[numeric], args):
+                if name in ("idle", "signon"):
+                    value = int(value) if value.isdigit() else value
+                if name is not None:
+                    query.result[name] = value
+        elif numeric in whois_flags:
+            query.result[whois_flags[numeric]] = True
+        elif numeric == "319":
+            if args:
+                query.result["channels"].extend(args[-1].split())
+        elif numeric == "401":
+            # The 318 that follows still ends the query.
+            query.error = args[-1] if args else "No such nick"
+
+    @handler("irc num 318")
+    def end_whois(self, cmd, me=None, nick=None, *args):
+        if nick:
+            self._complete("whois", nick)
+
+    # WHO
+
+    @handler("who complete")
+    def collect_who(self, name, mask, rows):
+        query = self._queries.get(("who", mask.lower()))
+        if query is None:
+            return
+        for row in rows:
+            if query.token is not None:
+                if row[0] == query.token and len(row) > len(whox_names):
+                    user = dict(zip(whox_names, row[1:]))
+                    if user["account"] == "0":
+                        user["account"] = None
+                    query.result.append(user)
+            elif len(row) >= 6:
+                query.result.append(self._who_user(*row))
+
+    def _who_user(self, channel, user, host, server, nick, flags, rest=""):
+        hops, _, realname = rest.partition(" ")
+        return {"channel": channel, "user": user, "host": host,
+                "server": server, "nick": nick, "flags": flags,
+                "hops": int(hops) if hops.isdigit() else None,
+                "realname": realname}
+
+    @handler("irc num 315")
+    def end_who(self, cmd, me=None, mask=None, *args):
+        if mask:
+            self._complete("who", mask)
+
+    # NAMES
+
+    @handler("names complete")
+    def collect_names(self, name, channel, members, userhosts):
+        query = self._queries.get(("names", channel.lower()))
+        if query is not None:
+            query.result.update(members)
+
+    @handler("irc num 366")
+    def end_names(self, cmd, me=None, channel=None, *args):
+        if channel:
+            self._complete("names", channel)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
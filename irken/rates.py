@@ -0,0 +1,216 @@
+r"""Sliding-window rate counters in bounded memory.
+
+Keeping a list of timestamps per nick to tell whether it's flooding costs
+memory and time in proportion to the flood. `RateCounter` instead keeps a
+count-min sketch per time bucket: a few rows of counters, each key hashed to
+one counter per row. A key's count is the smallest of its counters, which is
+never too low, and only too high when keys collide in every row. Memory is
+*buckets* times *depth* times *width* counters, however many keys there are,
+and adding or asking costs the same whatever the key.
+
+>>> rates = RateCounter(span=60, buckets=6, now=0)
+>>> for t in range(25):
+...     rates.add("spammer", now=t)
+>>> rates.add("friend", now=24)
+>>> rates.count("spammer", 10, now=24), rates.count("friend", 10, now=24)
+(5, 1)
+>>> rates.rate("spammer", 20, now=24)
+0.75
+>>> rates.count("spammer", now=100)
+0
+
+Windows are whole buckets of *span* / *buckets* seconds, the current one
+included, however far into it we are; a window is at least one bucket and
+at most *span* seconds.
+
+`FloodMixin` counts the PRIVMSGs and NOTICEs received per source and per
+source and target, and drops those of sources going over the limits before
+they're dispatched:
+
+>>> from irken.tests import TestConnection
+>>> class Conn(FloodMixin, TestConnection):
+...     flood_limit = 3
+...     @handler("flood")
+...     def on_flood(self, name, source, target):
+...         print "flood from", source.nick, "in", target
+...     @handler("irc cmd privmsg")
+...     def on_privmsg(self, cmd, target, text):
+...         print text
+>>> conn = Conn("bot")
+>>> conn.consume("".join(":spam!u@spam.host PRIVMSG #chan :buy %d\r\n" % i
+...                      for i in range(5)))
+buy 0
+buy 1
+buy 2
+flood from spam in #chan
+''
+"""
+
+import logging
+from time import time
+from array import array
+from irken.dispatch import DispatchRegistering, handler
+from irken.pipeline import stage
+
+logger = logging.getLogger("irken.rates")
+
+class RateCounter(object):
+    """Approximate event counts per key over the last *span* seconds.
+
+    The window is split into *buckets*; each bucket holds *depth* rows of
+    *width* counters. Wider rows mean fewer overestimates.
+    """
+
+    def __init__(self, span=60.0, buckets=12, width=1024, depth=3, now=None):
+        self.span = float(span)
+        self.buckets = buckets
+        self.width = width
+        self.depth = depth
+        self.resolution = self.span / buckets
+        self.cells = width * depth
+        self.counters = array("L", [0]) * (buckets * self.cells)
+        self._zeros = array("L", [0]) * self.cells
+        # Which tick each bucket holds counts for; stale ones are reset
+        # lazily, when next touched.
+        tick = self.tick(time() if now is None else now)
+        self.ticks = array("l", [tick]) * buckets
+
+    def tick(self, now):
+        return int(now // self.resolution)
+
+    def _bucket(self, tick):
+        """Offset of the bucket for *tick*, cleared if it held an older
+        one."""
+        slot = tick % self.buckets
+        offset = slot * self.cells
+        if self.ticks[slot] != tick:
+            self.counters[offset:offset + self.cells] = self._zeros
+            self.ticks[slot] = tick
+        return offset
+
+    def _cells(self, key):
+        # One counter per row, by double hashing.
+        h1 = hash(key)
+        h2 = hash((key, 1)) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width
+                for row in xrange(self.depth)]
+
+    def add(self, key, count=1, now=None):
+        """Count *count* events for *key*."""
+        now = time() if now is None else now
+        offset = self._bucket(self.tick(now))
+        counters = self.counters
+        for cell in self._cells(key):
+            counters[offset + cell] += count
+
+    def count(self, key, window=None, now=None):
+        """Estimated events for *key* over the last *window* seconds, or the
+        whole span."""
+        now = time() if now is None else now
+        window = self.span if window is None else min(window, self.span)
+        tick = self.tick(now)
+        nbuckets = max(1, int(-(-window // self.resolution)))
+        offsets = []
+        for t in xrange(tick - nbuckets + 1, tick + 1):
+            slot = t % self.buckets
+            if self.ticks[slot] == t:
+                offsets.append(slot * self.cells)
+        if not offsets:
+            return 0
+        counters = self.counters
+        return int(min(sum(counters[offset + cell] for offset in offsets)
+                       for cell in self._cells(key)))
+
+    def rate(self, key, window=None, now=None):
+        """Estimated events per second for *key* over the last *window*
+        seconds."""
+        window = self.span if window is None else min(window, self.span)
+        return self.count(key, window, now=now) / float(window)
+
+    def clear(self):
+        self.counters[:] = array("L", [0]) * len(self.counters)
+
+class FloodMixin(DispatchRegistering):
+    """Drops messages from sources sending more than *flood_limit* of them
+    to one target, or *flood_total_limit* in all, within *flood_window*
+    seconds.
+
+    Sources are told apart by host, so that changing nick doesn't reset the
+    count. When a source goes over a limit, "flood" is dispatched with the
+    source and target; for as long as it stays over, its messages are
+    dropped quietly. Handlers can ask `message_rate` themselves too.
+    """
+
+    flood_window = 10.0
+    flood_limit = 10
+    flood_total_limit = 20
+    flood_commands = frozenset(("PRIVMSG", "NOTICE"))
+    flood_flagged_size = 4096
+
+    def __init__(self, *args, **kwds):
+        super(FloodMixin, self).__init__(*args, **kwds)
+        self.rates = RateCounter(span=max(60.0, self.flood_window))
+        # Keys over a limit, and when they last were.
+        self._flagged = {}
+
+    def flood_key(self, prefix):
+        """What sources are counted by: the host if known, else the nick."""
+        if len(prefix) > 2 and prefix[2]:
+            return prefix[2].lower()
+        return prefix[0].lower()
+
+    def message_rate(self, source, window=None, target=None):
+        """Messages per second from *source* (a source or prefix), to
+        *target* or all of them, over *window* seconds."""
+        key = self.flood_key(getattr(source, "mask", source))
+        if target is not None:
+            key = (key, target.lower())
+        return self.rates.rate(key, window or self.flood_window)
+
+    @stage("flood_cmd")
+    def recv_cmd(self, prefix, command, args, **kwds):
+        rv = self.flood_cmd(prefix, command, args)
+        if rv is not None:
+            return super(FloodMixin, self).recv_cmd(*rv, **kwds)
+
+    def flood_cmd(self, prefix, command, args):
+        if command not in self.flood_commands or not prefix or not args:
+            return prefix, command, args
+        key = self.flood_key(prefix)
+        target = args[0].lower()
+        now = time()
+        window = self.flood_window
+        rates = self.rates
+        rates.add(key, now=now)
+        rates.add((key, target), now=now)
+        over = rates.count((key, target), window, now) - self.flood_limit
+        total_over = rates.count(key, window, now) - self.flood_total_limit
+        newly = self._flag((key, target), over > 0, now)
+        newly = self._flag(key, total_over > 0, now) or newly
+        if newly:
+            logger.info("flood from %s in %s", key, args[0])
+            self.dispatch("flood", self.lookup_prefix(prefix), args[0])
+        if over <= 0 and total_over <= 0:
+            return prefix, command, args
+
+    def _flag(self, key, over, now):
+        """Note whether *key* is *over*, returning True if it just went."""
+        flagged = self._flagged
+        if not over:
+            flagged.pop(key, None)
+            return False
+        since = flagged.get(key)
+        flagged[key] = now
+        if since is not None and now - since <= self.flood_window:
+            return False
+        if len(flagged) > self.flood_flagged_size:
+            # Those that stopped sending while over don't unflag themselves.
+            for stale in [k for k, t in flagged.iteritems()
+                          if now - t > self.flood_window]:
+                del flagged[stale]
+        return True
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
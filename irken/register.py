@@ -0,0 +1,244 @@
+r"""Registration in as few round trips as it takes.
+
+`RegistrationMixin` builds on capability negotiation to log in with SASL
+before registration ends, rather than identifying to services after it, and
+picks another nick if the one asked for is taken. Once welcomed, it joins
+*channels* right away, as many to a JOIN as fit:
+
+>>> from irken.tests import TestConnection
+>>> class Conn(RegistrationMixin, TestConnection): pass
+>>> conn = Conn("bot", sasl=("PLAIN", "bot", "hunter2"),
+...             channels=["#a", ("#secret", "key"), "#b"])
+>>> conn.start_negotiation()
+>>> conn.consume(":srv CAP * LS :sasl=PLAIN,EXTERNAL\r\n"
+...              ":srv CAP * ACK :sasl\r\n"
+...              "AUTHENTICATE +\r\n")
+''
+>>> for line in conn.io.sent_lines[1:]:
+...     print line.rstrip()
+CAP REQ sasl
+AUTHENTICATE PLAIN
+AUTHENTICATE Ym90AGJvdABodW50ZXIy
+>>> conn.consume(":srv 903 bot :SASL authentication successful\r\n")
+''
+>>> conn.io.sent_lines[-1]
+'CAP END\r\n'
+>>> conn.consume(":srv 001 bot :Welcome\r\n")
+''
+>>> conn.io.sent_lines[-1]
+'JOIN #secret,#a,#b key\r\n'
+"""
+
+import base64
+import random
+import logging
+from irken.caps import CapabilityMixin
+from irken.dispatch import handler
+from irken.isupport import parse_targmax
+from irken.nicks import nickname
+from irken.parser import max_line_length
+from irken.utils import NicknameMixin
+
+logger = logging.getLogger("irken.register")
+
+def sasl_chunks(payload):
+    """Base64 *payload* split into AUTHENTICATE arguments of 400 bytes, with
+    a "+" to end it if the last one is full (or there's nothing to send).
+
+    >>> sasl_chunks("")
+    ['+']
+    >>> [len(chunk) for chunk in sasl_chunks("x" * 300)]
+    [400, 1]
+    """
+    encoded = base64.b64encode(payload)
+    chunks = [encoded[i:i + 400] for i in xrange(0, len(encoded), 400)]
+    if not chunks or len(chunks[-1]) == 400:
+        chunks.append("+")
+    return chunks
+
+def _byte_len(value):
+    return len(value.encode("utf-8") if isinstance(value, unicode) else value)
+
+class RegistrationMixin(CapabilityMixin, NicknameMixin):
+    """Registers with SASL, nick fallback and channel joins.
+
+    *sasl* is `("PLAIN", account, password)` or `("EXTERNAL",)`, the latter
+    for a TLS client certificate. *channels* is a list of channel names or
+    `(name, key)` pairs, or a dict of names to keys. If the nick is taken,
+    *alt_nicks* are tried in turn, then variations of the nick. All three
+    may be given as keyword arguments.
+
+    If the server hasn't answered SASL in *sasl_timeout* seconds, it's taken
+    to have failed, so that registration goes on.
+    """
+
+    sasl_timeout = 30.0
+    sasl = None
+    channels = ()
+    alt_nicks = ()
+    registered = False
+    account = None
+
+    def __init__(self, *args, **kwds):
+        for name in ("sasl", "channels", "alt_nicks"):
+            if name in kwds:
+                setattr(self, name, kwds.pop(name))
+        super(RegistrationMixin, self).__init__(*args, **kwds)
+        if self.sasl:
+            self.wanted_caps = tuple(self.wanted_caps) + ("sasl",)
+        self.reset_registration()
+
+    def reset_registration(self):
+        self.registered = False
+        self.account = None
+        self._sasl_state = None
+        self._cancel_sasl_timer()
+        self._nick_candidates = None
+
+    def connect(self, *args, **kwds):
+        self.reset_registration()
+        return super(RegistrationMixin, self).connect(*args, **kwds)
+
+    # SASL
+
+    @handler("caps changed")
+    def start_sasl(self, name, caps):
+        if not self.sasl or "sasl" not in caps or self._sasl_state:
+            return
+        mechanism = self.sasl[0].upper()
+        offered = self.available_caps.get("sasl")
+        if offered and mechanism not in offered.upper().split(","):
+            logger.warning("server doesn't do SASL %s, only %s",
+                           mechanism, offered)
+            return
+        self._sasl_state = "started"
+        self.hold_negotiation("sasl")
+        self._sasl_timer = self.call_later(self.sasl_timeout,
+                                           self.sasl_timed_out)
+        self.send_cmd(None, "AUTHENTICATE", (mechanism,))
+
+    def _cancel_sasl_timer(self):
+        timer = getattr(self, "_sasl_timer", None)
+        if timer is not None:
+            timer.cancel()
+        self._sasl_timer = None
+
+    def sasl_timed_out(self):
+        self._sasl_timer = None
+        if self._sasl_state in ("started", "sent"):
+            logger.warning("no answer to SASL in %.0fs", self.sasl_timeout)
+            self.finish_sasl(False)
+
+    def sasl_payload(self):
+        if self.sasl[0].upper() == "EXTERNAL":
+            return ""
+        account, password = self.sasl[1:3]
+        payload = u"%s\0%s\0%s" % (account, account, password)
+        return payload.encode("utf-8")
+
+    @handler("irc cmd authenticate")
+    def continue_sasl(self, cmd, data="+"):
+        if self._sasl_state == "started" and data == "+":
+            self._sasl_state = "sent"
+            with self.batch():
+                for chunk in sasl_chunks(self.sasl_payload()):
+                    self.send_cmd(None, "AUTHENTICATE", (chunk,))
+
+    @handler("irc num 900")
+    def note_logged_in(self, cmd, me=None, mask=None, account=None, *args):
+        self.account = account
+
+    @handler("irc num 902", "irc num 903", "irc num 904", "irc num 905",
+             "irc num 906", "irc num 907")
+    def end_sasl(self, cmd, *args):
+        if self._sasl_state not in ("started", "sent"):
+            return
+        success = cmd.command == "903"
+        if not success:
+            logger.warning("SASL failed: %s", args[-1] if args else cmd)
+        self.finish_sasl(success)
+
+    def finish_sasl(self, success):
+        self._sasl_state = "done"
+        self._cancel_sasl_timer()
+        self.dispatch("sasl result", success)
+        self.release_negotiation("sasl")
+
+    # Nick collisions
+
+    def nick_candidates(self, nick):
+        """Nicks to try after *nick*: *alt_nicks*, then *nick* with an
+        underscore, then with random digits, for as long as it takes."""
+        for alt in self.alt_nicks:
+            yield alt
+        yield nick + "_"
+        nicklen = int(self.isupport.get("NICKLEN") or 9)
+        while True:
+            yield nick[:nicklen - 3] + "%03d" % (random.randrange(1000),)
+
+    @handler("irc num 432", "irc num 433", "irc num 437")
+    def try_other_nick(self, cmd, *args):
+        # After registration, it's up to whoever changed nick.
+        if self.registered:
+            return
+        if self._nick_candidates is None:
+            self._nick_candidates = self.nick_candidates(self.nick)
+        nick = next(self._nick_candidates)
+        logger.info("nick %s unavailable, trying %s", self.nick, nick)
+        # Not through the property, which would only send it once set.
+        self._nick = nickname(nick)
+        self.send_cmd(None, "NICK", (nick,))
+
+    # After the welcome
+
+    @handler("irc num 001")
+    def finish_registration(self, cmd, me=None, *args):
+        self.registered = True
+        self._nick_candidates = None
+        if me and me != self.nick:
+            self._nick = nickname(me)
+        if self.channels:
+            self.join_channels(self.channels)
+
+    def pack_joins(self, channels):
+        """Split *channels* into `(names, keys)` pairs that each fit in a
+        JOIN line, keyed channels first, as keys go with the channels in
+        order."""
+        if isinstance(channels, dict):
+            items = channels.items()
+        else:
+            items = [(channel, None) if isinstance(channel, basestring)
+                     else tuple(channel) for channel in channels]
+        items.sort(key=lambda item: not item[1])
+        limit = None
+        if "TARGMAX" in self.isupport:
+            limit = parse_targmax(self.isupport["TARGMAX"]).get("JOIN")
+        room = max_line_length - len("JOIN  \r\n")
+        lines = []
+        names, keys, length = [], [], 0
+        for name, key in items:
+            cost = _byte_len(name) + 1 + (_byte_len(key) + 1 if key else 0)
+            if names and (length + cost > room or
+                          (limit is not None and len(names) >= limit)):
+                lines.append((names, keys))
+                names, keys, length = [], [], 0
+            names.append(name)
+            if key:
+                keys.append(key)
+            length += cost
+        if names:
+            lines.append((names, keys))
+        return lines
+
+    def join_channels(self, channels):
+        """JOIN *channels*, in as few lines as they fit in."""
+        with self.batch():
+            for names, keys in self.pack_joins(channels):
+                args = [",".join(names)]
+                if keys:
+                    args.append(",".join(keys))
+                self.send_cmd(None, "JOIN", args)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,335 @@
+r"""Relay mode: one upstream connection shared by many local clients.
+
+A `Relay` listens for IRC clients and attaches them to an upstream
+connection, which must include `RelayMixin`. Lines from upstream go to every
+attached client as the very bytes that were received -- only the command is
+looked at, to decide what to keep -- so fanning out costs a buffer append
+per client, and nothing is decoded or rebuilt.
+
+    class Bouncer(RelayMixin, irken.Connection):
+        make_io = SimpleSocketIO
+
+    conn = Bouncer("mynick")
+    conn.connect(("irc.example.org", 6667))
+    relay = Relay(conn, ("127.0.0.1", 6667))
+    while True:
+        relay.run_once(1.0)
+
+A client registering with the relay gets the upstream's welcome numerics,
+then the last *backlog_size* messages. What it sends is passed upstream as
+is, except for registration and PING, which the relay answers itself. Client
+lines go through a `TokenBucket`, so that a chatty client can't get the
+shared connection killed for flooding.
+"""
+
+import socket
+import logging
+from time import time
+from select import select
+from collections import deque
+from irken.parser import split_tags
+
+logger = logging.getLogger("irken.relay")
+
+#: Upstream commands worth replaying to clients that attach later.
+backlog_commands = frozenset(("PRIVMSG", "NOTICE", "JOIN", "PART", "KICK",
+                              "QUIT", "NICK", "TOPIC", "MODE"))
+welcome_numerics = frozenset(("001", "002", "003", "004", "005"))
+
+def line_command(line):
+    """The command of raw *line*, found without parsing the rest of it.
+
+    >>> line_command("@time=x :nick!u@h PRIVMSG #a :hello")
+    'PRIVMSG'
+    >>> line_command("ping :abc")
+    'PING'
+    """
+    start = 0
+    if line.startswith("@"):
+        start = line.find(" ") + 1
+    if line.startswith(":", start):
+        start = line.find(" ", start) + 1
+    end = line.find(" ", start)
+    return line[start:end if end >= 0 else len(line)].upper()
+
+class TokenBucket(object):
+    """Allows *burst* events at once, refilling at *rate* per second.
+
+    >>> bucket = TokenBucket(burst=2, rate=0.5, now=0)
+    >>> [bucket.take(now=0) for i in range(3)]
+    [True, True, False]
+    >>> bucket.wait_time(now=1)
+    1.0
+    >>> bucket.take(now=2)
+    True
+    """
+
+    def __init__(self, burst=5, rate=0.5, now=None):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.stamp = time() if now is None else now
+
+    def _refill(self, now):
+        now = time() if now is None else now
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now=None):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now=None):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class RelayMixin(object):
+    """Hands every line received to *relay*, if there is one."""
+
+    relay = None
+
+    def recv_message(self, msg):
+        if self.relay is not None:
+            self.relay.relay_message(msg)
+        return super(RelayMixin, self).recv_message(msg)
+
+class RelayClient(object):
+    """A downstream client's socket and buffers."""
+
+    def __init__(self, sock, address):
+        sock.setblocking(0)
+        self.socket = sock
+        self.address = address
+        self.in_tail = ""
+        self.out_segs = deque()
+        self.out_bytes = 0
+        self.nick = None
+        self.user = None
+        self.password = None
+        self.registered = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def push(self, data):
+        self.out_segs.append(data)
+        self.out_bytes += len(data)
+
+    def write(self):
+        data = "".join(self.out_segs)
+        self.out_segs.clear()
+        sent = self.socket.send(data)
+        if sent < len(data):
+            self.out_segs.append(data[sent:])
+        self.out_bytes = len(data) - sent
+
+    def read(self):
+        """Read what's there, returning the complete lines."""
+        data = self.socket.recv(1 << 12)
+        if not data:
+            raise IOError("client closed connection")
+        lines = (self.in_tail + data).replace("\r", "").split("\n")
+        self.in_tail = lines.pop()
+        return [line for line in lines if line]
+
+    def close(self):
+        # Whatever fits in the socket buffer, such as an error reply, is
+        # still worth sending.
+        if self.out_bytes:
+            try:
+                self.write()
+            except socket.error:
+                pass
+        self.socket.close()
+
+class Relay(object):
+    """Relays *upstream* to clients connecting to *address*.
+
+    Clients must give *password* with PASS, if it's set. A client whose
+    output buffer grows past *client_buffer_limit* isn't keeping up, and is
+    disconnected rather than let grow without end.
+    """
+
+    backlog_size = 1000
+    client_buffer_limit = 1 << 20
+    server_name = "irken.relay"
+
+    def __init__(self, upstream, address=("127.0.0.1", 0), password=None,
+                 flood=None):
+        self.upstream = upstream
+        upstream.relay = self
+        self.password = password
+        self.flood = TokenBucket() if flood is None else flood
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+        self.clients = []
+        self.welcome = []
+        self.backlog = deque(maxlen=self.backlog_size)
+        self.upstream_queue = deque()
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def close(self):
+        for client in list(self.clients):
+            self.drop(client)
+        self.listener.close()
+        self.upstream.relay = None
+
+    # Upstream to clients
+
+    def relay_message(self, msg):
+        command = msg.command
+        if command == "PING":
+            return
+        data = msg.line + "\r\n"
+        if command in welcome_numerics:
+            if command == "001":
+                del self.welcome[:]
+            self.welcome.append(data)
+        elif command in backlog_commands:
+            self.backlog.append(data)
+        self.fan_out(data)
+
+    def fan_out(self, data, skip=None):
+        for client in list(self.clients):
+            if client.registered and client is not skip:
+                client.push(data)
+                if client.out_bytes > self.client_buffer_limit:
+                    logger.warning("dropping slow client %s", client.address)
+                    self.drop(client)
+
+    # Clients to upstream
+
+    def reply(self, client, command, *args):
+        line = ":%s %s %s" % (self.server_name, command,
+                              " ".join(args[:-1] + (":" + args[-1],)))
+        client.push(line + "\r\n")
+
+    def client_line(self, client, line):
+        command = line_command(line)
+        if command == "PING":
+            token = line.split(" ", 1)[1] if " " in line else ""
+            client.push(":%s PONG %s %s\r\n" % (self.server_name,
+                                                self.server_name, token))
+        elif command == "QUIT":
+            self.drop(client)
+        elif not client.registered:
+            self.register(client, command, line)
+        elif command in ("USER", "PASS", "CAP"):
+            pass
+        else:
+            self.upstream_queue.append(line)
+            if command in ("PRIVMSG", "NOTICE"):
+                # The server doesn't echo these, so the other clients would
+                # never see them otherwise.
+                self.echo(line, skip=client)
+
+    def echo(self, line, skip=None):
+        """Pass client *line* on to the other clients as if from us."""
+        tags, rest = split_tags(line)
+        if rest.startswith(":"):
+            rest = rest.partition(" ")[2]
+        data = ":%s %s\r\n" % (self.upstream.nick, rest)
+        if tags is not None:
+            data = "@%s %s" % (tags.raw, data)
+        self.backlog.append(data)
+        self.fan_out(data, skip=skip)
+
+    def register(self, client, command, line):
+        args = line.split(" ", 1)[1] if " " in line else ""
+        if command == "NICK":
+            client.nick = args.lstrip(":")
+        elif command == "USER":
+            client.user = args
+        elif command == "PASS":
+            client.password = args.lstrip(":")
+        elif command == "CAP" and args.upper().startswith("LS"):
+            self.reply(client, "CAP", "*", "LS", "")
+        if client.nick is None or client.user is None:
+            return
+        if self.password is not None and client.password != self.password:
+            self.reply(client, "464", client.nick, "Password incorrect")
+            self.drop(client)
+            return
+        client.registered = True
+        logger.info("client %s attached", client.address)
+        for data in self.welcome:
+            client.push(data)
+        for data in self.backlog:
+            client.push(data)
+
+    def pump_upstream(self, now=None):
+        """Send queued client lines upstream, as fast as flood control
+        allows."""
+        if not self.upstream_queue:
+            return
+        send_raw = self.upstream.protocol.send_raw
+        while self.upstream_queue and self.flood.take(now):
+            send_raw(self.upstream_queue.popleft())
+        self.upstream.flush()
+
+    # The loop
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        self.clients.append(RelayClient(sock, address))
+
+    def drop(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+            client.close()
+            logger.info("client %s detached", client.address)
+
+    def run_once(self, timeout=None):
+        """Wait at most *timeout* seconds for something to happen, and handle
+        it."""
+        self.pump_upstream()
+        if self.upstream_queue:
+            wait = self.flood.wait_time()
+            timeout = wait if timeout is None else min(timeout, wait)
+        upstream_io = self.upstream.io
+        upstream_sock = upstream_io.socket
+        rlist = [self.listener, upstream_sock] + self.clients
+        wlist = [client for client in self.clients if client.out_bytes]
+        if upstream_io.buffered_bytes():
+            wlist.append(upstream_sock)
+        r, w, _ = select(rlist, wlist, [], upstream_io.timer_timeout(timeout))
+        if upstream_sock in w:
+            upstream_io.write_buffered()
+        upstream_io.run_timers()
+        for obj in r:
+            if obj is self.listener:
+                self.accept()
+            elif obj is upstream_sock:
+                upstream_io.receive(self.upstream.consume)
+            elif obj in self.clients:
+                try:
+                    for line in obj.read():
+                        self.client_line(obj, line)
+                except (IOError, socket.error), e:
+                    logger.info("client %s: %s", obj.address, e)
+                    self.drop(obj)
+        for client in w:
+            if client in self.clients:
+                try:
+                    client.write()
+                except socket.error, e:
+                    logger.info("client %s: %s", client.address, e)
+                    self.drop(client)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,181 @@
+"""Hot restart: hand live connections over to a freshly exec'd process.
+
+The old process snapshots each connection's state, forks and execs the new
+code, and sends it the snapshots over a Unix socket. The IRC sockets are
+inherited across the exec, so the new process picks up reading where the old
+one left off -- the server never sees a reconnect.
+
+In the old process::
+
+    if restart.hand_off(connections):   # Once the new one has them.
+        sys.exit()
+
+and in the new::
+
+    connections = restart.resume(lambda state: MyBot(state["nick"]))
+    if not connections:
+        ...connect as usual...
+
+Python 2 can't send file descriptors with SCM_RIGHTS, so they're passed by
+inheritance, and the Unix socket carries their numbers along with the state.
+"""
+
+import os
+import sys
+import ssl
+import errno
+import signal
+import fcntl
+import socket
+import struct
+import logging
+import cPickle as pickle
+from irken.nicks import Mask
+
+logger = logging.getLogger("irken.restart")
+
+#: Name of the environment variable carrying the state socket's fd.
+env_var = "IRKEN_RESTART_FD"
+
+class RestartMixin(object):
+    """Makes a connection's state snapshottable.
+
+    Attributes named in *restart_attrs* are copied as they are, if set; add
+    to it for state of your own, as long as it pickles.
+    """
+
+    restart_attrs = ("isupport", "own_user", "own_host", "autoregister",
+                     "caps", "registered")
+
+    def snapshot(self):
+        state = {"nick": self.nick,
+                 "attrs": dict((attr, getattr(self, attr))
+                               for attr in self.restart_attrs
+                               if hasattr(self, attr)),
+                 "prefixes": [tuple(source.mask)
+                              for source in self._prefix_cache.itervalues()
+                              if source.mask],
+                 "in_tail": self.protocol.in_tail,
+                 # Copied, not drained, in case the hand-off fails.
+                 "out": (self.io.buffered_output() +
+                         "".join(self.protocol.out_segs))}
+        sock = self.io.socket
+        if isinstance(sock, ssl.SSLSocket):
+            # The TLS state lives in OpenSSL, not in the fd.
+            raise ValueError("TLS connections can't be handed off")
+        state["socket"] = (sock.fileno(), sock.family, sock.type, sock.proto)
+        return state
+
+    def handed_off(self):
+        """Drop the output the new process now sends in our stead."""
+        self.protocol.data_to_send()
+        self.io.discard_output()
+
+    def restore(self, state, sock):
+        for attr, value in state["attrs"].iteritems():
+            setattr(self, attr, value)
+        for mask in state["prefixes"]:
+            self.lookup_prefix(Mask(*mask))
+        self.protocol.in_tail = state["in_tail"]
+        self.io.adopt_socket(sock)
+        if state["out"]:
+            self.io.deliver(state["out"])
+
+def _set_inheritable(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+def send_states(sock, states):
+    data = pickle.dumps(states, 2)
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def recv_states(sock):
+    def recv_exactly(n):
+        chunks = []
+        while n:
+            chunk = sock.recv(n)
+            if not chunk:
+                raise IOError("short read of restart state")
+            chunks.append(chunk)
+            n -= len(chunk)
+        return "".join(chunks)
+    size, = struct.unpack("!I", recv_exactly(4))
+    return pickle.loads(recv_exactly(size))
+
+def hand_off(conns, argv=None, executable=sys.executable, timeout=30.0):
+    """Exec a new process running *argv* (defaulting to this process's), and
+    hand it *conns*. Returns the new process's pid once it has them.
+
+    If it hasn't said it has them within *timeout* seconds, it's killed and
+    None returned; the connections are then still this process's, output
+    and all.
+
+    Stop reading from the connections before calling this, or you'll steal
+    data from the new process.
+    """
+    argv = sys.argv if argv is None else argv
+    states = [conn.snapshot() for conn in conns]
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    for state in states:
+        _set_inheritable(state["socket"][0])
+    _set_inheritable(theirs.fileno())
+    env = dict(os.environ)
+    env[env_var] = str(theirs.fileno())
+    pid = os.fork()
+    if not pid:
+        try:
+            ours.close()
+            os.execve(executable, [executable] + list(argv), env)
+        finally:
+            os._exit(127)
+    theirs.close()
+    ours.settimeout(timeout)
+    try:
+        send_states(ours, states)
+        if ours.recv(2) != "ok":
+            raise IOError("new process didn't take over connections")
+    except (IOError, socket.error), e:
+        logger.error("hand-off to pid %d failed: %s", pid, e)
+        _kill(pid)
+        return None
+    finally:
+        ours.close()
+    for conn in conns:
+        conn.handed_off()
+    logger.info("handed %d connections to pid %d", len(states), pid)
+    return pid
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+    os.waitpid(pid, 0)
+
+def resume(factory, environ=os.environ):
+    """Take over connections handed off to this process, if any.
+
+    *factory* is called with each state snapshot and should return a fresh
+    connection instance, which then gets the state and socket restored.
+    """
+    fd = environ.get(env_var)
+    if fd is None:
+        return []
+    del environ[env_var]
+    ctrl = socket.fromfd(int(fd), socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(int(fd))
+    try:
+        states = recv_states(ctrl)
+        conns = []
+        for state in states:
+            fileno, family, type_, proto = state["socket"]
+            sock = socket.fromfd(fileno, family, type_, proto)
+            os.close(fileno)
+            conn = factory(state)
+            conn.restore(state, sock)
+            conns.append(conn)
+        ctrl.sendall("ok")
+    finally:
+        ctrl.close()
+    return conns
@@ -0,0 +1,147 @@
+r"""Sending text of any length.
+
+A server truncates whatever doesn't fit in 512 bytes -- and the limit applies
+to the line as the server relays it, that is, with our full mask as prefix.
+`SayMixin.say` works out the room left for text once, from the mask the
+server knows us by, and splits the text at spaces or, failing that, at UTF-8
+code point boundaries.
+
+>>> from irken.tests import TestConnection
+>>> class Conn(SayMixin, TestConnection): pass
+>>> conn = Conn("bot")
+>>> conn.consume(":srv 001 bot :Welcome to IRC bot!bot@example.org\r\n")
+''
+>>> conn.mask
+Mask(ByteNickname('bot'), 'bot', 'example.org')
+>>> conn.text_budget("PRIVMSG", "#chan")
+474
+>>> conn.say("#chan", "a" * 600)
+>>> [len(line) for line in conn.io.sent_lines.pop().split("\r\n")]
+[488, 140, 0]
+"""
+
+import re
+from irken.nicks import Mask
+from irken.dispatch import DispatchRegistering, handler
+from irken.parser import max_line_length
+
+_newline_re = re.compile(r"\r\n|\r|\n")
+
+def split_text(data, max_bytes):
+    r"""Split the byte string *data* into non-empty pieces of at most
+    *max_bytes* bytes, preferably at spaces, but never in the middle of a
+    UTF-8 sequence. Newlines always split.
+
+    >>> split_text("hello world", 8)
+    ['hello', 'world']
+    >>> split_text("hello\nworld", 80)
+    ['hello', 'world']
+    >>> split_text("abcdefgh", 3)
+    ['abc', 'def', 'gh']
+    >>> split_text(u"\xe5\xe4\xf6".encode("utf-8"), 3)
+    ['\xc3\xa5', '\xc3\xa4', '\xc3\xb6']
+    >>> split_text("", 3)
+    []
+    """
+    pieces = []
+    for line in _newline_re.split(data):
+        while len(line) > max_bytes:
+            cut = line.rfind(" ", 0, max_bytes + 1)
+            if cut > 0:
+                pieces.append(line[:cut])
+                line = line[cut + 1:]
+                continue
+            cut = max_bytes
+            while cut > 0 and 0x80 <= ord(line[cut]) < 0xc0:
+                cut -= 1
+            if not cut:
+                cut = max_bytes
+            pieces.append(line[:cut])
+            line = line[cut:]
+        if line:
+            pieces.append(line)
+    return pieces
+
+class SayMixin(DispatchRegistering):
+    """Learns our full mask from the server and splits text sent with `say`
+    and `notice` into lines that fit.
+
+    Until the user and host are known, the longest ones allowed (ISUPPORT
+    USERLEN and HOSTLEN, or *default_userlen* and *default_hostlen*) are
+    assumed.
+    """
+
+    default_userlen = 10
+    default_hostlen = 63
+    own_user = own_host = None
+
+    @property
+    def mask(self):
+        if self.own_user:
+            return Mask(self.nick, self.own_user, self.own_host)
+        return Mask(self.nick)
+
+    def _to_bytes(self, v):
+        if isinstance(v, unicode):
+            encode = getattr(self, "_encode", None)
+            return encode(v) if encode else v.encode("utf-8")
+        return v
+
+    def _isupport_len(self, name, default):
+        value = getattr(self, "isupport", {}).get(name)
+        return int(value) if value else default
+
+    def text_budget(self, command, target):
+        """Number of bytes left for text in a *command* to *target*, as the
+        server will relay it."""
+        nick = len(self._to_bytes(self.nick))
+        if self.own_user:
+            user = len(self._to_bytes(self.own_user))
+        else:
+            user = self._isupport_len("USERLEN", self.default_userlen)
+        if self.own_host:
+            host = len(self._to_bytes(self.own_host))
+        else:
+            host = self._isupport_len("HOSTLEN", self.default_hostlen)
+        # ":nick!user@host COMMAND target :text\r\n"
+        overhead = (1 + nick + 1 + user + 1 + host + 1 + len(command) + 1 +
+                    len(self._to_bytes(target)) + 2 + 2)
+        return max_line_length - overhead
+
+    def say(self, target, text, command="PRIVMSG"):
+        """Send *text* to *target*, in as many lines as it takes."""
+        budget = self.text_budget(command, target)
+        with self.batch():
+            for piece in split_text(self._to_bytes(text), budget):
+                self.send_cmd(None, command, (target, piece))
+
+    def notice(self, target, text):
+        self.say(target, text, command="NOTICE")
+
+    def learn_own_mask(self, mask):
+        if mask.user:
+            self.own_user = mask.user
+        if mask.host:
+            self.own_host = mask.host
+
+    @handler("irc num 001")
+    def learn_mask_from_welcome(self, cmd, *args):
+        # Most servers end the welcome with our full mask.
+        words = args[-1].split() if args else ()
+        if words and "!" in words[-1] and "@" in words[-1]:
+            self.learn_own_mask(Mask.from_string(words[-1]))
+
+    @handler("irc num 396")
+    def learn_displayed_host(self, cmd, *args):
+        if len(args) >= 2:
+            self.own_host = args[1]
+
+    def recv_message(self, msg):
+        if msg.command == "JOIN" and msg.prefix and msg.prefix.host:
+            if msg.prefix.nick.lower() == self.nick.lower():
+                self.learn_own_mask(msg.prefix)
+        return super(SayMixin, self).recv_message(msg)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,331 @@
+"""Sharding connections across worker processes.
+
+One process only gets one core's worth of parsing and dispatch, so a large
+fleet of connections is better split over several. A `Supervisor` hashes
+each connection id to one of *n_workers* worker processes, each of which
+builds its connections with *factory* and runs them all from one select
+loop::
+
+    def factory(conn_id, spec):
+        conn = MyBot(spec["nick"])
+        conn.connect(spec["address"])
+        return conn
+
+    sup = Supervisor(factory, 4)
+    for network, spec in networks.iteritems():
+        sup.add(network, spec)
+    sup.start()
+    while True:
+        sup.poll(1.0)
+
+The supervisor talks to its workers over pipes: commands go down
+(`broadcast` sends a command on every connection in every shard, `send_to`
+on only one), and heartbeats and metrics come up. A worker that dies or
+stops beating is restarted on its own; the other shards carry on as if
+nothing happened.
+
+Messages on the pipes are plain tuples, first item naming the kind.
+"""
+
+import logging
+import multiprocessing
+from zlib import crc32
+from time import time
+from select import select
+
+logger = logging.getLogger("irken.shard")
+
+def shard_of(conn_id, n_workers):
+    """The index of the worker that *conn_id* belongs to.
+
+    This is stable across processes and runs, unlike `hash` can be.
+
+    >>> shard_of("freenode", 4), shard_of("libera", 4)
+    (2, 3)
+    """
+    return (crc32(str(conn_id)) & 0xffffffff) % n_workers
+
+def connection_metrics(conn):
+    """What a worker reports about each of its connections."""
+    rv = {"nick": conn.nick}
+    if hasattr(conn, "lag_metrics"):
+        rv.update(conn.lag_metrics())
+    if hasattr(conn, "output_metrics"):
+        rv["output"] = conn.output_metrics()
+    return rv
+
+class Worker(object):
+    """The worker process's side: a set of connections and a pipe.
+
+    Connections whose socket fails, or that raise anything else, are
+    dropped and reported as dead, leaving the rest running; it's then up to
+    the supervisor to bring them back (by restarting us).
+    """
+
+    def __init__(self, index, pipe, factory, specs, heartbeat=1.0):
+        self.index = index
+        self.pipe = pipe
+        self.factory = factory
+        self.heartbeat = heartbeat
+        self.conns = {}
+        self.running = True
+        for conn_id, spec in specs.iteritems():
+            try:
+                self.conns[conn_id] = factory(conn_id, spec)
+            except Exception, e:
+                logger.exception("worker %d: creating %r failed", index,
+                                 conn_id)
+                self.report_dead(conn_id, e)
+
+    def report_dead(self, conn_id, exc):
+        self.pipe.send(("dead", self.index, conn_id, repr(exc)))
+
+    def drop(self, conn_id, exc):
+        conn = self.conns.pop(conn_id)
+        logger.warning("worker %d: connection %r lost: %s", self.index,
+                       conn_id, exc)
+        try:
+            conn.io.socket.close()
+        except Exception:
+            pass
+        self.report_dead(conn_id, exc)
+
+    def guard(self, conn_id, func, *args):
+        """Call *func* with *args* for connection *conn_id*, dropping the
+        connection if it raises."""
+        try:
+            func(*args)
+        except (IOError, EnvironmentError), e:
+            self.drop(conn_id, e)
+        except Exception, e:
+            logger.exception("worker %d: error in connection %r", self.index,
+                             conn_id)
+            self.drop(conn_id, e)
+
+    def send_heartbeat(self):
+        self.pipe.send(("heartbeat", self.index, time(), len(self.conns)))
+
+    def handle(self, msg):
+        kind = msg[0]
+        if kind == "send":
+            _, conn_id, command, args = msg
+            if conn_id is None:
+                targets = self.conns.items()
+            elif conn_id in self.conns:
+                targets = [(conn_id, self.conns[conn_id])]
+            else:
+                targets = []
+            for conn_id, conn in targets:
+                self.guard(conn_id, conn.send_cmd, None, command, args)
+        elif kind == "metrics":
+            metrics = dict((conn_id, connection_metrics(conn))
+                           for conn_id, conn in self.conns.iteritems())
+            self.pipe.send(("metrics", self.index, msg[1], metrics))
+        elif kind == "stop":
+            self.running = False
+        else:
+            logger.error("worker %d: unknown message %r", self.index, msg)
+
+    def run_once(self, timeout):
+        by_sock = dict((conn.io.socket, conn_id)
+                       for conn_id, conn in self.conns.iteritems())
+        for conn in self.conns.values():
+            timeout = conn.io.timer_timeout(timeout)
+        wlist = [sock for sock, conn_id in by_sock.iteritems()
+                 if self.conns[conn_id].io.buffered_bytes()]
+        r, w, _ = select(list(by_sock) + [self.pipe], wlist, [], timeout)
+        for sock in w:
+            conn_id = by_sock[sock]
+            self.guard(conn_id, self.conns[conn_id].io.write_buffered)
+        for conn_id, conn in self.conns.items():
+            if conn_id in self.conns:
+                self.guard(conn_id, conn.io.run_timers)
+        for obj in r:
+            if obj is self.pipe:
+                while self.running and self.pipe.poll():
+                    self.handle(self.pipe.recv())
+                continue
+            conn_id = by_sock[obj]
+            conn = self.conns.get(conn_id)
+            if conn is None:
+                continue
+            self.guard(conn_id, conn.io.receive, conn.consume)
+
+    def run(self):
+        next_beat = time()
+        while self.running:
+            now = time()
+            if now >= next_beat:
+                self.send_heartbeat()
+                next_beat = now + self.heartbeat
+            self.run_once(max(0.0, next_beat - now))
+
+def worker_main(index, pipe, factory, specs, heartbeat):
+    try:
+        Worker(index, pipe, factory, specs, heartbeat).run()
+    except (EOFError, KeyboardInterrupt):
+        # The supervisor went away, or we're being told to stop the hard way.
+        pass
+    finally:
+        pipe.close()
+
+class Supervisor(object):
+    """Runs connections sharded over *n_workers* processes.
+
+    *factory* is called in the worker process as ``factory(conn_id, spec)``
+    and should return a connected connection using a blocking socket io
+    such as `irken.io.SimpleSocketIO`. A worker that has sent no heartbeat
+    for *stale_after* seconds is considered hung and gets restarted.
+    """
+
+    heartbeat = 1.0
+    stale_after = 10.0
+
+    def __init__(self, factory, n_workers=None):
+        self.factory = factory
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.specs = {}
+        self.processes = {}
+        self.pipes = {}
+        self.health = {}
+        self._metrics = {}
+        self._metrics_token = 0
+
+    def add(self, conn_id, spec):
+        """Register a connection; it's started with its shard's worker."""
+        self.specs[conn_id] = spec
+
+    def shard_of(self, conn_id):
+        return shard_of(conn_id, self.n_workers)
+
+    def shard_specs(self, index):
+        return dict((conn_id, spec)
+                    for conn_id, spec in self.specs.iteritems()
+                    if self.shard_of(conn_id) == index)
+
+    def start(self):
+        for index in xrange(self.n_workers):
+            self.spawn(index)
+
+    def spawn(self, index):
+        ours, theirs = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=worker_main, name="irken-shard-%d" % (index,),
+            args=(index, theirs, self.factory, self.shard_specs(index),
+                  self.heartbeat))
+        proc.daemon = True
+        proc.start()
+        theirs.close()
+        self.processes[index] = proc
+        self.pipes[index] = ours
+        restarts = self.health[index]["restarts"] + 1 \
+            if index in self.health else 0
+        self.health[index] = {"pid": proc.pid, "started": time(),
+                              "last_beat": time(), "connections": 0,
+                              "dead": {}, "restarts": restarts}
+        logger.info("started shard %d as pid %d", index, proc.pid)
+
+    def restart(self, index):
+        """Stop and respawn worker *index*, leaving the others alone."""
+        proc, pipe = self.processes.pop(index), self.pipes.pop(index)
+        try:
+            pipe.send(("stop",))
+        except (IOError, EnvironmentError):
+            pass
+        proc.join(self.heartbeat * 2)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+        pipe.close()
+        self.spawn(index)
+
+    def stop(self):
+        for index in list(self.processes):
+            proc, pipe = self.processes.pop(index), self.pipes.pop(index)
+            try:
+                pipe.send(("stop",))
+            except (IOError, EnvironmentError):
+                pass
+            proc.join(self.heartbeat * 2)
+            if proc.is_alive():
+                proc.terminate()
+            pipe.close()
+
+    def _post(self, index, msg):
+        try:
+            self.pipes[index].send(msg)
+        except (IOError, EnvironmentError):
+            logger.warning("shard %d unreachable", index)
+
+    def broadcast(self, command, args):
+        """Send a command on every connection in every shard."""
+        for index in list(self.pipes):
+            self._post(index, ("send", None, command, tuple(args)))
+
+    def send_to(self, conn_id, command, args):
+        """Send a command on connection *conn_id*, wherever it runs."""
+        self._post(self.shard_of(conn_id),
+                   ("send", conn_id, command, tuple(args)))
+
+    def handle(self, msg):
+        kind, index = msg[0], msg[1]
+        health = self.health[index]
+        if kind == "heartbeat":
+            health["last_beat"] = time()
+            health["connections"] = msg[3]
+        elif kind == "dead":
+            health["dead"][msg[2]] = msg[3]
+        elif kind == "metrics":
+            if msg[2] == self._metrics_token:
+                self._metrics[index] = msg[3]
+        else:
+            logger.error("unknown message from shard %d: %r", index, msg)
+
+    def poll(self, timeout=0.0):
+        """Handle what workers have sent, waiting at most *timeout* seconds
+        for something to arrive, and restart the ones that died or hung."""
+        by_pipe = dict((pipe, index) for index, pipe in self.pipes.items())
+        r, _, _ = select(list(by_pipe), [], [], timeout)
+        for pipe in r:
+            index = by_pipe[pipe]
+            try:
+                while pipe.poll():
+                    self.handle(pipe.recv())
+            except (EOFError, IOError, EnvironmentError):
+                pass
+        self.check_workers()
+
+    def check_workers(self, now=None):
+        now = time() if now is None else now
+        for index, proc in self.processes.items():
+            if not proc.is_alive():
+                logger.error("shard %d died with exit code %s", index,
+                             proc.exitcode)
+                self.restart(index)
+            elif now - self.health[index]["last_beat"] > self.stale_after:
+                logger.error("shard %d hung; no heartbeat for %.1fs", index,
+                             now - self.health[index]["last_beat"])
+                self.restart(index)
+
+    def metrics(self, timeout=1.0):
+        """Collect per-connection metrics from every worker, as a dict of
+        connection id to metrics. Shards that don't answer within *timeout*
+        seconds are left out."""
+        self._metrics_token += 1
+        self._metrics = {}
+        for index in list(self.pipes):
+            self._post(index, ("metrics", self._metrics_token))
+        deadline = time() + timeout
+        while len(self._metrics) < len(self.pipes):
+            left = deadline - time()
+            if left <= 0:
+                break
+            self.poll(left)
+        rv = {}
+        for metrics in self._metrics.itervalues():
+            rv.update(metrics)
+        return rv
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -4,8 +4,10 @@ from irken.base import BaseConnection
 from irken.dispatch import CommonDispatchMixin, Command, handler
 from irken.encoding import EncodingMixin
 from irken.utils import AutoRegisterMixin
+from irken.pipeline import compose
+from irken.io import BaseIO
 
-class TestIO(object):
+class TestIO(BaseIO):
     def __init__(self):
         # TODO Should be using a deque.
         self.sent_lines = []
@@ -33,7 +35,7 @@ class TestMixin(object):
 
 bases = (AutoRegisterMixin, TestMixin, CommonDispatchMixin,
          EncodingMixin, BaseConnection)
-TestConnection = type("TestConnection", bases, {})
+TestConnection = compose("TestConnection", bases)
 
 class IrkenTestCase(unittest.TestCase):
     # I would name this "test_class", but unittest thinks it's a test function
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+from irken import analytics
+
+capture = """\
+@time=2012-01-01T00:00:01.500Z :alice!a@h PRIVMSG #Chan :hello there
+:srv 001 bot :Welcome
+1325376003.25 :bob!b@h NOTICE alice :psst
+:alice!a@h JOIN #chan
+PING :srv
+:bob!b@h PRIVMSG #chan :\xe5\xe4\xf6
+"""
+
+class AnalyticsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "capture.log")
+        with open(self.path, "wb") as fp:
+            # Enough copies to make several chunks.
+            fp.write(capture * 50)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, name):
+        return analytics.read_npy(os.path.join(self.tmp, "out", name))
+
+    def names(self, name):
+        with open(os.path.join(self.tmp, "out", name)) as fp:
+            return fp.read().splitlines()
+
+    def test_chunk_ranges(self):
+        ranges = analytics.chunk_ranges(self.path, 1000)
+        self.assertTrue(len(ranges) > 5)
+        self.assertEquals(ranges[0][0], 0)
+        self.assertEquals(ranges[-1][1], os.path.getsize(self.path))
+        with open(self.path, "rb") as fp:
+            data = fp.read()
+        for start, end in ranges:
+            self.assertEquals(data[end - 1], "\n")
+
+    def test_analyze(self):
+        rows = analytics.analyze([self.path], os.path.join(self.tmp, "out"),
+                                 processes=2, chunk_size=1000)
+        self.assertEquals(rows, 6 * 50)
+        commands = self.names("command.txt")
+        sources = self.names("source.txt")
+        targets = self.names("target.txt")
+        command = [commands[i] for i in self.read("command.npy")]
+        self.assertEquals(command[:6], ["PRIVMSG", "001", "NOTICE", "JOIN",
+                                        "PING", "PRIVMSG"])
+        self.assertEquals(sorted(set(command)),
+                          ["001", "JOIN", "NOTICE", "PING", "PRIVMSG"])
+        source = self.read("source.npy")
+        self.assertEquals([sources[i] if i >= 0 else None
+                           for i in source[:6]],
+                          ["alice", "srv", "bob", "alice", None, "bob"])
+        target = self.read("target.npy")
+        self.assertEquals([targets[i] if i >= 0 else None
+                           for i in target[:6]],
+                          ["#chan", None, "alice", "#chan", None, "#chan"])
+        times = self.read("time.npy")
+        self.assertEquals(times[0], 1325376001.5)
+        self.assertEquals(times[2], 1325376003.25)
+        self.assertTrue(times[1] != times[1])
+        offsets = self.read("text_offsets.npy")
+        self.assertEquals(len(offsets), rows + 1)
+        with open(os.path.join(self.tmp, "out", "text.bin"), "rb") as fp:
+            text = fp.read()
+        texts = [text[offsets[i]:offsets[i + 1]] for i in range(rows)]
+        self.assertEquals(texts[:6], ["hello there", "Welcome", "psst", "",
+                                      "", "\xe5\xe4\xf6"])
+        self.assertEquals(texts[6:12], texts[:6])
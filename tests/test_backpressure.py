@@ -0,0 +1,135 @@
+import socket
+from irken.backpressure import BackpressureMixin, BackpressureError
+from irken.dispatch import handler
+from irken.io import SimpleSocketIO, SelectIO
+from irken.tests import TestConnection, IrkenTestCase
+
+class StuckIO(SimpleSocketIO):
+    """Writes nothing until told to."""
+    stuck = True
+
+    def deliver(self, data):
+        self.out_buffer_segs.append(data)
+        if not self.stuck:
+            self.drain_output()
+        return self.out_buffer
+
+class BackpressureTest(BackpressureMixin, TestConnection):
+    make_io = StuckIO
+    high_water, low_water = 40, 10
+
+    def __init__(self, *args, **kwds):
+        super(BackpressureTest, self).__init__(*args, **kwds)
+        self.events = []
+
+    @handler("output paused", "output resumed")
+    def note_event(self, name, buffered):
+        self.events.append((str(name), buffered))
+
+class BackpressureTestCase(IrkenTestCase):
+    irken_cls = BackpressureTest
+
+    def setUp(self):
+        super(BackpressureTestCase, self).setUp()
+        ours, self.server = socket.socketpair()
+        self.conn.io.adopt_socket(ours)
+
+    def tearDown(self):
+        self.conn.io.socket.close()
+        self.server.close()
+
+    def test_drop_and_resume(self):
+        conn = self.conn
+        conn.backpressure_policy = "drop"
+        for i in range(5):
+            conn.send_cmd(None, "PRIVMSG", ("#a", "line %d" % (i,)))
+        self.assertTrue(conn.paused)
+        self.assertEquals(conn.events, [("output paused", 40)])
+        self.assertEquals(conn.dropped_lines, 3)
+        conn.send_cmd(None, "JOIN", ("#b",))
+        self.assertEquals(conn.buffered_bytes(), 49)
+        drained = []
+        conn.drain(lambda: drained.append(True))
+        self.assertEquals(drained, [])
+        self.assertTrue(conn.io.drain_output())
+        conn.consume(":srv NOTICE tester :hi\r\n")
+        self.assertFalse(conn.paused)
+        self.assertEquals(conn.events[-1], ("output resumed", 0))
+        self.assertEquals(drained, [True])
+        self.assertEquals(self.server.recv(100),
+                          "PRIVMSG #a :line 0\r\nPRIVMSG #a :line 1\r\n"
+                          "JOIN #b\r\n")
+
+    def test_resume_when_idle(self):
+        conn = self.conn
+        conn.backpressure_policy = "drop"
+        for i in range(3):
+            conn.send_cmd(None, "PRIVMSG", ("#a", "line %d" % (i,)))
+        self.assertTrue(conn.paused)
+        drained = []
+        conn.drain(lambda: drained.append(True))
+        # Nothing is read; the run loop's write alone resumes.
+        conn.io.write_buffered()
+        self.assertFalse(conn.paused)
+        self.assertEquals(drained, [True])
+        self.assertEquals(self.server.recv(100),
+                          "PRIVMSG #a :line 0\r\nPRIVMSG #a :line 1\r\n")
+
+    def test_block(self):
+        conn = self.conn
+        for i in range(4):
+            conn.send_cmd(None, "PRIVMSG", ("#a", "line %d" % (i,)))
+        # The third waited for the first two to be written.
+        self.assertEquals(conn.buffered_bytes(), 40)
+        self.assertEquals([name for name, n in conn.events],
+                          ["output paused", "output resumed"])
+
+    def test_disconnect(self):
+        conn = self.conn
+        conn.backpressure_policy = "disconnect"
+        for i in range(2):
+            conn.send_cmd(None, "PRIVMSG", ("#a", "line %d" % (i,)))
+        self.assertRaises(BackpressureError, conn.send_cmd,
+                          None, "PRIVMSG", ("#a", "line 2"))
+
+class SelectBackpressureTest(BackpressureTest):
+    make_io = SelectIO
+    high_water, low_water = 1 << 16, 1 << 12
+    backpressure_policy = "drop"
+
+class SelectBackpressureTestCase(IrkenTestCase):
+    irken_cls = SelectBackpressureTest
+
+    def setUp(self):
+        super(SelectBackpressureTestCase, self).setUp()
+        ours, self.server = socket.socketpair()
+        self.conn.io.adopt_socket(ours)
+
+    def tearDown(self):
+        self.conn.io.socket.close()
+        self.server.close()
+
+    def test_peer_not_reading(self):
+        conn = self.conn
+        line = "x" * 400
+        # Sending never blocks; once the socket's buffers are full, the rest
+        # piles up in io.
+        for i in xrange(20000):
+            conn.send_cmd(None, "PRIVMSG", ("#a", line))
+            if conn.paused:
+                break
+        self.assertTrue(conn.paused)
+        self.assertEquals(conn.events[0][0], "output paused")
+        self.assertTrue(conn.io.buffered_bytes() >= conn.high_water)
+        self.server.setblocking(0)
+        received = 0
+        for i in xrange(10000):
+            try:
+                received += len(self.server.recv(1 << 16))
+            except socket.error:
+                pass
+            conn.io.interact(consumer=conn.consume, timeout=0.01)
+            if not conn.paused:
+                break
+        self.assertFalse(conn.paused)
+        self.assertEquals(conn.events[-1][0], "output resumed")
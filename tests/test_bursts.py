@@ -0,0 +1,84 @@
+# coding: utf-8
+
+from irken.bursts import BurstMixin
+from irken.dispatch import handler
+from irken.tests import TestConnection, IrkenTestCase
+
+class BurstTest(BurstMixin, TestConnection):
+    dispatch_burst_lines = False
+
+    def __init__(self, *args, **kwds):
+        super(BurstTest, self).__init__(*args, **kwds)
+        self.events = []
+
+    @handler("names complete", "who complete")
+    def note_burst(self, name, *args):
+        self.events.append((name,) + args)
+
+    @handler("irc num 353", "irc num 352")
+    def note_line(self, cmd, *args):
+        self.events.append((cmd.command,))
+
+class BurstTestCase(IrkenTestCase):
+    irken_cls = BurstTest
+
+    def names_lines(self, channel, nicks, per_line=40):
+        for i in range(0, len(nicks), per_line):
+            yield ":srv 353 tester = %s :%s\r\n" % (
+                channel, " ".join(nicks[i:i + per_line]))
+        yield ":srv 366 tester %s :End of /NAMES list.\r\n" % (channel,)
+
+    def test_large_channel(self):
+        nicks = ["@op%d" % i for i in range(10)] + \
+                ["user%d" % i for i in range(20000)]
+        self.conn.consume("".join(self.names_lines("#big", nicks)))
+        (name, channel, members, userhosts), = self.conn.events
+        self.assertEquals((name, channel), ("names complete", "#big"))
+        self.assertEquals(len(members), 20010)
+        self.assertEquals(members["op3"], "@")
+        self.assertEquals(members["user19999"], "")
+        self.assertEquals(userhosts, {})
+
+    def test_nicks_interned(self):
+        lines = list(self.names_lines("#a", ["foo"])) + \
+                list(self.names_lines("#b", ["+foo"]))
+        self.conn.consume("".join(lines))
+        (_, _, a, _), (_, _, b, _) = self.conn.events
+        self.assertTrue(list(a)[0] is list(b)[0])
+
+    def test_prefix_from_isupport(self):
+        self.feed_lines(":srv 005 tester PREFIX=(qaohv)~&@%+ :are supported"
+                        "\r\n")
+        self.conn.consume("".join(self.names_lines("#a", ["~q", "&a", "%h"])))
+        members = self.conn.events[0][2]
+        self.assertEquals(members, {"q": "~", "a": "&", "h": "%"})
+
+    def test_who(self):
+        self.feed_lines(":srv 352 tester #a u1 h1 srv n1 H :0 Jöns\r\n",
+                        ":srv 352 tester #a u2 h2 srv n2 G :0 Two\r\n",
+                        ":srv 315 tester #a :End of /WHO list.\r\n")
+        (name, mask, rows), = self.conn.events
+        self.assertEquals(mask, "#a")
+        self.assertEquals(rows[0], ["#a", "u1", "h1", "srv", "n1", "H",
+                                    u"0 J\xf6ns"])
+        self.assertEquals(len(rows), 2)
+
+    def test_mixed_encodings(self):
+        self.conn.consume("".join(self.names_lines(
+            "#a", ["J\xf6ns", "@\xc3\xa5sa", "bo"])))
+        members = self.conn.events[0][2]
+        self.assertEquals(members, {u"J\xf6ns": "", u"\xe5sa": "@",
+                                    u"bo": ""})
+        self.feed_lines(":srv 352 tester #a u1 h1 srv n1 H :0 J\xf6ns\r\n",
+                        ":srv 352 tester #a u2 h2 srv n2 G :0 \xc3\xa5sa\r\n",
+                        ":srv 315 tester #a :End of /WHO list.\r\n")
+        rows = self.conn.events[1][2]
+        self.assertEquals([row[-1] for row in rows],
+                          [u"0 J\xf6ns", u"0 \xe5sa"])
+
+    def test_dispatch_burst_lines(self):
+        self.assertTrue(BurstMixin.dispatch_burst_lines)
+        self.conn.dispatch_burst_lines = True
+        self.conn.consume("".join(self.names_lines("#a", ["x", "y"])))
+        self.assertEquals([event[0] for event in self.conn.events],
+                          ["353", "names complete"])
@@ -0,0 +1,144 @@
+from irken.caps import CapabilityMixin
+from irken.dispatch import handler
+from irken.pipeline import compose
+from irken.tests import IrkenTestCase, TestConnection, bases
+
+class CapTest(CapabilityMixin, TestConnection):
+    def __init__(self, *args, **kwds):
+        super(CapTest, self).__init__(*args, **kwds)
+        self.events = []
+
+    @handler("irc cmd join")
+    def note_join(self, cmd, *args):
+        self.events.append(("join",) + args)
+
+    @handler("batch start")
+    def note_batch_start(self, name, *args):
+        self.events.append(("start",) + args)
+
+    @handler("batch end")
+    def note_batch_end(self, name, *args):
+        self.events.append(("end",) + args)
+
+# As in irken.Connection, registering comes first in the MRO, so that CAP LS
+# is sent before USER and NICK.
+RegisteringCapTest = compose("RegisteringCapTest",
+                             bases[:1] + (CapabilityMixin,) + bases[1:])
+
+class CapTestCase(IrkenTestCase):
+    irken_cls = CapTest
+
+    def negotiate(self, offered, acked):
+        self.conn.start_negotiation()
+        self.assert_sent("CAP LS 302\r\n")
+        self.feed_lines(":srv CAP * LS :%s\r\n" % (offered,))
+        if acked:
+            self.assert_sent("CAP REQ :%s\r\n" % (acked,))
+            self.feed_lines(":srv CAP * ACK :%s\r\n" % (acked,))
+        self.assert_sent("CAP END\r\n")
+
+class NegotiationTestCase(CapTestCase):
+    def test_cap_ls_before_registering(self):
+        conn = RegisteringCapTest("tester", autoregister=("u", "Real"))
+        conn.connect(("irc.example.org", 6667))
+        sent = conn.io.sent_lines
+        self.assertEquals(sent[0], "CAP LS 302\r\n")
+        self.assertEquals([line.split()[0] for line in sent[1:]],
+                          ["USER", "NICK"])
+
+    def test_reconnect_negotiates_again(self):
+        conn = RegisteringCapTest("tester", autoregister=("u", "Real"))
+        for i in range(2):
+            conn.connect(("irc.example.org", 6667))
+            self.assertEquals(conn.io.sent_lines[0], "CAP LS 302\r\n")
+            del conn.io.sent_lines[:]
+            conn.consume(":srv CAP * LS :batch\r\n")
+            self.assertEquals(conn.io.sent_lines, ["CAP REQ batch\r\n"])
+            del conn.io.sent_lines[:]
+            conn.consume(":srv CAP * ACK :batch\r\n")
+            self.assertEquals(conn.io.sent_lines, ["CAP END\r\n"])
+            del conn.io.sent_lines[:]
+            conn.consume(":srv 001 tester :Welcome\r\n")
+            self.assertEquals(conn.caps, {"batch": None})
+
+    def test_multiline_ls(self):
+        self.conn.start_negotiation()
+        self.assert_sent("CAP LS 302\r\n")
+        self.feed_lines(":srv CAP * LS * :sasl=PLAIN batch\r\n")
+        self.assertEquals(self.conn.io.sent_lines, [])
+        self.feed_lines(":srv CAP * LS :away-notify tls\r\n")
+        self.assert_sent("CAP REQ :away-notify batch\r\n")
+        self.assertEquals(self.conn.available_caps["sasl"], "PLAIN")
+        self.feed_lines(":srv CAP * NAK :away-notify batch\r\n")
+        self.assert_sent("CAP END\r\n")
+        self.assertEquals(self.conn.caps, {})
+
+    def test_nothing_wanted(self):
+        self.negotiate("sasl tls", None)
+
+    def test_new_and_del(self):
+        self.negotiate("batch multi-prefix", "multi-prefix batch")
+        self.feed_lines(":srv CAP tester NEW :away-notify\r\n")
+        self.assert_sent("CAP REQ away-notify\r\n")
+        self.feed_lines(":srv CAP tester ACK :away-notify\r\n")
+        # Registered already, so no CAP END.
+        self.assertEquals(self.conn.io.sent_lines, [])
+        self.feed_lines(":srv CAP tester DEL :batch\r\n")
+        self.assertEquals(sorted(self.conn.caps),
+                          ["away-notify", "multi-prefix"])
+
+    def test_req_split(self):
+        self.conn.wanted_caps = tuple("cap-%03d" % (i,) for i in range(100))
+        self.conn.start_negotiation()
+        self.conn.io.sent_lines = []
+        self.feed_lines(":srv CAP * LS :%s\r\n" %
+                        (" ".join(self.conn.wanted_caps),))
+        lines = self.conn.io.sent_lines
+        self.assertTrue(len(lines) > 1)
+        self.assertTrue(all(len(line) <= 512 for line in lines))
+        self.conn.io.sent_lines = []
+
+class CapabilityTestCase(CapTestCase):
+    def setUp(self):
+        super(CapabilityTestCase, self).setUp()
+        self.negotiate("extended-join account-notify away-notify "
+                       "userhost-in-names batch",
+                       "userhost-in-names extended-join away-notify "
+                       "account-notify batch")
+
+    def source(self, nick):
+        return self.conn.lookup_prefix((nick,))
+
+    def test_extended_join(self):
+        self.feed_lines(":a!u@h JOIN #chan acct :Some One\r\n",
+                        ":b!u@h JOIN #chan * :No Account\r\n")
+        self.assertEquals(self.conn.events,
+                          [("join", "#chan"), ("join", "#chan")])
+        self.assertEquals(self.source("a").account, "acct")
+        self.assertEquals(self.source("a").realname, "Some One")
+        self.assertEquals(self.source("b").account, None)
+
+    def test_account_and_away(self):
+        self.feed_lines(":a!u@h ACCOUNT acct\r\n",
+                        ":a!u@h AWAY :gone fishing\r\n")
+        self.assertEquals(self.source("a").account, "acct")
+        self.assertEquals(self.source("a").away, "gone fishing")
+        self.feed_lines(":a!u@h ACCOUNT *\r\n", ":a!u@h AWAY\r\n")
+        self.assertEquals(self.source("a").account, None)
+        self.assertEquals(self.source("a").away, None)
+
+    def test_userhost_in_names(self):
+        self.feed_lines(":srv 353 tester = #chan :@a!ua@ha +b!ub@hb "
+                        "tester!t@h\r\n",
+                        ":srv 366 tester #chan :End of /NAMES list.\r\n")
+        self.assertEquals(tuple(self.source("a").mask), ("a", "ua", "ha"))
+        self.assertEquals(tuple(self.source("b").mask), ("b", "ub", "hb"))
+
+    def test_batch(self):
+        self.feed_lines(":srv BATCH +abc netsplit a.srv b.srv\r\n",
+                        "@batch=abc :a!u@h QUIT :a.srv b.srv\r\n",
+                        ":srv BATCH -abc\r\n")
+        self.assertEquals(self.conn.events, [
+            ("start", "abc", "netsplit", "a.srv", "b.srv"),
+            ("end", "abc", "netsplit", "a.srv", "b.srv")])
+        self.assertEquals(self.conn.batches, {})
@@ -0,0 +1,75 @@
+import irken
+from irken.coalesce import CoalescingMixin
+from irken.tests import TestConnection, TestMixin, IrkenTestCase
+
+class CoalesceTest(CoalescingMixin, TestConnection):
+    pass
+
+class CoalesceTestCase(IrkenTestCase):
+    irken_cls = CoalesceTest
+
+    def test_isupport_targmax(self):
+        self.conn.consume(":srv 005 tester TARGMAX=PRIVMSG:2,NOTICE:2 "
+                          ":are supported by this server\r\n")
+        self.assertEquals(self.conn.max_targets("NOTICE"), 2)
+        with self.conn.coalesce():
+            for chan in ("#a", "#b", "#c", "#a"):
+                self.conn.send_cmd(None, "NOTICE", (chan, u"hi"))
+        self.assert_sent("NOTICE #a,#b hi\r\nNOTICE #c hi\r\n"
+                         "NOTICE #a hi\r\n")
+
+    def test_order_kept(self):
+        self.conn.isupport["TARGMAX"] = "PRIVMSG:"
+        with self.conn.coalesce():
+            self.conn.send_cmd(None, "PRIVMSG", ("#x", "second"))
+            self.conn.send_cmd(None, "PART", ("#x",))
+            self.conn.send_cmd(None, "PRIVMSG", ("#y", "first"))
+            self.conn.send_cmd(None, "PRIVMSG", ("#x", "first"))
+            self.conn.send_cmd(None, "PRIVMSG", ("#x", "second"))
+            self.conn.send_cmd(None, "PRIVMSG", ("#y", "second"))
+            self.conn.send_cmd(None, "PRIVMSG", ("#x", "second"))
+        sent, self.conn.io.sent_lines = self.conn.io.sent_lines, []
+        self.assertEquals("".join(sent).split("\r\n"), [
+            "PRIVMSG #x second", "PART #x", "PRIVMSG #y,#x first",
+            "PRIVMSG #x,#y second", "PRIVMSG #x second", ""])
+
+    def test_passthrough_outside_block(self):
+        self.conn.isupport["MAXTARGETS"] = "4"
+        self.conn.send_cmd(None, "PRIVMSG", ("#a", "x"))
+        self.conn.send_cmd(None, "PRIVMSG", ("#b", "x"))
+        self.assert_sent("PRIVMSG #a x\r\n")
+        self.assert_sent("PRIVMSG #b x\r\n")
+
+    def test_no_support_no_merge(self):
+        with self.conn.coalesce():
+            self.conn.send_cmd(None, "PRIVMSG", ("#a", "x"))
+            self.conn.send_cmd(None, "PRIVMSG", ("#b", "x"))
+        self.assert_sent("PRIVMSG #a x\r\nPRIVMSG #b x\r\n")
+
+    def test_line_limit(self):
+        self.conn.isupport["TARGMAX"] = "PRIVMSG:"
+        text = "x" * 480
+        chans = ["#chan%02d" % i for i in range(10)]
+        with self.conn.coalesce():
+            for chan in chans:
+                self.conn.send_cmd(None, "PRIVMSG", (chan, text))
+        lines = self.conn.io.sent_lines.pop().split("\r\n")[:-1]
+        self.assertTrue(all(len(line) + 2 <= 512 for line in lines))
+        targets = ",".join(line.split(" ")[1] for line in lines)
+        self.assertEquals(targets.split(","), chans)
+
+class ComposedCoalesceTestCase(IrkenTestCase):
+    def setUp(self):
+        cls = type("ComposedTest", (TestMixin, irken.Connection), {})
+        self.conn = cls("tester", autoregister=("u", "r"))
+        self.conn.isupport["TARGMAX"] = "PRIVMSG:"
+
+    def test_tagged_not_merged(self):
+        with self.conn.coalesce():
+            self.conn.send_cmd(None, "PRIVMSG", ("#a", "hi"),
+                               tags={"+draft/reply": "abc"})
+            self.conn.send_cmd(None, "PRIVMSG", ("#b", "hi"))
+            self.conn.send_cmd(None, "PRIVMSG", ("#c", "hi"))
+        self.assertEquals("".join(self.conn.io.sent_lines).split("\r\n"), [
+            "@+draft/reply=abc PRIVMSG #a hi", "PRIVMSG #b,#c hi", ""])
+        self.conn.io.sent_lines = []
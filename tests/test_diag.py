@@ -0,0 +1,73 @@
+from irken import diag
+from irken.tests import TestConnection, IrkenTestCase
+
+class DiagTest(diag.DiagnosticsMixin, TestConnection):
+    diag_history = 3
+
+class DiagTestCase(IrkenTestCase):
+    irken_cls = DiagTest
+
+    def test_usage(self):
+        usage = diag.memory_usage(self.conn)
+        self.assertEquals(sorted(usage),
+                          ["buffers", "dispatch", "prefix_cache", "timers"])
+        self.assertEquals(usage["prefix_cache"], (0, usage["prefix_cache"][1]))
+        self.conn.autoflush = False
+        self.conn.send_cmd(None, "PING", ("x",))
+        self.assertEquals(diag.memory_usage(self.conn)["buffers"], (1, 8))
+        self.conn.protocol.data_to_send()
+
+    def test_user_attributes_count(self):
+        src = self.conn.lookup_prefix(("friend",))
+        before = diag.memory_usage(self.conn)["prefix_cache"][1]
+        # Like the example bot, referring back to the connection, which
+        # mustn't be counted.
+        src.msg_counts = dict((("#c%d" % i), i) for i in range(100))
+        src.msg_counts[self.conn] = 1
+        after = diag.memory_usage(self.conn)["prefix_cache"][1]
+        self.assertTrue(after - before > 100 * 20)
+        self.assertTrue(after - before < 100 * 200)
+
+    def test_growth_warning(self):
+        conn = self.conn
+        for i in range(3):
+            for j in range(10):
+                conn.lookup_prefix(("n%d-%d" % (i, j),))
+            conn.sample_memory()
+        growing = conn.memory_history.growing()
+        self.assertEquals(growing.keys(), ["prefix_cache"])
+        report = conn.memory_report(objects=True)
+        self.assertTrue("growing: prefix_cache" in report)
+        self.assertTrue("RemoteSource" in report)
+
+    def test_sampled_on_consume(self):
+        self.conn._next_diag = 0
+        self.conn.consume(":a!b@c PRIVMSG tester :hi\r\n")
+        self.assertEquals(len(self.conn.memory_history.samples), 1)
+        self.conn.consume(":a!b@c PRIVMSG tester :hi\r\n")
+        self.assertEquals(len(self.conn.memory_history.samples), 1)
+
+    def test_sampled(self):
+        for i in range(100):
+            src = self.conn.lookup_prefix(("n%d" % (i,),))
+            src.notes = "x" * 50
+        full = diag.memory_usage(self.conn)["prefix_cache"]
+        sampled = diag.memory_usage(self.conn, 10)["prefix_cache"]
+        self.assertEquals(sampled[0], full[0])
+        self.assertTrue(abs(sampled[1] - full[1]) < full[1] // 5)
+
+    def test_dump_signal(self):
+        import os
+        import signal
+        prev = signal.getsignal(signal.SIGUSR1)
+        try:
+            diag.install_dump_signal([self.conn])
+            os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+            signal.signal(signal.SIGUSR1, prev)
+        self.assertTrue(self.conn.dump_requested)
+        reports = []
+        self.conn.memory_report = lambda objects=False: reports.append(objects)
+        self.conn.timers.advance(self.conn.timers.next_deadline())
+        self.assertEquals(reports, [True])
+        self.assertFalse(self.conn.dump_requested)
@@ -1,4 +1,4 @@
-from irken.dispatch import Command, handler
+from irken.dispatch import Command, handler, STOP
 from irken.tests import TestConnection, IrkenTestCase
 
 class DispatchingTest(TestConnection):
@@ -32,3 +32,146 @@ class DispatchingTestCase(IrkenTestCase):
         self.assertEquals(self.conn.called,
             [(1, cmd, "foo", "bar"),
              (2, cmd, "foo", "bar")])
+
+class PipelineTestCase(IrkenTestCase):
+    def test_connection_is_flattened(self):
+        import irken
+        from irken.dispatch import BaseDispatchMixin
+        from irken.base import BaseConnection
+        recv = irken.Connection.recv_cmd.im_func
+        send = irken.Connection.send_cmd.im_func
+        self.assertEquals(recv.stages, ("decode_cmd", "caps_cmd"))
+        self.assertTrue(recv.terminal is
+                        vars(BaseDispatchMixin)["recv_cmd"])
+        self.assertEquals(send.stages, ("encode_cmd", "coalesce_cmd",
+                                       "backpressure_cmd"))
+        self.assertTrue(send.terminal is vars(BaseConnection)["send_cmd"])
+
+    def test_subclass_overrides_transform(self):
+        import irken
+        from irken.tests import TestMixin
+        class Shouting(TestMixin, irken.Connection):
+            def encode_cmd(self, prefix, command, args):
+                rv = super(Shouting, self).encode_cmd(prefix, command, args)
+                return rv[0], rv[1], [arg.upper() for arg in rv[2]]
+        conn = Shouting("tester", autoregister=("u", "r"))
+        conn.send_cmd(None, "PRIVMSG", (u"#chan", u"hello"))
+        self.assertEquals(conn.io.sent_lines, ["PRIVMSG #CHAN HELLO\r\n"])
+
+class EventTestCase(IrkenTestCase):
+    def test_event_per_line(self):
+        events = []
+        self.conn.evtable["irc cmd privmsg"] = ["note_event"]
+        self.conn.note_event = lambda cmd, *args: events.append(cmd)
+        self.conn.consume(":nick!u@h PRIVMSG #chan :hello\r\n")
+        event, = events
+        self.assertEquals(event, "irc cmd PRIVMSG")
+        self.assertEquals(event[8:], "PRIVMSG")
+        self.assertEquals(event.command, "PRIVMSG")
+        self.assertEquals(event.args, ["#chan", "hello"])
+        self.assertTrue(event.source is self.conn.lookup_prefix(("nick",)))
+
+class CTCPTestCase(IrkenTestCase):
+    def setUp(self):
+        import irken
+        from irken.tests import TestMixin
+        cls = type("CTCPTest", (TestMixin, irken.Connection), {})
+        self.conn = cls("tester", autoregister=("u", "r"))
+
+    def test_version_reply(self):
+        self.conn.consume(":nick!u@h PRIVMSG tester :\x01VERSION\x01\r\n")
+        self.assert_sent("notice nick :\x01version irken\x01\r\n")
+
+class PriorityTest(DispatchingTest):
+    ignored = ("spammer",)
+
+    @handler("irc cmd privmsg", priority=10)
+    def drop_ignored(self, cmd, target, text):
+        self.called.append((0, cmd, target, text))
+        if cmd.source.nick in self.ignored:
+            return STOP
+
+    @handler("irc cmd privmsg", priority=-1)
+    def do_last(self, cmd, target, text):
+        self.called.append((3, cmd, target, text))
+
+class PriorityTestCase(IrkenTestCase):
+    irken_cls = PriorityTest
+
+    def test_order(self):
+        self.conn.consume(":friend!u@h PRIVMSG #chan :hi\r\n")
+        self.assertEquals([c[0] for c in self.conn.called], [0, 1, 2, 3])
+
+    def test_stop(self):
+        self.conn.consume(":spammer!u@h PRIVMSG #chan :buy\r\n")
+        self.assertEquals([c[0] for c in self.conn.called], [0])
+
+class PatternTest(DispatchingTest):
+    @handler("irc num 4*")
+    def on_error_numeric(self, cmd, *args):
+        self.called.append(("4xx", cmd.command))
+
+    @handler("ctcp message *", priority=5)
+    def on_any_ctcp(self, cmd, *args):
+        self.called.append(("ctcp", cmd.command))
+
+class PatternTestCase(IrkenTestCase):
+    irken_cls = PatternTest
+
+    def test_numeric_glob(self):
+        self.conn.consume(":srv 433 * tester :Nickname is already in use\r\n")
+        self.conn.consume(":srv 001 tester :Welcome\r\n")
+        self.assertEquals(self.conn.called, [("4xx", "433")])
+
+    def test_cached(self):
+        self.conn.consume(":srv 401 tester x :No such nick\r\n")
+        merged = self.conn._pattern_cache["irc num 401"][-1]
+        self.assertEquals(merged, ("on_error_numeric",))
+        self.conn.consume(":srv 401 tester y :No such nick\r\n")
+        self.assertTrue(self.conn._pattern_cache["irc num 401"][-1] is merged)
+        self.assertEquals(self.conn._pattern_cache.get("irc cmd privmsg"),
+                          None)
+
+    def test_cache_sees_evtable_changes(self):
+        self.conn.consume(":srv 401 tester x :No such nick\r\n")
+        self.conn.evtable["irc num 401"] = ["on_any_ctcp"]
+        self.assertEquals(list(self.conn.handlers_for("irc num 401")),
+                          [self.conn.on_any_ctcp, self.conn.on_error_numeric])
+
+    def test_instance_patterns(self):
+        conn = PatternTest("x", autoregister=("u", "r"),
+                           evtable={"irc num 00*": ["on_error_numeric"]})
+        conn.consume(":srv 001 x :Welcome\r\n")
+        self.assertEquals(conn.called, [("4xx", "001")])
+        self.assertTrue(PatternTest.pattern_trie is not conn.pattern_trie)
+
+class ComposedDispatchTestCase(IrkenTestCase):
+    def setUp(self):
+        import irken
+        from irken.tests import TestMixin
+        class Composed(TestMixin, irken.Connection):
+            @handler("batch start", "batch end")
+            def note_batch(self, name, *args):
+                self.called.append((name,) + args)
+        self.conn = Composed("tester", autoregister=("u", "r"))
+        self.conn.called = []
+
+    def test_handlers_once(self):
+        for handler_attrs in self.conn.evtable.itervalues():
+            self.assertEquals(len(handler_attrs), len(set(handler_attrs)))
+        self.conn.consume(":srv BATCH +abc netsplit a.srv b.srv\r\n"
+                          ":srv BATCH -abc\r\n")
+        self.assertEquals(self.conn.called, [
+            ("batch start", "abc", "netsplit", "a.srv", "b.srv"),
+            ("batch end", "abc", "netsplit", "a.srv", "b.srv")])
+
+class EventStringTestCase(IrkenTestCase):
+    def test_string_operators(self):
+        from irken.dispatch import Event
+        ev = Event(u"irc cmd PRIVMSG", "irc cmd privmsg", "PRIVMSG", None)
+        self.assertEquals(ev + u"!", u"irc cmd PRIVMSG!")
+        self.assertEquals(u"<" + ev, u"<irc cmd PRIVMSG")
+        self.assertEquals(u"%s" % (ev,), u"irc cmd PRIVMSG")
+        self.assertEquals(list(ev)[:3], list(u"irc"))
+        self.assertTrue(ev < u"irc cmd QUIT")
+        self.assertEquals(sorted([u"irc cmd QUIT", ev])[0], ev)
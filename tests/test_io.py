@@ -1,7 +1,20 @@
 # coding: utf-8
 
+import os
+import ssl
+import random
+import shutil
+import socket
+import asyncore
+import hashlib
+import tempfile
+import threading
+import subprocess
+import unittest
 from irken.nicks import Mask
 from irken.tests import IrkenTestCase
+from irken.io import ConnectRace, SimpleSocketIO, AsyncoreIO, TimingWheel
+from irken.io import FingerprintError
 
 class IOTestCase(IrkenTestCase):
     def test_autoregister_connect(self):
@@ -37,3 +50,277 @@ class IOTestCase(IrkenTestCase):
                          "\xc3\xb6n \xc3\xb6var \xc3\xb6rn\xc3\xa5sk"
                          "\xc3\xa5dning.\r\n")
         # TODO Test input, that is, UTF-8 -> unicode object.
+
+class ConnectRaceTestCase(IrkenTestCase):
+    def setUp(self):
+        super(ConnectRaceTestCase, self).setUp()
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(5)
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        self.closed_addr = closed.getsockname()
+        closed.close()
+
+    def tearDown(self):
+        self.server.close()
+        super(ConnectRaceTestCase, self).tearDown()
+
+    def addrinfo(self, *addrs):
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", addr)
+                for addr in addrs]
+
+    def test_falls_through_refused(self):
+        good = self.server.getsockname()
+        race = ConnectRace(self.addrinfo(self.closed_addr, good), delay=5.0)
+        sock, addr = race.run(timeout=5.0)
+        self.assertEquals(addr, good)
+        self.assertEquals(race.errors[0][0], self.closed_addr)
+        sock.close()
+
+    def test_all_refused(self):
+        race = ConnectRace(self.addrinfo(self.closed_addr), delay=0.01)
+        self.assertRaises(socket.error, race.run, 5.0)
+
+    def test_blocking_io(self):
+        io = SimpleSocketIO()
+        addr = io.connect(self.server.getsockname())
+        self.assertEquals(addr, self.server.getsockname())
+        peer, _ = self.server.accept()
+        io.deliver("PING x\r\n")
+        self.assertEquals(peer.recv(100), "PING x\r\n")
+        peer.close()
+        io.socket.close()
+
+    def test_asyncore_io(self):
+        io = AsyncoreIO()
+        io.connect(self.server.getsockname())
+        io.deliver("PING x\r\n")
+        while io.race is not None or io.producer_fifo:
+            io.run_once(count=1, timeout=1.0)
+        peer, _ = self.server.accept()
+        self.assertEquals(peer.recv(100), "PING x\r\n")
+        peer.close()
+        io.close()
+        self.assertEquals(asyncore.socket_map, {})
+
+    def test_asyncore_falls_through_refused(self):
+        good = self.server.getsockname()
+        io = AsyncoreIO()
+        race = io.run_race(ConnectRace(self.addrinfo(self.closed_addr, good),
+                                       delay=5.0))
+        for i in range(50):
+            if io.race is None:
+                break
+            io.run_once(count=1, timeout=0.1)
+        self.assertEquals(io.race, None)
+        self.assertTrue(io.connected)
+        self.assertEquals(race.winner[1], good)
+        self.assertEquals(race.errors[0][0], self.closed_addr)
+        peer, _ = self.server.accept()
+        peer.close()
+        io.close()
+        self.assertEquals(asyncore.socket_map, {})
+
+def make_cert(directory):
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    with open(os.devnull, "w") as null:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey",
+                               "rsa:2048", "-nodes", "-days", "1",
+                               "-subj", "/CN=localhost",
+                               "-keyout", key, "-out", cert],
+                              stdout=null, stderr=null)
+    return cert, key
+
+def have_openssl():
+    try:
+        with open(os.devnull, "w") as null:
+            subprocess.check_call(["openssl", "version"], stdout=null)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+@unittest.skipUnless(have_openssl(), "needs the openssl command")
+class TLSTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.cert, cls.key = make_cert(cls.tmp)
+        with open(cls.cert) as fp:
+            der = ssl.PEM_cert_to_DER_cert(fp.read())
+        cls.fingerprint = ":".join("%02X" % ord(c)
+                                   for c in hashlib.sha256(der).digest())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(5)
+        self.received = []
+
+    def tearDown(self):
+        self.server.close()
+
+    def serve(self):
+        """Accept one TLS client in a thread, greet it, and keep one line
+        it sends in *received*."""
+        def run():
+            sock, _ = self.server.accept()
+            sock.settimeout(5)
+            try:
+                tls = ssl.wrap_socket(sock, server_side=True,
+                                      certfile=self.cert, keyfile=self.key)
+                tls.sendall(":srv NOTICE * :hello\r\n")
+                self.received.append(tls.recv(100))
+                tls.close()
+            except (ssl.SSLError, socket.error):
+                # The client gave up on us, as it should have.
+                sock.close()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_pinned(self):
+        thread = self.serve()
+        io = SimpleSocketIO()
+        io.tls, io.tls_fingerprint = True, self.fingerprint
+        io.connect(self.server.getsockname())
+        self.assertTrue(isinstance(io.socket, ssl.SSLSocket))
+        got = []
+        io.receive(lambda data: got.append(data) or "")
+        self.assertEquals(got, [":srv NOTICE * :hello\r\n"])
+        io.deliver("PING x\r\n")
+        thread.join(5)
+        self.assertEquals(self.received, ["PING x\r\n"])
+        io.socket.close()
+
+    def test_pin_mismatch(self):
+        thread = self.serve()
+        io = SimpleSocketIO()
+        io.tls, io.tls_fingerprint = True, "00" * 32
+        self.assertRaises(FingerprintError, io.connect,
+                          self.server.getsockname())
+        thread.join(5)
+
+    def test_unverified_is_refused(self):
+        thread = self.serve()
+        io = SimpleSocketIO()
+        io.tls = True
+        self.assertRaises(ssl.SSLError, io.connect,
+                          self.server.getsockname())
+        thread.join(5)
+
+    def test_asyncore_handshake(self):
+        thread = self.serve()
+        got = []
+        io = AsyncoreIO(consumer=got.append)
+        io.tls, io.tls_fingerprint = True, self.fingerprint
+        io.connect(self.server.getsockname())
+        io.deliver("PING y\r\n")
+        for i in range(100):
+            if got and not io.producer_fifo:
+                break
+            io.run_once(count=1, timeout=0.1)
+        self.assertEquals(io.handshake, None)
+        self.assertTrue(io.connected)
+        self.assertEquals("".join(got), ":srv NOTICE * :hello\r\n")
+        thread.join(5)
+        self.assertEquals(self.received, ["PING y\r\n"])
+        io.close()
+
+class TimingWheelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimingWheel(resolution=0.01, levels=3, now=0)
+        self.calls = []
+
+    def test_matches_sorted_order(self):
+        rand = random.Random(4)
+        deadlines = [rand.uniform(0, 3000) for i in range(2000)]
+        timers = [self.wheel.call_at(when, self.calls.append, when)
+                  for when in deadlines]
+        cancelled = set(rand.sample(range(len(timers)), 500))
+        for i in cancelled:
+            timers[i].cancel()
+        expected = sorted(when for i, when in enumerate(deadlines)
+                          if i not in cancelled)
+        now = 0.0
+        while self.wheel:
+            deadline = self.wheel.next_deadline()
+            self.assertTrue(deadline >= now)
+            now = deadline
+            before = len(self.calls)
+            self.assertTrue(self.wheel.advance(now) > 0)
+            # Everything run was due, and nothing due was left.
+            self.assertTrue(all(when <= now for when in
+                                self.calls[before:]))
+        self.assertEquals(sorted(self.calls), expected)
+        # Each at its tick, so in order but for timers sharing a tick.
+        self.assertEquals([int(when * 100) for when in self.calls],
+                          [int(when * 100) for when in expected])
+
+    def test_next_deadline_beyond_reach(self):
+        # Two levels of 64 ticks of a second reach 4096 seconds; the rest
+        # overflow, and are put in the wheel as time goes by.
+        for seed in range(50):
+            rand = random.Random(seed)
+            wheel = TimingWheel(resolution=1.0, levels=2, now=0)
+            left = []
+            def add(when):
+                left.append(when)
+                wheel.call_at(when, left.remove, when)
+            for i in range(30):
+                add(rand.randrange(1, 20000))
+            while wheel:
+                self.assertEquals(wheel.next_deadline(), min(left))
+                now = min(left) + rand.choice((0, 0, rand.randrange(5000)))
+                wheel.advance(now)
+                self.assertTrue(all(when > now for when in left))
+                if rand.random() < 0.3:
+                    add(now + rand.randrange(1, 20000))
+            self.assertEquals(left, [])
+
+    def test_beyond_reach(self):
+        # Three levels of 64 ticks of 10ms reach about 43 minutes.
+        self.wheel.call_at(86400.0, self.calls.append, "day")
+        self.assertEquals(self.wheel.advance(3600.0), 0)
+        self.assertEquals(self.wheel.next_deadline(), 86400.0)
+        self.assertEquals(self.wheel.advance(86400.0), 1)
+
+    def test_scheduling_from_callbacks(self):
+        def again(n):
+            self.calls.append(n)
+            if n:
+                self.wheel.call_at(0, again, n - 1)
+        self.wheel.call_at(1.0, again, 3)
+        # What's overdue when scheduled is run from the next tick on, with
+        # no waiting for it.
+        self.assertEquals(self.wheel.advance(1.0), 1)
+        self.assertEquals(self.wheel.timeout(now=1.0), 0.0)
+        self.assertEquals(self.wheel.advance(1.05), 3)
+        self.assertEquals(self.calls, [3, 2, 1, 0])
+
+    def test_cancel_from_callback(self):
+        later = self.wheel.call_at(1.0, self.calls.append, "later")
+        self.wheel.call_at(1.0, lambda: later.cancel())
+        self.wheel.call_at(1.0, lambda: later.cancel())
+        self.wheel.advance(1.0)
+        self.assertTrue(self.calls in ([], ["later"]))
+        self.assertEquals(len(self.wheel), 0)
+
+    def test_error_keeps_the_rest(self):
+        def fail():
+            raise ValueError("boom")
+        for i in range(5):
+            self.wheel.call_at(1.0, self.calls.append, i)
+        self.wheel.call_at(1.0, fail)
+        try:
+            self.wheel.advance(1.0)
+        except ValueError:
+            pass
+        self.wheel.advance(1.0)
+        self.assertEquals(sorted(self.calls), range(5))
@@ -0,0 +1,70 @@
+from irken.lag import LagMixin, LagError
+from irken.tests import TestConnection, IrkenTestCase
+
+class LagTest(LagMixin, TestConnection):
+    pass
+
+class LagTestCase(IrkenTestCase):
+    irken_cls = LagTest
+
+    def test_no_pings_before_welcome(self):
+        self.conn.consume(":srv PING :x\r\n")
+        self.assert_sent("PONG x\r\n")
+        self.assertFalse(self.conn._lag_pings)
+
+    def test_ping_pong_rtt(self):
+        self.conn.consume(":srv 001 tester :Welcome\r\n")
+        line = self.conn.io.sent_lines.pop(0)
+        self.assertTrue(line.startswith("PING irken-lag-"))
+        token = line[5:-2]
+        self.conn.consume(":srv PONG srv :%s\r\n" % (token,))
+        self.assertEquals(self.conn.rtt.count, 1)
+        self.assertFalse(self.conn._lag_pings)
+        metrics = self.conn.lag_metrics()
+        self.assertEquals(metrics["pending_pings"], 0)
+        self.assertEquals(metrics["dispatch"]["count"], 2)
+
+    def test_unknown_pong_ignored(self):
+        self.conn.consume(":srv PONG srv :whatever\r\n")
+        self.assertEquals(self.conn.rtt.count, 0)
+
+    def test_threshold_reconnect(self):
+        self.conn.lag_threshold = 5.0
+        self.conn.lag_reconnect = True
+        self.conn.lag_interval = float("inf")
+        self.conn.send_lag_ping(now=0.0)
+        self.conn.io.sent_lines.pop(0)
+        self.assertRaises(LagError, self.conn.check_lag)
+        # Once per time it goes over.
+        self.conn.check_lag()
+
+    def test_reconnect_after_lag_error(self):
+        self.conn.lag_threshold = 5.0
+        self.conn.lag_reconnect = True
+        self.conn.send_lag_ping(now=0.0)
+        self.conn.io.sent_lines.pop(0)
+        self.assertRaises(LagError, self.conn.check_lag)
+        self.conn.connect(("irc.example.org", 6667))
+        del self.conn.io.sent_lines[:]
+        self.conn.consume(":srv NOTICE * :*** Looking up your hostname\r\n")
+        self.assertEquals(self.conn.lag, None)
+        self.assertEquals(self.conn.dispatch_lag.count, 1)
+
+    def test_pings_from_timer(self):
+        from time import time
+        self.conn.consume(":srv 001 tester :Welcome\r\n")
+        self.conn.io.sent_lines.pop(0)
+        self.assertEquals(len(self.conn.timers), 1)
+        self.conn._next_lag_ping = time()
+        self.conn.timers.advance(time() + 1.0)
+        self.assertTrue(self.conn.io.sent_lines.pop(0).startswith("PING "))
+        self.assertEquals(len(self.conn.timers), 1)
+
+    def test_readable_at_used_once(self):
+        from time import time
+        self.conn.io.readable_at = time() - 10.0
+        self.conn.consume(":srv NOTICE * :hi\r\n")
+        self.assertTrue(self.conn.dispatch_lag.last >= 10.0)
+        self.assertEquals(self.conn.io.readable_at, None)
+        self.conn.consume(":srv NOTICE * :again\r\n")
+        self.assertTrue(self.conn.dispatch_lag.last < 10.0)
@@ -0,0 +1,78 @@
+from irken.dispatch import handler
+from irken.modes import ModeMixin, ModeChange, ModeTable
+from irken.tests import TestConnection, IrkenTestCase
+
+class ModeTest(ModeMixin, TestConnection):
+    def __init__(self, *args, **kwds):
+        super(ModeTest, self).__init__(*args, **kwds)
+        self.changes = []
+
+    @handler("channel modes")
+    def note_modes(self, name, source, channel, changes):
+        self.changes.append((source.nick, channel, changes))
+
+class ModeTableTestCase(IrkenTestCase):
+    def test_param_kinds(self):
+        table = ModeTable("beI,k,fl,imnpst", "(qaohv)~&@%+")
+        self.assertEquals(table.parse("+fqlb", ["[5:2]", "a", "10", "m"]),
+                          [(True, "f", "[5:2]"), (True, "q", "a"),
+                           (True, "l", "10"), (True, "b", "m")])
+        self.assertEquals(table.parse("-fqlb", ["a", "m"]),
+                          [(False, "f", None), (False, "q", "a"),
+                           (False, "l", None), (False, "b", "m")])
+
+    def test_ban_list_query(self):
+        self.assertEquals(ModeTable().parse("+b", []), [(True, "b", None)])
+
+    def test_unknown_modes_take_nothing(self):
+        self.assertEquals(ModeTable().parse("+Zo", ["a"]),
+                          [(True, "Z", None), (True, "o", "a")])
+
+class ModeMixinTestCase(IrkenTestCase):
+    irken_cls = ModeTest
+
+    def test_channel_modes_event(self):
+        self.feed_lines(":srv 005 tester CHANMODES=beI,k,fl,imnpst "
+                        "PREFIX=(ohv)@%+ :are supported\r\n",
+                        ":op!o@h MODE #chan +hf-v a [5:2] b\r\n",
+                        ":op!o@h MODE tester +i\r\n")
+        self.assertEquals(self.conn.changes, [
+            ("op", "#chan", [(True, "h", "a"), (True, "f", "[5:2]"),
+                             (False, "v", "b")])])
+
+    def test_table_rebuilt_on_isupport(self):
+        table = self.conn.mode_table()
+        self.assertTrue(self.conn.mode_table() is table)
+        self.feed_lines(":srv 005 tester CHANMODES=b,k,l,imnt "
+                        ":are supported\r\n")
+        self.assertFalse(self.conn.mode_table() is table)
+
+    def test_pack_by_modes(self):
+        self.feed_lines(":srv 005 tester MODES=4 :are supported\r\n")
+        masks = ["*!*@host%d" % (i,) for i in range(10)]
+        n = self.conn.set_modes("#chan", [ModeChange(False, "b", mask)
+                                          for mask in masks])
+        self.assertEquals(n, 3)
+        lines = self.conn.io.sent_lines.pop(0).split("\r\n")[:-1]
+        self.assertEquals(lines[0], "MODE #chan -bbbb " + " ".join(masks[:4]))
+        self.assertEquals(lines[2], "MODE #chan -bb " + " ".join(masks[8:]))
+
+    def test_pack_by_length(self):
+        self.feed_lines(":srv 005 tester MODES :are supported\r\n")
+        masks = ["*!*@%s.example.org" % ("x" * 60 + str(i),)
+                 for i in range(20)]
+        self.conn.set_modes("#chan", [ModeChange(True, "b", mask)
+                                      for mask in masks])
+        lines = self.conn.io.sent_lines.pop(0).split("\r\n")[:-1]
+        self.assertTrue(len(lines) > 1)
+        self.assertTrue(all(len(line) + 2 <= 512 for line in lines))
+        self.assertEquals(sum(len(line.split()) - 3 for line in lines), 20)
+
+    def test_queue(self):
+        for nick in ("a", "b", "c", "d"):
+            self.conn.queue_mode("#chan", True, "o", nick)
+        self.conn.queue_mode("#chan", False, "m")
+        self.assertEquals(self.conn.io.sent_lines, [])
+        self.conn.timers.advance(self.conn.timers.next_deadline())
+        self.assert_sent("MODE #chan +ooo a b c\r\nMODE #chan +o-m d\r\n")
+        self.assertEquals(len(self.conn.timers), 0)
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+from irken.msglog import MessageLog, MessageLogMixin
+from irken.tests import TestConnection, IrkenTestCase
+
+class MessageLogTest(MessageLogMixin, TestConnection):
+    pass
+
+class MessageLogTestCase(IrkenTestCase):
+    irken_cls = MessageLogTest
+
+    def setUp(self):
+        super(MessageLogTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(MessageLogTestCase, self).tearDown()
+
+    def test_targets(self):
+        log = self.conn.message_log = MessageLog(self.dir)
+        self.conn.consume(":a!b@c PRIVMSG #Chan :public\r\n"
+                          ":a!b@c PRIVMSG tester :private\r\n"
+                          ":a!b@c QUIT :bye\r\n"
+                          "PING :srv\r\n")
+        self.assert_sent("PONG srv\r\n")
+        self.assertEquals([l for t, l in log.tail("#chan", 5)],
+                          [":a!b@c PRIVMSG #Chan :public"])
+        self.assertEquals([l for t, l in log.tail("a", 5)],
+                          [":a!b@c PRIVMSG tester :private",
+                           ":a!b@c QUIT :bye"])
+        self.assertEquals(len(log.tail("*", 5)), 1)
+
+    def test_rotation_and_compaction(self):
+        log = MessageLog(self.dir, segment_size=200, max_size=500,
+                         flush_bytes=100)
+        for i in range(40):
+            log.append("#c", "PRIVMSG #c :message number %02d" % i, when=i)
+        self.assertTrue(len(log.segments) > 1)
+        total = sum(os.path.getsize(log._path(seg)) for seg in log.segments)
+        self.assertTrue(total <= 500 + 200)
+        last = log.tail("#c", 3)
+        self.assertEquals([when for when, line in last], [37.0, 38.0, 39.0])
+        log.close()
+        reopened = MessageLog(self.dir)
+        self.assertEquals(reopened.tail("#c", 3), last)
+        self.assertEquals(reopened.between("#c", 0, 1000),
+                          log.between("#c", 0, 1000))
+
+    def test_torn_write(self):
+        log = MessageLog(self.dir)
+        log.append("#c", "one", when=1)
+        log.close()
+        with open(log._path(0), "ab") as fp:
+            fp.write("2.000 #c tor")
+        log = MessageLog(self.dir)
+        log.append("#c", "two", when=3)
+        self.assertEquals(log.tail("#c", 5), [(1.0, "one"), (3.0, "two")])
+        log.close()
+        self.assertEquals(MessageLog(self.dir).tail("#c", 5),
+                          [(1.0, "one"), (3.0, "two")])
+
+    def test_times_as_written(self):
+        log = MessageLog(self.dir)
+        log.append("#c", "one", when=1.0004)
+        log.append("#c", "two", when=2.0004)
+        self.assertEquals(log.between("#c", 1.0, 1.0), [(1.0, "one")])
+        self.assertEquals(log.between("#c", 2.0002, 3), [])
+        log.close()
+        reopened = MessageLog(self.dir)
+        self.assertEquals(reopened.between("#c", 1.0, 1.0), [(1.0, "one")])
+        self.assertEquals(reopened.between("#c", 2.0002, 3), [])
+
+    def test_own_nick_casemapped(self):
+        log = self.conn.message_log = MessageLog(self.dir)
+        self.conn.nick = "te[st"
+        self.conn.consume(":a!b@c PRIVMSG TE{ST :private\r\n")
+        self.assertEquals([l for t, l in log.tail("a", 5)],
+                          [":a!b@c PRIVMSG TE{ST :private"])
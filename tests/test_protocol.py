@@ -0,0 +1,43 @@
+from irken.protocol import Protocol
+from irken.tests import IrkenTestCase
+
+class ProtocolTestCase(IrkenTestCase):
+    def test_split_reads(self):
+        proto = Protocol()
+        self.assertEquals(proto.receive_data("PI"), [])
+        self.assertEquals(proto.receive_data("NG"), [])
+        msgs = proto.receive_data(" :a\r\nPING :b\r\n\r\n")
+        self.assertEquals([m.args for m in msgs], [["a"], ["b"]])
+        self.assertEquals(proto.in_tail, "")
+
+    def test_consume_keeps_tail(self):
+        self.conn.consume("PING :hel")
+        self.assertEquals(self.conn.io.sent_lines, [])
+        self.conn.consume("lo\r\n")
+        self.assert_sent("PONG hello\r\n")
+
+    def test_manual_flush(self):
+        self.conn.autoflush = False
+        self.conn.send_cmd(None, "A", ())
+        self.conn.send_cmd(None, "B", ())
+        self.assertEquals(self.conn.io.sent_lines, [])
+        self.conn.flush()
+        self.assert_sent("A\r\nB\r\n")
+        self.conn.flush()
+        self.assertEquals(self.conn.io.sent_lines, [])
+
+class TagsTestCase(IrkenTestCase):
+    def test_tags_visible_to_handlers(self):
+        seen = []
+        self.conn.evtable["irc cmd privmsg"] = ["note_tags"]
+        self.conn.note_tags = lambda cmd, *args: seen.append(self.conn.tags)
+        self.conn.consume("@time=2012-06-30T23:59:60.419Z;msgid=a\\sb "
+                          ":nick!u@h PRIVMSG #chan :hi\r\n")
+        self.assertEquals(seen[0]["msgid"], "a b")
+        self.conn.consume(":nick!u@h PRIVMSG #chan :hi\r\n")
+        self.assertEquals(seen[1], None)
+
+    def test_send_tags(self):
+        self.conn.send_cmd(None, "TAGMSG", ("#chan",),
+                           tags={"+typing": "active"})
+        self.assert_sent("@+typing=active TAGMSG #chan\r\n")
@@ -0,0 +1,125 @@
+from irken.queries import QueryMixin
+from irken.tests import TestConnection, IrkenTestCase
+
+class QueryTest(QueryMixin, TestConnection):
+    pass
+
+class QueryTestCase(IrkenTestCase):
+    irken_cls = QueryTest
+
+    def test_whois(self):
+        query = self.conn.whois("friend")
+        self.assert_sent("WHOIS friend\r\n")
+        self.feed_lines(":srv 311 tester Friend fu fh * :Real Name\r\n",
+                        ":srv 319 tester Friend :@#a +#b\r\n",
+                        ":srv 319 tester Friend :#c\r\n",
+                        ":srv 317 tester Friend 12 1000 :seconds idle\r\n",
+                        ":srv 313 tester Friend :is an operator\r\n")
+        self.assertFalse(query.done)
+        self.feed_lines(":srv 318 tester Friend :End of /WHOIS list.\r\n")
+        self.assertTrue(query.done)
+        self.assertEquals(query.result["channels"], ["@#a", "+#b", "#c"])
+        self.assertEquals(query.result["idle"], 12)
+        self.assertTrue(query.result["operator"])
+        # Cached now, until friend changes nick.
+        self.assertTrue(self.conn.whois("FRIEND") is query)
+        self.assertEquals(self.conn.io.sent_lines, [])
+        self.feed_lines(":friend!fu@fh NICK other\r\n")
+        self.assertFalse(self.conn.whois("friend") is query)
+        self.assert_sent("WHOIS friend\r\n")
+
+    def test_whois_no_such_nick(self):
+        query = self.conn.whois("ghost")
+        self.assert_sent("WHOIS ghost\r\n")
+        self.feed_lines(":srv 401 tester ghost :No such nick/channel\r\n",
+                        ":srv 318 tester ghost :End of /WHOIS list.\r\n")
+        self.assertTrue(query.done)
+        self.assertEquals(query.error, "No such nick/channel")
+        # Failures aren't cached.
+        self.conn.whois("ghost")
+        self.assert_sent("WHOIS ghost\r\n")
+
+    def test_timeout(self):
+        done = []
+        query = self.conn.whois("lost").add_callback(done.append)
+        self.assert_sent("WHOIS lost\r\n")
+        self.conn.timers.advance(query.timer.deadline)
+        self.assertEquals(done, [query])
+        self.assertEquals(query.error, "timed out")
+        # A late reply pairs up with nothing, and the next query is new.
+        self.feed_lines(":srv 318 tester lost :End of /WHOIS list.\r\n")
+        self.assertFalse(self.conn.whois("lost") is query)
+        self.assert_sent("WHOIS lost\r\n")
+
+    def test_who_in_order(self):
+        a, b = self.conn.who("#a"), self.conn.who("#b")
+        self.assert_sent("WHO #a\r\n")
+        self.assert_sent("WHO #b\r\n")
+        self.feed_lines(":srv 352 tester #a u1 h1 srv n1 H :0 Real One\r\n",
+                        ":srv 315 tester #a :End of /WHO list.\r\n",
+                        ":srv 352 tester #b u2 h2 srv n2 G@ :3 Two\r\n",
+                        ":srv 315 tester #b :End of /WHO list.\r\n")
+        self.assertEquals([u["nick"] for u in a.result], ["n1"])
+        self.assertEquals(b.result[0]["hops"], 3)
+        self.assertEquals(b.result[0]["realname"], "Two")
+        self.feed_lines(":n2!u2@h2 QUIT :bye\r\n")
+        self.assertTrue(self.conn.who("#a") is a)
+        self.assertFalse(self.conn.who("#b") is b)
+        self.assert_sent("WHO #b\r\n")
+
+    def test_whox_batch(self):
+        self.feed_lines(":srv 005 tester WHOX :are supported\r\n")
+        a, b = self.conn.who_many(["#a", "#b"])
+        self.assert_sent("WHO #a %tcuhnfar,1\r\nWHO #b %tcuhnfar,2\r\n")
+        # Replies correlate by mask and token, whatever order they come in;
+        # the stray row has some other token.
+        self.feed_lines(":srv 354 tester 2 #b u2 h2 n2 H acct :Two\r\n",
+                        ":srv 354 tester 9 #b u9 h9 n9 H 0 :Stray\r\n",
+                        ":srv 315 tester #b :End of /WHO list.\r\n",
+                        ":srv 354 tester 1 #a u1 h1 n1 H 0 :One\r\n",
+                        ":srv 315 tester #a :End of /WHO list.\r\n")
+        self.assertTrue(a.done and b.done)
+        self.assertEquals(a.result, [{"channel": "#a", "user": "u1",
+                                      "host": "h1", "nick": "n1",
+                                      "flags": "H", "account": None,
+                                      "realname": "One"}])
+        self.assertEquals([u["account"] for u in b.result], ["acct"])
+
+    def test_names(self):
+        query = self.conn.names("#chan")
+        self.assertTrue(self.conn.names("#Chan") is query)
+        self.assert_sent("NAMES #chan\r\n")
+        self.feed_lines(":srv 353 tester = #chan :@op +voice plain\r\n",
+                        ":srv 353 tester = #chan :more\r\n",
+                        ":srv 366 tester #chan :End of /NAMES list.\r\n")
+        self.assertEquals(query.result, {"op": "@", "voice": "+", "plain": "",
+                                         "more": ""})
+        self.feed_lines(":op!o@h QUIT :bye\r\n")
+        self.conn.names("#chan")
+        self.assert_sent("NAMES #chan\r\n")
+        self.feed_lines(":srv 366 tester #chan :End of /NAMES list.\r\n")
+        self.feed_lines(":new!n@h JOIN #chan\r\n")
+        self.conn.names("#chan")
+        self.assert_sent("NAMES #chan\r\n")
+
+    def test_unsolicited_replies(self):
+        self.feed_lines(":srv 353 tester = #x :a b\r\n",
+                        ":srv 366 tester #x :End of /NAMES list.\r\n",
+                        ":srv 311 tester x u h * :X\r\n",
+                        ":srv 318 tester x :End of /WHOIS list.\r\n")
+        self.assertEquals(self.conn._query_cache, {})
+
+    def test_nick_index_shrinks(self):
+        self.conn.query_ttl = -1.0
+        self.conn.names("#chan")
+        self.assert_sent("NAMES #chan\r\n")
+        self.feed_lines(":srv 353 tester = #chan :a b\r\n",
+                        ":srv 366 tester #chan :End of /NAMES list.\r\n")
+        self.assertEquals(sorted(self.conn._cached_nicks), ["a", "b"])
+        # Expired, so asked again and forgotten.
+        self.conn.names("#chan")
+        self.assert_sent("NAMES #chan\r\n")
+        self.assertEquals(self.conn._cached_nicks, {})
+        self.feed_lines(":srv 366 tester #chan :End of /NAMES list.\r\n")
+        self.conn.forget_query(("names", "#chan"))
+        self.assertEquals(self.conn._cached_nicks, {})
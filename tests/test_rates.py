@@ -0,0 +1,79 @@
+import unittest
+from irken.dispatch import handler
+from irken.rates import RateCounter, FloodMixin
+from irken.tests import TestConnection, IrkenTestCase
+
+class RateCounterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rates = RateCounter(span=60, buckets=6, width=64, depth=3, now=0)
+
+    def test_sliding(self):
+        for t in range(60):
+            self.rates.add("a", now=t)
+        self.assertEquals(self.rates.count("a", now=59), 60)
+        self.assertEquals(self.rates.count("a", 30, now=59), 30)
+        # The oldest bucket has slid out; the newest has just begun.
+        self.assertEquals(self.rates.count("a", now=60), 50)
+        self.assertEquals(self.rates.count("a", now=125), 0)
+
+    def test_never_underestimates(self):
+        for i in range(1000):
+            self.rates.add("key%d" % (i,), count=i % 7, now=5)
+        for i in range(1000):
+            self.assertTrue(self.rates.count("key%d" % (i,), now=5) >= i % 7)
+
+    def test_bounded(self):
+        size = len(self.rates.counters)
+        for i in range(10000):
+            self.rates.add(("nick%d" % (i,), "#chan"), now=i % 120)
+        self.assertEquals(len(self.rates.counters), size)
+        self.assertEquals(size, 6 * 64 * 3)
+
+class FloodTest(FloodMixin, TestConnection):
+    flood_limit = 3
+    flood_total_limit = 5
+
+    def __init__(self, *args, **kwds):
+        super(FloodTest, self).__init__(*args, **kwds)
+        self.floods = []
+        self.messages = []
+
+    @handler("flood")
+    def note_flood(self, name, source, target):
+        self.floods.append((source.nick, target))
+
+    @handler("irc cmd privmsg")
+    def note_privmsg(self, cmd, target, text):
+        self.messages.append((cmd.source.nick, target, text))
+
+class FloodTestCase(IrkenTestCase):
+    irken_cls = FloodTest
+
+    def say(self, mask, target, count):
+        self.feed_lines(*[":%s PRIVMSG %s :%d\r\n" % (mask, target, i)
+                          for i in range(count)])
+
+    def test_per_target(self):
+        self.say("spam!u@bad.host", "#a", 5)
+        self.say("ok!u@good.host", "#a", 2)
+        self.assertEquals(len(self.conn.messages), 3 + 2)
+        self.assertEquals(self.conn.floods, [("spam", "#a")])
+
+    def test_total_and_nick_changes(self):
+        self.say("spam!u@bad.host", "#a", 3)
+        self.say("spam2!u@bad.host", "#b", 3)
+        self.assertEquals(len(self.conn.messages), 5)
+        self.assertEquals(self.conn.floods, [("spam2", "#b")])
+        rate = self.conn.message_rate
+        self.assertEquals(rate(self.conn.lookup_prefix(("other",))), 0)
+        # Both nicks are the same host.
+        source = self.conn.lookup_prefix(("spam",))
+        self.assertEquals(rate(source), 0.6)
+        self.assertEquals(rate(source, target="#A"), 0.3)
+
+    def test_event_despite_jumps(self):
+        # As if collisions took the count from the limit past limit + 1.
+        self.conn.rates.add(("bad.host", "#a"), count=4)
+        self.say("spam!u@bad.host", "#a", 2)
+        self.assertEquals(self.conn.floods, [("spam", "#a")])
+        self.assertEquals(self.conn.messages, [])
@@ -0,0 +1,118 @@
+from irken.dispatch import handler
+from irken.register import RegistrationMixin
+from irken.tests import TestConnection, IrkenTestCase
+
+class RegisterTest(RegistrationMixin, TestConnection):
+    def __init__(self, *args, **kwds):
+        super(RegisterTest, self).__init__(*args, **kwds)
+        self.results = []
+
+    @handler("sasl result")
+    def note_result(self, name, success):
+        self.results.append(success)
+
+class RegistrationTestCase(IrkenTestCase):
+    irken_cls = RegisterTest
+
+    def setUp(self):
+        self.conn = self.irken_cls(self.nick, autoregister=("u", "r"),
+                                   alt_nicks=["tester2"],
+                                   sasl=("EXTERNAL",))
+
+    def negotiate_sasl(self):
+        self.conn.start_negotiation()
+        self.assert_sent("CAP LS 302\r\n")
+        self.feed_lines(":srv CAP * LS :sasl\r\n")
+        self.assert_sent("CAP REQ sasl\r\n")
+        self.feed_lines(":srv CAP * ACK :sasl\r\n")
+        self.assert_sent("AUTHENTICATE EXTERNAL\r\n")
+        self.feed_lines("AUTHENTICATE +\r\n")
+        self.assert_sent("AUTHENTICATE +\r\n")
+
+    def test_sasl_external(self):
+        self.negotiate_sasl()
+        self.feed_lines(":srv 900 tester tester!t@h acct :You are now "
+                        "logged in as acct\r\n",
+                        ":srv 903 tester :SASL authentication successful\r\n")
+        self.assert_sent("CAP END\r\n")
+        self.assertEquals((self.conn.account, self.conn.results),
+                          ("acct", [True]))
+
+    def test_sasl_failure_still_ends(self):
+        self.negotiate_sasl()
+        self.feed_lines(":srv 904 tester :SASL authentication failed\r\n")
+        self.assert_sent("CAP END\r\n")
+        self.assertEquals(self.conn.results, [False])
+
+    def test_sasl_timeout(self):
+        self.negotiate_sasl()
+        timer = self.conn._sasl_timer
+        self.conn.timers.advance(timer.deadline)
+        self.assert_sent("CAP END\r\n")
+        self.assertEquals(self.conn.results, [False])
+        # A late answer changes nothing.
+        self.feed_lines(":srv 903 tester :SASL authentication successful\r\n")
+        self.assertEquals(self.conn.results, [False])
+
+    def test_mechanism_not_offered(self):
+        self.conn.start_negotiation()
+        self.assert_sent("CAP LS 302\r\n")
+        self.feed_lines(":srv CAP * LS :sasl=PLAIN\r\n")
+        self.assert_sent("CAP REQ sasl\r\n")
+        self.feed_lines(":srv CAP * ACK :sasl\r\n")
+        self.assert_sent("CAP END\r\n")
+
+    def test_nick_fallback(self):
+        self.feed_lines(":srv 433 * tester :Nickname is already in use\r\n")
+        self.assert_sent("NICK tester2\r\n")
+        self.feed_lines(":srv 433 * tester2 :Nickname is already in use\r\n")
+        self.assert_sent("NICK tester_\r\n")
+        self.feed_lines(":srv 432 * tester_ :Erroneous nickname\r\n")
+        nick = self.conn.io.sent_lines.pop(0)[5:-2]
+        self.assertTrue(nick.startswith("tester") and nick[6:].isdigit())
+        self.assertEquals(self.conn.nick, nick)
+        self.feed_lines(":srv 001 %s :Welcome\r\n" % (nick,))
+        self.assertTrue(self.conn.registered)
+        # From now on, a taken nick is the business of whoever asked for it.
+        self.feed_lines(":srv 433 %s other :Nickname is already in use\r\n"
+                        % (nick,))
+        self.assertEquals(self.conn.io.sent_lines, [])
+
+    def test_join_packing(self):
+        self.conn.channels = ["#chan%03d" % (i,) for i in range(100)]
+        self.conn.channels[50] = ("#keyed", "sekrit")
+        self.feed_lines(":srv 001 tester :Welcome\r\n")
+        lines = self.conn.io.sent_lines.pop(0).split("\r\n")[:-1]
+        self.assertTrue(len(lines) > 1)
+        self.assertTrue(all(len(line) + 2 <= 512 for line in lines))
+        self.assertEquals(lines[0].split()[2], "sekrit")
+        self.assertTrue(lines[0].split()[1].startswith("#keyed,"))
+        names = sum((line.split()[1].split(",") for line in lines), [])
+        self.assertEquals(len(names), 100)
+
+    def test_join_targmax(self):
+        self.feed_lines(":srv 005 tester TARGMAX=JOIN:2 :are supported\r\n")
+        self.conn.join_channels({"#a": None, "#b": None, "#c": None})
+        lines = self.conn.io.sent_lines.pop(0).split("\r\n")[:-1]
+        self.assertEquals([len(line.split()[1].split(",")) for line in lines],
+                          [2, 1])
+
+    def test_reconnect(self):
+        self.conn.channels = ["#a"]
+        self.conn.sasl = ("EXTERNAL",)
+        for i in range(2):
+            self.conn.connect(("irc.example.org", 6667))
+            self.assertEquals(self.conn.registered, False)
+            del self.conn.io.sent_lines[:]
+            self.feed_lines(":srv CAP * LS :sasl\r\n",
+                            ":srv CAP * ACK :sasl\r\n")
+            self.assert_sent("CAP REQ sasl\r\n")
+            self.assert_sent("AUTHENTICATE EXTERNAL\r\n")
+            self.feed_lines(":srv 433 * tester :Nickname is already in use\r\n")
+            self.assert_sent("NICK tester2\r\n")
+            # No JOIN before the welcome.
+            self.assertEquals(self.conn.io.sent_lines, [])
+            self.feed_lines(":srv 001 tester2 :Welcome\r\n")
+            self.assert_sent("JOIN #a\r\n")
+            self.conn.nick = "tester"
+            del self.conn.io.sent_lines[:]
@@ -0,0 +1,113 @@
+import socket
+from irken.relay import RelayMixin, Relay, TokenBucket
+from irken.io import SimpleSocketIO
+from irken.tests import TestConnection, IrkenTestCase
+
+class RelayTest(RelayMixin, TestConnection):
+    make_io = SimpleSocketIO
+
+class RelayTestCase(IrkenTestCase):
+    irken_cls = RelayTest
+
+    def setUp(self):
+        super(RelayTestCase, self).setUp()
+        ours, self.server = socket.socketpair()
+        self.server.settimeout(5)
+        self.conn.io.adopt_socket(ours)
+        self.relay = Relay(self.conn, password="sekrit",
+                           flood=TokenBucket(burst=2, rate=1000))
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.relay.close()
+        self.conn.io.socket.close()
+        self.server.close()
+
+    def attach(self):
+        client = socket.create_connection(self.relay.address)
+        client.settimeout(5)
+        self.clients.append(client)
+        client.sendall("PASS sekrit\r\nNICK me\r\nUSER me 0 * :Me\r\n")
+        return client
+
+    def spin(self, n=5):
+        for i in xrange(n):
+            self.relay.run_once(0.01)
+
+    def upstream(self, data):
+        self.server.sendall(data)
+        self.spin()
+
+    def read_lines(self, sock, n):
+        data = ""
+        while data.count("\r\n") < n:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data.split("\r\n")[:n]
+
+    def test_attach_and_relay(self):
+        self.upstream(":srv 001 tester :Welcome\r\n"
+                      ":srv 005 tester NICKLEN=30 :are supported\r\n"
+                      ":a!b@c PRIVMSG #chan :\xe5 before\r\n"
+                      "PING :srv\r\n")
+        self.assertEquals(self.server.recv(100), "PONG srv\r\n")
+        client = self.attach()
+        self.spin()
+        self.assertEquals(self.read_lines(client, 3),
+                          [":srv 001 tester :Welcome",
+                           ":srv 005 tester NICKLEN=30 :are supported",
+                           ":a!b@c PRIVMSG #chan :\xe5 before"])
+        other = self.attach()
+        self.spin()
+        self.read_lines(other, 3)
+        self.upstream("@time=x :a!b@c PRIVMSG #chan :after\r\n")
+        for sock in (client, other):
+            self.assertEquals(self.read_lines(sock, 1),
+                              ["@time=x :a!b@c PRIVMSG #chan :after"])
+
+        client.sendall("PRIVMSG #chan :from client\r\nPING :x\r\n")
+        self.spin()
+        self.assertEquals(self.server.recv(100),
+                          "PRIVMSG #chan :from client\r\n")
+        self.assertEquals(self.read_lines(client, 1),
+                          [":irken.relay PONG irken.relay :x"])
+        self.assertEquals(self.read_lines(other, 1),
+                          [":tester PRIVMSG #chan :from client"])
+
+        client.sendall("@+draft/reply=1 NOTICE #chan :tagged\r\n")
+        self.spin()
+        self.assertEquals(self.server.recv(100),
+                          "@+draft/reply=1 NOTICE #chan :tagged\r\n")
+        self.assertEquals(self.read_lines(other, 1),
+                          ["@+draft/reply=1 :tester NOTICE #chan :tagged"])
+
+    def test_flood_control(self):
+        self.relay.flood = TokenBucket(burst=2, rate=0.001)
+        client = self.attach()
+        self.spin()
+        client.sendall("JOIN #a\r\nJOIN #b\r\nJOIN #c\r\n")
+        self.spin()
+        self.assertEquals(self.server.recv(100), "JOIN #a\r\nJOIN #b\r\n")
+        self.assertEquals(list(self.relay.upstream_queue), ["JOIN #c"])
+
+    def test_bad_password(self):
+        client = socket.create_connection(self.relay.address)
+        self.clients.append(client)
+        client.settimeout(5)
+        client.sendall("NICK me\r\nUSER me 0 * :Me\r\n")
+        self.spin()
+        self.assertEquals(self.read_lines(client, 1),
+                          [":irken.relay 464 me :Password incorrect"])
+        self.assertEquals(self.relay.clients, [])
+
+    def test_slow_client(self):
+        self.relay.client_buffer_limit = 100
+        self.attach()
+        self.spin()
+        self.assertEquals(len(self.relay.clients), 1)
+        self.relay.fan_out("x" * 101)
+        self.assertEquals(self.relay.clients, [])
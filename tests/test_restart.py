@@ -0,0 +1,90 @@
+import os
+import socket
+from irken import restart
+from irken.io import SimpleSocketIO, AsyncoreIO
+from irken.isupport import ISupportMixin
+from irken.tests import TestConnection, IrkenTestCase
+
+class RestartTest(restart.RestartMixin, ISupportMixin, TestConnection):
+    make_io = SimpleSocketIO
+
+class RestartTestCase(IrkenTestCase):
+    irken_cls = RestartTest
+
+    def setUp(self):
+        super(RestartTestCase, self).setUp()
+        self.ours, self.server = socket.socketpair()
+        self.conn.io.adopt_socket(self.ours)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_resume(self):
+        conn = self.conn
+        conn.consume(":srv 005 tester NICKLEN=30 :are supported\r\n"
+                     ":friend!f@h PRIVMSG tester :hi\r\n:srv PRIVMSG tes")
+        conn.autoflush = False
+        conn.send_cmd(None, "PRIVMSG", ("friend", "bye"))
+        ctrl, theirs = socket.socketpair()
+        state = conn.snapshot()
+        # Here, the "old process" is still around and owns the socket.
+        state["socket"] = (os.dup(state["socket"][0]),) + state["socket"][1:]
+        restart.send_states(ctrl, [state])
+        environ = {restart.env_var: str(os.dup(theirs.fileno()))}
+        theirs.close()
+        make = lambda state: RestartTest(state["nick"])
+        new_conn, = restart.resume(make, environ=environ)
+        self.assertEquals(ctrl.recv(2), "ok")
+        conn.handed_off()
+        self.assertEquals(conn.protocol.data_to_send(), "")
+        self.assertEquals(environ, {})
+        self.assertEquals(new_conn.isupport, {"NICKLEN": "30"})
+        self.assertEquals(new_conn.autoregister, ("test-user", "Test User One"))
+        self.assertTrue("friend" in new_conn._prefix_cache)
+        self.assertEquals(self.server.recv(100), "PRIVMSG friend bye\r\n")
+        self.server.sendall("ter :x\r\n")
+        new_conn.io.receive(new_conn.consume)
+        self.assertEquals(new_conn.protocol.in_tail, "")
+        self.assertTrue("srv" in new_conn._prefix_cache)
+
+    def test_nothing_to_resume(self):
+        self.assertEquals(restart.resume(None, environ={}), [])
+
+    def test_failed_hand_off_keeps_output(self):
+        self.conn.autoflush = False
+        self.conn.send_cmd(None, "PRIVMSG", ("friend", "still here"))
+        for executable, argv in (("/bin/true", []), ("/bin/sleep", ["5"])):
+            pid = restart.hand_off([self.conn], argv=argv,
+                                   executable=executable, timeout=0.5)
+            self.assertEquals(pid, None)
+        self.conn.flush()
+        self.assertEquals(self.server.recv(100),
+                          "PRIVMSG friend :still here\r\n")
+
+class AsyncoreRestartTest(RestartTest):
+    make_io = AsyncoreIO
+
+class AsyncoreRestartTestCase(IrkenTestCase):
+    irken_cls = AsyncoreRestartTest
+
+    def setUp(self):
+        super(AsyncoreRestartTestCase, self).setUp()
+        ours, self.server = socket.socketpair()
+        # Not connected as far as asyncore knows, so output stays queued.
+        self.conn.io.set_socket(ours)
+
+    def tearDown(self):
+        self.conn.io.close()
+        self.server.close()
+
+    def test_snapshot_keeps_queued_output(self):
+        conn = self.conn
+        conn.send_cmd(None, "PRIVMSG", ("friend", "queued"))
+        conn.autoflush = False
+        conn.send_cmd(None, "PRIVMSG", ("friend", "unflushed"))
+        self.assertEquals(conn.snapshot()["out"],
+                          "PRIVMSG friend queued\r\n"
+                          "PRIVMSG friend unflushed\r\n")
+        conn.handed_off()
+        self.assertEquals(conn.io.buffered_bytes(), 0)
+        self.assertEquals(conn.io.buffered_output(), "")
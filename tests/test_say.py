@@ -0,0 +1,33 @@
+# coding: utf-8
+
+from irken.say import SayMixin
+from irken.tests import TestConnection, IrkenTestCase
+
+class SayTest(SayMixin, TestConnection):
+    pass
+
+class SayTestCase(IrkenTestCase):
+    irken_cls = SayTest
+
+    def test_learn_from_join_and_396(self):
+        self.conn.consume(":tester!tu@host.example JOIN #chan\r\n")
+        self.assertEquals(self.conn.mask.to_string(), "tester!tu@host.example")
+        self.conn.consume(":srv 396 tester cloak :is now your hidden host\r\n")
+        self.assertEquals(self.conn.mask.to_string(), "tester!tu@cloak")
+
+    def test_unknown_mask_is_worst_case(self):
+        self.conn.isupport = {"HOSTLEN": "20"}
+        budget = self.conn.text_budget("PRIVMSG", "#c")
+        # ":tester!" + 10 + "@" + 20 + " PRIVMSG #c :\r\n"
+        self.assertEquals(budget, 512 - (8 + 10 + 1 + 20 + 15))
+
+    def test_say_utf8(self):
+        self.conn.consume(":tester!tu@h JOIN #c\r\n")
+        text = u"å" * 300
+        self.conn.say("#c", text)
+        lines = self.conn.io.sent_lines.pop().split("\r\n")[:-1]
+        self.assertEquals(len(lines), 2)
+        pieces = [line.split(" ", 2)[2].decode("utf-8") for line in lines]
+        self.assertEquals(u"".join(pieces), text)
+        relayed = max(len(":tester!tu@h " + line + "\r\n") for line in lines)
+        self.assertTrue(relayed <= 512)
@@ -0,0 +1,129 @@
+import socket
+import unittest
+from irken import shard
+from irken.io import SimpleSocketIO
+from irken.dispatch import handler
+from irken.tests import TestConnection
+
+class ShardTest(TestConnection):
+    make_io = SimpleSocketIO
+
+    @handler("irc cmd privmsg")
+    def on_privmsg(self, cmd, target, text):
+        if text == "boom":
+            raise ValueError("handler blew up")
+
+def make_conn(conn_id, spec):
+    conn = ShardTest(spec["nick"], autoregister=("shard", "Shard Test"))
+    conn.connect(spec["address"])
+    return conn
+
+class ShardTestCase(unittest.TestCase):
+    conn_ids = ("n0", "n1", "n2", "n3", "n4", "n5")
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.server.settimeout(5)
+        self.sup = shard.Supervisor(make_conn, 2)
+        self.sup.heartbeat = 0.05
+        address = self.server.getsockname()
+        for conn_id in self.conn_ids:
+            self.sup.add(conn_id, {"nick": "bot-" + conn_id,
+                                   "address": address})
+        self.clients = {}
+
+    def tearDown(self):
+        self.sup.stop()
+        for sock in self.clients.itervalues():
+            sock.close()
+        self.server.close()
+
+    def accept(self, n):
+        """Accept *n* connections, returning their conn ids."""
+        accepted = []
+        for i in xrange(n):
+            sock, _ = self.server.accept()
+            sock.settimeout(5)
+            nick = self.read_lines(sock, 2)[1].split()[1]
+            conn_id = nick[len("bot-"):]
+            self.clients[conn_id] = sock
+            accepted.append(conn_id)
+        return sorted(accepted)
+
+    def read_lines(self, sock, n):
+        data = ""
+        while data.count("\r\n") < n:
+            data += sock.recv(4096)
+        return data.split("\r\n")[:n]
+
+    def test_shard_of(self):
+        shards = [self.sup.shard_of(conn_id) for conn_id in self.conn_ids]
+        self.assertEquals(sorted(set(shards)), [0, 1])
+        self.assertEquals(shards, [shard.shard_of(c, 2) for c in self.conn_ids])
+
+    def test_fleet(self):
+        self.sup.start()
+        self.assertEquals(self.accept(len(self.conn_ids)), list(self.conn_ids))
+        self.sup.broadcast("PRIVMSG", ("#all", "hello there"))
+        for sock in self.clients.itervalues():
+            self.assertEquals(self.read_lines(sock, 1),
+                              ["PRIVMSG #all :hello there"])
+        self.sup.send_to("n1", "PING", ("x",))
+        self.assertEquals(self.read_lines(self.clients["n1"], 1), ["PING x"])
+        metrics = self.sup.metrics(timeout=5)
+        self.assertEquals(sorted(metrics), list(self.conn_ids))
+        self.assertEquals(metrics["n2"]["nick"], "bot-n2")
+
+        # Restart the shard n0 is in; only its connections come back.
+        index = self.sup.shard_of("n0")
+        pid = self.sup.processes[index].pid
+        moved = sorted(c for c in self.conn_ids
+                       if self.sup.shard_of(c) == index)
+        others = [c for c in self.conn_ids if c not in moved]
+        self.sup.restart(index)
+        self.assertNotEquals(self.sup.processes[index].pid, pid)
+        self.assertEquals(self.sup.health[index]["restarts"], 1)
+        for conn_id in moved:
+            self.assertEquals(self.clients.pop(conn_id).recv(100), "")
+        self.assertEquals(self.accept(len(moved)), moved)
+        self.sup.send_to(others[0], "PING", ("y",))
+        self.assertEquals(self.read_lines(self.clients[others[0]], 1),
+                          ["PING y"])
+
+    def test_dead_worker(self):
+        self.sup.start()
+        self.accept(len(self.conn_ids))
+        self.sup.processes[0].terminate()
+        self.sup.processes[0].join()
+        self.sup.poll(0)
+        self.assertTrue(self.sup.processes[0].is_alive())
+        self.assertEquals(self.sup.health[0]["restarts"], 1)
+        self.assertEquals(self.sup.health[1]["restarts"], 0)
+
+    def test_heartbeat(self):
+        self.sup.start()
+        self.accept(len(self.conn_ids))
+        for i in xrange(10):
+            self.sup.poll(0.05)
+        counts = [self.sup.health[i]["connections"] for i in (0, 1)]
+        self.assertEquals(sum(counts), len(self.conn_ids))
+
+    def test_connection_error(self):
+        self.sup.start()
+        self.accept(len(self.conn_ids))
+        index = self.sup.shard_of("n0")
+        pid = self.sup.processes[index].pid
+        self.clients["n0"].sendall(":x!y@z PRIVMSG bot-n0 :boom\r\n")
+        self.assertEquals(self.clients["n0"].recv(100), "")
+        for i in xrange(5):
+            self.sup.poll(0.05)
+        # Only that connection went; its worker carries on.
+        self.assertEquals(self.sup.processes[index].pid, pid)
+        self.assertEquals(self.sup.health[index]["restarts"], 0)
+        self.assertTrue("n0" in self.sup.health[index]["dead"])
+        for conn_id in self.conn_ids[1:]:
+            self.sup.send_to(conn_id, "PING", (conn_id,))
+            self.assertEquals(self.read_lines(self.clients[conn_id], 1),
+                              ["PING " + conn_id])